@@ -1,4 +1,4 @@
-import React, { createContext, useContext, useState, useEffect } from 'react';
+import React, { createContext, useContext, useState, useEffect, useRef } from 'react';
 import { useAuth } from './AuthContext';
 import { API_URL } from '../config';
 
@@ -47,6 +47,8 @@ export function DeviceProvider({ children }) {
     const [rooms, setRooms] = useState([]);
     const [automations, setAutomations] = useState([]);
     const [lastCommandTime, setLastCommandTime] = useState(Date.now());  
+    // Latest device change version seen, so polls only fetch deltas
+    const deviceVersionRef = useRef(null);
 
     // Get auth token for API requests
     const { accessToken, isAuthenticated, refreshAuth } = useAuth() || {};
@@ -62,6 +64,54 @@ export function DeviceProvider({ children }) {
     };
 
 
+    /**
+     * Appends ?since=<version> once a full list has been loaded.
+     */
+    const devicesUrl = (url) => {
+        return deviceVersionRef.current !== null ? `${url}?since=${deviceVersionRef.current}` : url;
+    };
+
+    /**
+     * Applies a devices response: a full list replaces the state,
+     * a delta ({ version, changed, deleted }) is merged into it.
+     */
+    const applyDevicesResponse = async (response) => {
+        const data = await response.json();
+
+        if (Array.isArray(data)) {
+            const version = response.headers.get('X-Devices-Version');
+            deviceVersionRef.current = version !== null ? Number(version) : null;
+            setDevices(data);
+            // Emit an event that devices have been updated
+            DeviceEvents.emit(DEVICE_EVENTS.DEVICES_UPDATED, data);
+            return;
+        }
+
+        deviceVersionRef.current = data.version;
+        if (data.changed.length === 0 && data.deleted.length === 0) {
+            return;
+        }
+
+        setDevices(prevDevices => {
+            const deleted = new Set(data.deleted);
+            const changed = new Map(data.changed.map(device => [device.id, device]));
+            const known = new Set(prevDevices.map(device => device.id));
+
+            const nextDevices = prevDevices
+                .filter(device => !deleted.has(device.id))
+                .map(device => changed.get(device.id) || device);
+            data.changed.forEach(device => {
+                if (!known.has(device.id)) {
+                    nextDevices.push(device);
+                }
+            });
+
+            // Emit an event that devices have been updated
+            DeviceEvents.emit(DEVICE_EVENTS.DEVICES_UPDATED, nextDevices);
+            return nextDevices;
+        });
+    };
+
      /**
      * Fetches the list of devices from the backend API.
      * If the request is successful, it updates the devices state.
@@ -74,13 +124,10 @@ export function DeviceProvider({ children }) {
         try {
             // For testing, use the debug endpoint that doesn't require authentication
             // TEMPORARY SOLUTION UNTIL AUTH IS WORKING
-            const debugResponse = await fetch(`${API_URL}/debug/devices`);
+            const debugResponse = await fetch(devicesUrl(`${API_URL}/debug/devices`));
             
             if (debugResponse.ok) {
-                const data = await debugResponse.json();
-                setDevices(data);
-                // Emit an event that devices have been updated
-                DeviceEvents.emit(DEVICE_EVENTS.DEVICES_UPDATED, data);
+                await applyDevicesResponse(debugResponse);
                 setIsLoading(false);
                 return;
             }
@@ -91,7 +138,7 @@ export function DeviceProvider({ children }) {
                 return;
             }
             
-            const response = await fetch(`${API_URL}/devices`, {
+            const response = await fetch(devicesUrl(`${API_URL}/devices`), {
                 headers: getAuthHeaders()
             });
             
@@ -100,14 +147,11 @@ export function DeviceProvider({ children }) {
                 const refreshed = refreshAuth && await refreshAuth();
                 if (refreshed) {
                     // Retry with new token
-                    const retryResponse = await fetch(`${API_URL}/devices`, {
+                    const retryResponse = await fetch(devicesUrl(`${API_URL}/devices`), {
                         headers: getAuthHeaders()
                     });
                     if (retryResponse.ok) {
-                        const data = await retryResponse.json();
-                        setDevices(data);
-                        // Emit an event that devices have been updated
-                        DeviceEvents.emit(DEVICE_EVENTS.DEVICES_UPDATED, data);
+                        await applyDevicesResponse(retryResponse);
                     } else {
                         setError('Authentication error');
                     }
@@ -115,10 +159,7 @@ export function DeviceProvider({ children }) {
                     console.log('Session expired or token refresh failed');
                 }
             } else if (response.ok) {
-                const data = await response.json();
-                setDevices(data);
-                // Emit an event that devices have been updated
-                DeviceEvents.emit(DEVICE_EVENTS.DEVICES_UPDATED, data);
+                await applyDevicesResponse(response);
             } else {
                 const errorData = await response.json();
                 setError(errorData.error || 'Failed to fetch devices');
@@ -522,6 +522,22 @@ export default function AnalyticsDashboardScreen() {
   };
 
   // Function to handle quick actions for device troubleshooting
+  // Diagnostics run as background jobs on the backend; poll until one finishes
+  const pollDeviceJob = async (jobId, { intervalMs = 1000, maxAttempts = 30 } = {}) => {
+    for (let attempt = 0; attempt < maxAttempts; attempt++) {
+      const response = await fetch(`http://localhost:5000/api/devices/jobs/${jobId}`);
+      if (!response.ok) {
+        throw new Error('Failed to fetch job status');
+      }
+      const job = await response.json();
+      if (job.status === 'succeeded' || job.status === 'failed') {
+        return job;
+      }
+      await new Promise(resolve => setTimeout(resolve, intervalMs));
+    }
+    throw new Error('Timed out waiting for the device test to finish');
+  };
+
   const handleQuickAction = async (action, deviceData, deviceName) => {
     try {
       const deviceId = deviceData.device || deviceData.name || deviceData.id;
@@ -614,8 +630,12 @@ export default function AnalyticsDashboardScreen() {
               });
               
               if (response.ok) {
-                const testResult = await response.json();
-                if (testResult.status === 'passed') {
+                const { jobId } = await response.json();
+                const job = await pollDeviceJob(jobId);
+                const testResult = job.result || {};
+                if (!testResult.tests) {
+                  alert(`Device test failed for ${deviceName}: ${testResult.error || 'Unknown error'}`);
+                } else if (testResult.status === 'passed') {
                   alert(`Device test successful for ${deviceName}.\n\nResults:\n• Reachable: ${testResult.tests.reachable ? 'Yes' : 'No'}\n• Responsive: ${testResult.tests.responsive ? 'Yes' : 'No'}\n• State Valid: ${testResult.tests.state_valid ? 'Yes' : 'No'}\n• Current State: ${testResult.current_state}`);
                 } else {
                   alert(`Device test completed for ${deviceName}, but some issues detected.\n\nResults:\n• Reachable: ${testResult.tests.reachable ? 'Yes' : 'No'}\n• Responsive: ${testResult.tests.responsive ? 'Yes' : 'No'}\n• State Valid: ${testResult.tests.state_valid ? 'Yes' : 'No'}`);
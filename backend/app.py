@@ -1,6 +1,8 @@
 from flask import Flask, jsonify, request
 from flask_cors import CORS
-from flask_jwt_extended import JWTManager, jwt_required, get_jwt_identity
+from flask_jwt_extended import JWTManager, jwt_required, get_jwt_identity, decode_token
+from flask_jwt_extended.exceptions import JWTExtendedException
+from jwt import PyJWTError
 from datetime import datetime, timezone
 from config import JWT_SECRET_KEY
 from routes.device_routes import device_routes
@@ -10,12 +12,14 @@ from routes.home_assistant_routes import home_assistant_routes
 from routes.auth_routes import auth_routes
 from routes.ml_routes import ml_routes
 import db
-from scheduler import start_scheduler, schedule_automations
+from scheduler import start_scheduler
 from routes.analytics_routes import analytics_routes
+from routes.scene_routes import scene_routes
+from device_registry import device_registry
 
 app = Flask(__name__)
 app.url_map.strict_slashes = False
-CORS(app)
+CORS(app, expose_headers=["X-Devices-Version"])
 
 # Configure JWT
 app.config["JWT_SECRET_KEY"] = JWT_SECRET_KEY
@@ -40,6 +44,20 @@ def check_if_token_revoked(jwt_header, jwt_payload):
     # If token not in database or is revoked, consider it blocked
     return token is None or token.get('is_revoked', False)
 
+def decode_access_token(token):
+    """
+    Validate an access token with this app's JWT settings and return its
+    claims, or None. Used by the ASGI routes, which run outside Flask.
+    """
+    with app.app_context():
+        try:
+            claims = decode_token(token)
+        except (PyJWTError, JWTExtendedException):
+            return None
+    if claims.get('type') != 'access' or check_if_token_revoked(None, claims):
+        return None
+    return claims
+
 @app.route('/')
 def home():
     return jsonify({
@@ -56,13 +74,18 @@ def home():
                 "list": "/api/devices",
                 "toggle": "/api/devices/<id>/toggle",
                 "temperature": "/api/devices/<id>/temperature",
-                "toggle_all_lights": "/api/devices/toggle-all-lights"
+                "toggle_all_lights": "/api/devices/toggle-all-lights",
+                "commands": "/api/devices/commands"
             },
             "rooms": {
                 "list": "/api/rooms",
                 "devices_by_room": "/api/devices/by-room/<room_id>"
             },
             "automations": "/api/automations",
+            "scenes": {
+                "list": "/api/scenes",
+                "apply": "/api/scenes/<id>/apply"
+            },
             "home_assistant": "/api/home-assistant",
             "ml": {
                 "predict_device": "/api/ml/predict/device/<device_id>",
@@ -86,27 +109,21 @@ def test_auth():
 @app.route('/api/debug/devices')
 def debug_devices():
     try:
-        devices = list(db.devices_collection.find())
-        formatted_devices = []
-        for device in devices:
-            formatted_device = {
-                'id': str(device['_id']),
-                'name': device['name'],
-                'type': device['type'],
-                'isOn': device['isOn']
-            }
-            
-            if 'roomId' in device:
-                formatted_device['roomId'] = str(device['roomId'])
-            if 'temperature' in device:
-                formatted_device['temperature'] = device['temperature']
-            if 'isHomeAssistant' in device:
-                formatted_device['isHomeAssistant'] = device['isHomeAssistant']
-            if 'entityId' in device:
-                formatted_device['entityId'] = device['entityId']
-            formatted_devices.append(formatted_device)
-            
-        return jsonify(formatted_devices)
+        from routes.device_routes import get_device_listing, get_device_changes
+
+        since = request.args.get('since')
+        if since is not None:
+            try:
+                since = int(since)
+            except ValueError:
+                return jsonify({"error": "since must be an integer version"}), 400
+            return jsonify(get_device_changes(since))
+
+        formatted_devices, version = get_device_listing()
+
+        response = jsonify(formatted_devices)
+        response.headers['X-Devices-Version'] = str(version)
+        return response
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -114,30 +131,26 @@ def debug_devices():
 @app.route('/api/debug/devices/<device_id>/toggle', methods=['POST'])
 def debug_toggle_device(device_id):
     try:
-        from bson import ObjectId
         import requests
         from config import HOME_ASSISTANT_URL, HOME_ASSISTANT_TOKEN
         
         # Find device in database
-        device = db.devices_collection.find_one({"_id": ObjectId(device_id)})
+        device = device_registry.get(device_id)
         if not device:
             return jsonify({"error": "Device not found"}), 404
 
-        # Determine new state
-        new_state = not device.get('isOn', False)  # Toggle the state
-
         # Handle Home Assistant devices
         if device.get('isHomeAssistant'):
             print(f"📱 Device {device['name']} is a Home Assistant device with entity_id: {device.get('entityId')}")
             
-            # Toggle Home Assistant Device
+            # Toggle Home Assistant Device (its toggle service, since our cached state may be stale)
             ha_payload = {"entity_id": device["entityId"]}
             ha_headers = {
                 "Authorization": f"Bearer {HOME_ASSISTANT_TOKEN}",
                 "Content-Type": "application/json"
             }
-            ha_service = "turn_on" if new_state else "turn_off"
-            ha_url = f"{HOME_ASSISTANT_URL}/api/services/light/{ha_service}"
+            ha_service = "toggle"
+            ha_url = f"{HOME_ASSISTANT_URL}/api/services/{device['entityId'].split('.', 1)[0]}/{ha_service}"
             
             print(f"📡 Sending command to Home Assistant: {ha_service} for {device['entityId']}")
             
@@ -156,14 +169,17 @@ def debug_toggle_device(device_id):
             from routes.device_routes import get_homeassistant_state
             new_state = get_homeassistant_state(device["entityId"])
             print(f"🔄 Updated state from Home Assistant: {new_state}")
+            device = db.set_device_power(device_id, new_state)
         else:
-            print(f"🔹 Toggling local device {device['name']} to {'ON' if new_state else 'OFF'}")
+            # Flip in one atomic round trip so concurrent toggles cannot race
+            device = db.set_device_power(device_id)
+            if device:
+                print(f"🔹 Toggled local device {device['name']} to {'ON' if device['isOn'] else 'OFF'}")
 
-        # Update MongoDB state
-        db.devices_collection.update_one(
-            {"_id": ObjectId(device_id)},
-            {"$set": {"isOn": new_state}}
-        )
+        if not device:
+            return jsonify({"error": "Device not found"}), 404
+        device_registry.upsert(device)
+        new_state = device["isOn"]
 
         # Return full updated device object for frontend
         updated_device = {
@@ -197,7 +213,7 @@ def debug_toggle_all_lights():
         print(f"🔄 Toggling all lights to {desired_state}")
 
         # Fetch all light devices
-        lights = list(db.devices_collection.find({"type": "light"}))
+        lights = device_registry.by_type("light")
         updated_lights = []
 
         for device in lights:
@@ -232,8 +248,9 @@ def debug_toggle_all_lights():
             # Update MongoDB state
             db.devices_collection.update_one(
                 {"_id": ObjectId(device["_id"])},
-                {"$set": {"isOn": desired_state}}
+                db.device_update({"isOn": desired_state})
             )
+            device_registry.apply(device["_id"], {"isOn": desired_state})
 
             # Append updated device state
             updated_lights.append({
@@ -264,7 +281,7 @@ def debug_set_temperature(device_id):
         new_temp = data['temperature']
         print(f"🌡️ Setting temperature to {new_temp}°F for device {device_id}")
 
-        device = db.devices_collection.find_one({"_id": ObjectId(device_id)})
+        device = device_registry.get(device_id)
         if not device:
             return jsonify({"error": "Device not found"}), 404
         if device['type'] != 'thermostat':
@@ -295,10 +312,8 @@ def debug_set_temperature(device_id):
             print(f"🔹 Setting temperature for local thermostat {device['name']} to {new_temp}°F")
 
         # Update MongoDB state
-        db.devices_collection.update_one(
-            {"_id": ObjectId(device_id)},
-            {"$set": {"temperature": new_temp}}
-        )
+        db.devices_collection.update_one({"_id": ObjectId(device_id)}, db.device_update({"temperature": new_temp}))
+        device_registry.apply(device_id, {"temperature": new_temp})
         
         # Prepare response
         updated_device = {
@@ -349,16 +364,7 @@ app.register_blueprint(automation_routes, url_prefix='/api/automations')
 app.register_blueprint(home_assistant_routes, url_prefix='/api/home-assistant')
 app.register_blueprint(ml_routes, url_prefix='/api/ml')
 app.register_blueprint(analytics_routes, url_prefix='/api/analytics')
-
-
-# Refresh scheduled automations after any request
-@app.after_request
-def refresh_scheduler(response):
-    try:
-        schedule_automations()
-    except Exception as e:
-        print(f"Error refreshing scheduler: {e}")
-    return response
+app.register_blueprint(scene_routes, url_prefix='/api/scenes')
 
 # Initialize admin user if needed
 #@app.before_first_request
@@ -383,5 +389,4 @@ def initialize_admin():
 
 if __name__ == '__main__':
     start_scheduler()
-    schedule_automations()
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
@@ -0,0 +1,547 @@
+"""
+ASGI entry point for the TechHome backend.
+
+The device command and Home Assistant proxy endpoints run natively on
+asyncio using httpx.AsyncClient and PyMongo's AsyncMongoClient, so a request
+waiting on Home Assistant does not hold a worker thread. Toggle and temperature
+behave like the Flask routes (coalescing, optimistic mode); only the ML
+history write runs in a thread. Every other route is served by the Flask app
+mounted underneath.
+
+Run with:
+    uvicorn asgi:app --host 0.0.0.0 --port 5000
+"""
+import asyncio
+import contextlib
+import httpx
+from a2wsgi import WSGIMiddleware
+from bson import ObjectId
+from bson.errors import InvalidId
+from datetime import datetime, timezone
+from pymongo import UpdateOne, ReturnDocument
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse
+from starlette.routing import Mount, Route
+
+import db
+from app import app as flask_app, decode_access_token
+from coalescer import AsyncCommandCoalescer
+from config import HOME_ASSISTANT_URL, HOME_ASSISTANT_TOKEN, COMMAND_COALESCE_WINDOW, OPTIMISTIC_TOGGLES
+from device_registry import device_registry
+from models.device_log import build_log_entry, device_log_writer
+from routes.device_routes import get_reported_is_on
+from scheduler import start_scheduler
+
+try:
+    from ml_models import update_device_history
+except ImportError:
+    def update_device_history(device_id, state, user_id=None):
+        pass
+
+# Shared connection pool for all in-flight Home Assistant calls
+HA_MAX_CONNECTIONS = 100
+HA_TIMEOUT = 2
+
+ha_client = None
+
+# Merges rapid toggles / setpoint changes for the same device into one execution
+command_coalescer = AsyncCommandCoalescer(COMMAND_COALESCE_WINDOW)
+
+# Write-behind confirmations still running, awaited before shutdown
+background_tasks = set()
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    global ha_client
+    ha_client = httpx.AsyncClient(
+        base_url=HOME_ASSISTANT_URL or "",
+        headers={
+            "Authorization": f"Bearer {HOME_ASSISTANT_TOKEN}",
+            "Content-Type": "application/json"
+        },
+        timeout=HA_TIMEOUT,
+        limits=httpx.Limits(max_connections=HA_MAX_CONNECTIONS)
+    )
+    start_scheduler()
+    try:
+        yield
+    finally:
+        if background_tasks:
+            await asyncio.gather(*background_tasks, return_exceptions=True)
+        await ha_client.aclose()
+        await asyncio.to_thread(device_log_writer.close)
+        await db.close_async_database()
+
+
+# Authentication helpers (tokens are checked with the Flask app's JWT settings)
+def get_jwt_claims(request):
+    """Validate the bearer access token and return its claims, or None"""
+    auth_header = request.headers.get("Authorization", "")
+    if not auth_header.startswith("Bearer "):
+        return None
+    return decode_access_token(auth_header[len("Bearer "):])
+
+def jwt_required(endpoint):
+    async def wrapper(request):
+        claims = get_jwt_claims(request)
+        if claims is None or not claims.get("sub"):
+            return JSONResponse({"msg": "Missing or invalid access token"}, status_code=401)
+        request.state.jwt = claims
+        return await endpoint(request)
+    return wrapper
+
+async def get_user_identity(request):
+    claims = getattr(request.state, "jwt", None)
+    if not claims:
+        return "system"
+    if claims.get("username"):
+        return claims["username"]
+
+    # Older tokens without the claim fall back to the shared username cache
+    user_id = claims["sub"]
+    username = db.get_cached_username(user_id)
+    if username is not None:
+        return username
+    try:
+        user = await db.get_async_database()["users"].find_one(
+            {"_id": ObjectId(user_id)}, {"username": 1}
+        )
+    except Exception:
+        return "system"
+    if user and 'username' in user:
+        db.cache_username(user_id, user['username'])
+        return user['username']
+    return "unknown"
+
+async def safe_log_device_action(user, device, action, result, is_error=False, error_type=None):
+    try:
+        # Queued for the background batched writer, so no Mongo round trip here
+        device_log_writer.submit(build_log_entry(user, device, action, result, is_error, error_type))
+    except Exception as e:
+        print(f"[Logging Error] {e}")
+
+# Log an action once for every user whose commands were coalesced into it
+async def log_for_users(users, device, action, result, is_error=False, error_type=None):
+    for user in dict.fromkeys(users):
+        await safe_log_device_action(user, device, action, result, is_error, error_type)
+
+async def record_device_history(device_id, state, user_id):
+    """Record a device state change for the ML model off the event loop"""
+    try:
+        await asyncio.to_thread(update_device_history, str(device_id), state, user_id)
+    except Exception as e:
+        print(f"Warning: Failed to update device history for ML: {e}")
+
+# Call a Home Assistant service, returning (success, error message)
+async def send_homeassistant_command(domain, service, payload):
+    try:
+        response = await ha_client.post(f"/api/services/{domain}/{service}", json=payload)
+    except httpx.HTTPError as e:
+        return False, f"Home Assistant connection error {str(e)}"
+    if response.status_code != 200:
+        return False, f"Home Assistant error {response.text}"
+    return True, None
+
+def format_command_device(device_id, device):
+    return {
+        "id": device_id,
+        "name": device["name"],
+        "type": device["type"],
+        "roomId": str(device.get("roomId")) if device.get("roomId") else None,
+        "isOn": device.get("isOn", False),
+        "isHomeAssistant": device.get("isHomeAssistant", False),
+        "entityId": device.get("entityId", None),
+        "attributes": device.get("attributes", {})
+    }
+
+async def read_json(request):
+    try:
+        return await request.json()
+    except Exception:
+        return None
+
+
+# Device command endpoints
+# Apply the net result of one or more coalesced toggles (one per entry in
+# users), returning (body, status)
+async def apply_toggle(users, device_id, device_obj_id, user_id):
+    devices = db.get_async_database()["devices"]
+    device = await devices.find_one({"_id": device_obj_id})
+
+    if not device:
+        await log_for_users(
+            users, device_id, "toggle", "error: device not found",
+            is_error=True, error_type="device_not_found"
+        )
+        return {"error": "Device not found"}, 404
+
+    # An even number of coalesced toggles leaves the device as it is
+    changed = len(users) % 2 == 1
+
+    if changed and device.get('isHomeAssistant'):
+        entity_id = device["entityId"]
+        # Home Assistant flips the entity itself; our isOn may be stale
+        ha_response = await ha_client.post(
+            f"/api/services/{entity_id.split('.', 1)[0]}/toggle", json={"entity_id": entity_id}
+        )
+        if ha_response.status_code != 200:
+            await log_for_users(
+                users, entity_id, "toggle", f"error: Home Assistant error {ha_response.text}",
+                is_error=True, error_type="home_assistant_error"
+            )
+            return {"error": f"Home Assistant error: {ha_response.text}"}, ha_response.status_code
+        is_on = get_reported_is_on(ha_response, entity_id)
+    else:
+        is_on = None
+
+    if changed:
+        # Record the state Home Assistant reports, or flip ours atomically like it did
+        device = await devices.find_one_and_update(
+            {"_id": device_obj_id}, db.device_power_update(is_on), return_document=ReturnDocument.AFTER
+        )
+        if not device:
+            return {"error": "Device not found"}, 404
+        device_registry.upsert(device)
+        await record_device_history(device_obj_id, device.get("isOn", False), user_id)
+
+    new_state = device.get("isOn", False)
+    await log_for_users(
+        users,
+        device.get("entityId") if device.get("isHomeAssistant") else device_id,
+        "toggle",
+        "on" if new_state else "off"
+    )
+    return format_command_device(device_id, device), 200
+
+# Flip a device in Mongo right away and confirm with Home Assistant in the background
+async def apply_toggle_optimistic(user, device_id, device_obj_id, user_id):
+    database = db.get_async_database()
+    command_id = ObjectId()
+
+    # Atomic flip; Home Assistant devices are marked with the pending command
+    device = await database["devices"].find_one_and_update(
+        {"_id": device_obj_id},
+        [{"$set": {
+            "isOn": {"$not": [{"$ifNull": ["$isOn", False]}]},
+            "version": db.DEVICE_VERSION,
+            "pendingCommand": {"$cond": [{"$eq": ["$isHomeAssistant", True]}, command_id, "$$REMOVE"]}
+        }}],
+        return_document=ReturnDocument.AFTER
+    )
+
+    if not device:
+        await safe_log_device_action(
+            user, device_id, "toggle", "error: device not found",
+            is_error=True, error_type="device_not_found"
+        )
+        return {"error": "Device not found"}, 404
+
+    device_registry.upsert(device)
+    new_state = device["isOn"]
+    await record_device_history(device_obj_id, new_state, user_id)
+    updated_device = format_command_device(device_id, device)
+
+    # Local devices have nothing to confirm
+    if not device.get('isHomeAssistant'):
+        await safe_log_device_action(user, device_id, "toggle", "on" if new_state else "off")
+        return {"status": "confirmed", "device": updated_device}, 200
+
+    await database["device_commands"].insert_one({
+        "_id": command_id,
+        "device_id": device_obj_id,
+        "command": "toggle",
+        "desired_state": new_state,
+        "status": "pending",
+        "user": user,
+        "created_at": datetime.now(timezone.utc)
+    })
+    task = asyncio.create_task(confirm_optimistic_toggle(user, command_id, device, new_state))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+    return {"status": "pending", "commandId": str(command_id), "device": updated_device}, 202
+
+async def confirm_optimistic_toggle(user, command_id, device, new_state):
+    """Send a write-behind toggle to Home Assistant, then finalize or roll it back"""
+    database = db.get_async_database()
+    entity_id = device["entityId"]
+    try:
+        ha_service = "turn_on" if new_state else "turn_off"
+        ok, error = await send_homeassistant_command(entity_id.split('.', 1)[0], ha_service, {"entity_id": entity_id})
+
+        # Only touch the device if no later command has replaced ours
+        pending_filter = {"_id": device["_id"], "pendingCommand": command_id}
+        if ok:
+            result = await database["devices"].update_one(pending_filter, {"$unset": {"pendingCommand": ""}})
+            if result.modified_count:
+                device_registry.apply(device["_id"], {}, unset=("pendingCommand",))
+            status = "confirmed"
+            await safe_log_device_action(user, entity_id, "toggle", "on" if new_state else "off")
+        else:
+            rollback = await database["devices"].update_one(
+                pending_filter, db.device_update({"isOn": not new_state}, unset=("pendingCommand",))
+            )
+            if rollback.modified_count:
+                device_registry.apply(device["_id"], {"isOn": not new_state}, unset=("pendingCommand",))
+            status = "rolled_back"
+            await safe_log_device_action(
+                user, entity_id, "toggle", f"error: {error}",
+                is_error=True, error_type="home_assistant_error"
+            )
+    except Exception as e:
+        status, error = "failed", str(e)
+        print(f"[Write-behind Error] {e}")
+
+    await database["device_commands"].update_one(
+        {"_id": command_id},
+        {"$set": {"status": status, "error": error, "completed_at": datetime.now(timezone.utc)}}
+    )
+
+@jwt_required
+async def toggle_device(request):
+    user = await get_user_identity(request)
+    device_id = request.path_params["device_id"]
+    optimistic = request.query_params.get('optimistic', '').lower() in ('1', 'true')
+    user_id = request.headers.get('X-User-ID')
+
+    try:
+        device_obj_id = ObjectId(device_id)
+
+        # Opt-in write-behind mode answers before Home Assistant does
+        if OPTIMISTIC_TOGGLES or optimistic:
+            body, status = await apply_toggle_optimistic(user, device_id, device_obj_id, user_id)
+        else:
+            # Rapid toggles of the same device are merged into their net effect
+            body, status = await command_coalescer.submit(
+                (device_id, "toggle"),
+                [user],
+                lambda pending, new: pending + new,
+                lambda users: apply_toggle(users, device_id, device_obj_id, user_id)
+            )
+    except InvalidId:
+        await safe_log_device_action(user, device_id, "toggle", "error: invalid device id")
+        return JSONResponse({"error": "Invalid device ID format"}, status_code=400)
+    except Exception as e:
+        await safe_log_device_action(user, device_id, "toggle", f"error: {str(e)}")
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+    return JSONResponse(body, status_code=status)
+
+# Apply the final (coalesced) setpoint to a thermostat on behalf of every
+# user that sent one, returning (body, status)
+async def apply_temperature(users, device, device_id, temperature):
+    if device.get('isHomeAssistant') and device.get('entityId'):
+        ok, error = await send_homeassistant_command(
+            "climate", "set_temperature",
+            {"entity_id": device["entityId"], "temperature": float(temperature)}
+        )
+        if not ok:
+            await log_for_users(
+                users, device["entityId"], "set_temperature", f"error: {error}",
+                is_error=True, error_type="home_assistant_error"
+            )
+            return {"error": error}, 502
+
+    await db.get_async_database()["devices"].update_one(
+        {"_id": device["_id"]}, db.device_update({"temperature": temperature})
+    )
+    device_registry.apply(device["_id"], {"temperature": temperature})
+
+    await log_for_users(users, device_id, "set_temperature", str(temperature))
+    return {
+        "id": device_id,
+        "name": device["name"],
+        "type": device["type"],
+        "roomId": str(device.get("roomId")) if device.get("roomId") else None,
+        "temperature": temperature
+    }, 200
+
+@jwt_required
+async def set_temperature(request):
+    user = await get_user_identity(request)
+    device_id = request.path_params["device_id"]
+    data = await read_json(request)
+
+    try:
+        device_obj_id = ObjectId(device_id)
+        device = await db.get_async_database()["devices"].find_one({"_id": device_obj_id})
+
+        if not device:
+            await safe_log_device_action(user, device_id, "set_temperature", "error: device not found")
+            return JSONResponse({"error": "Device not found"}, status_code=404)
+
+        if device['type'] != 'thermostat':
+            await safe_log_device_action(user, device_id, "set_temperature", "error: not a thermostat")
+            return JSONResponse({"error": "Not a thermostat"}, status_code=400)
+
+        if not data or 'temperature' not in data:
+            await safe_log_device_action(user, device_id, "set_temperature", "error: temperature required")
+            return JSONResponse({"error": "Temperature required"}, status_code=400)
+
+        # Setpoints sent while a slider is dragged collapse to the last value
+        body, status = await command_coalescer.submit(
+            (device_id, "temperature"),
+            (data['temperature'], [user]),
+            lambda pending, new: (new[0], pending[1] + new[1]),
+            lambda intent: apply_temperature(intent[1], device, device_id, intent[0])
+        )
+    except InvalidId:
+        await safe_log_device_action(user, device_id, "set_temperature", "error: invalid device id")
+        return JSONResponse({"error": "Invalid device ID format"}, status_code=400)
+    except Exception as e:
+        await safe_log_device_action(user, device_id, "set_temperature", f"error: {str(e)}")
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+    return JSONResponse(body, status_code=status)
+
+@jwt_required
+async def toggle_all_lights(request):
+    user = await get_user_identity(request)
+    database = db.get_async_database()
+
+    try:
+        data = await read_json(request)
+        if not data or 'desiredState' not in data:
+            return JSONResponse({"error": "Desired state required"}, status_code=400)
+
+        desired_state = data['desiredState']  # True = ON, False = OFF
+        ha_service = "turn_on" if desired_state else "turn_off"
+
+        lights = await database["devices"].find({"type": "light"}).to_list(None)
+
+        # Send all Home Assistant commands concurrently
+        ha_lights = [device for device in lights if device.get('isHomeAssistant')]
+        ha_responses = await asyncio.gather(
+            *(ha_client.post(f"/api/services/light/{ha_service}", json={"entity_id": device["entityId"]})
+              for device in ha_lights),
+            return_exceptions=True
+        )
+        failed_ids = set()
+        for device, ha_response in zip(ha_lights, ha_responses):
+            if isinstance(ha_response, Exception):
+                print(f"WARNING: Failed to toggle {device['entityId']}. Error: {ha_response}")
+                failed_ids.add(device["_id"])
+            elif ha_response.status_code == 401:
+                print(f"ERROR: Unauthorized Home Assistant token for {device['entityId']}")
+                failed_ids.add(device["_id"])
+            elif ha_response.status_code != 200:
+                print(f"WARNING: Failed to toggle {device['entityId']}. Response: {ha_response.text}")
+                failed_ids.add(device["_id"])
+
+        updated = [device for device in lights if device["_id"] not in failed_ids]
+        if updated:
+            await database["devices"].bulk_write(
+                [UpdateOne({"_id": device["_id"]}, db.device_update({"isOn": desired_state})) for device in updated],
+                ordered=False
+            )
+            for device in updated:
+                device_registry.apply(device["_id"], {"isOn": desired_state})
+            try:
+                device_log_writer.submit_many([
+                    build_log_entry(
+                        user,
+                        device.get("entityId") if device.get("isHomeAssistant") else str(device["_id"]),
+                        "toggle_all",
+                        "on" if desired_state else "off"
+                    )
+                    for device in updated
+                ])
+            except Exception as e:
+                print(f"[Logging Error] {e}")
+
+            # Record device state changes for the ML model off the event loop
+            user_id = request.headers.get('X-User-ID')
+            def record_history():
+                for device in updated:
+                    try:
+                        update_device_history(str(device["_id"]), desired_state, user_id)
+                    except Exception as e:
+                        print(f"Warning: Failed to update device history for ML: {e}")
+            await asyncio.to_thread(record_history)
+
+        return JSONResponse([
+            {
+                "id": str(device["_id"]),
+                "name": device["name"],
+                "type": device["type"],
+                "isOn": desired_state
+            }
+            for device in updated
+        ])
+
+    except Exception as e:
+        await safe_log_device_action(user, "all_lights", "toggle_all", f"error: {str(e)}")
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+# Home Assistant proxy endpoints
+@jwt_required
+async def get_home_assistant_states(request):
+    try:
+        response = await ha_client.get("/api/states", timeout=1.5)
+        response.raise_for_status()
+        return JSONResponse(response.json())
+    except httpx.HTTPError as e:
+        print(f"Error: {str(e)}")
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+@jwt_required
+async def toggle_ha_device(request):
+    entity_id = request.path_params["entity_id"]
+    devices = db.get_async_database()["devices"]
+
+    try:
+        device = await devices.find_one({"entityId": entity_id, "isHomeAssistant": True})
+
+        # If we have the device in our database, use its state, otherwise query HA
+        if device:
+            new_state = not device.get('isOn', False)
+        else:
+            response = await ha_client.get(f"/api/states/{entity_id}", timeout=1)
+            if response.status_code != 200:
+                return JSONResponse({"error": f"Failed to get state for {entity_id}"}, status_code=response.status_code)
+            new_state = response.json().get("state") != "on"
+
+        ha_service = "turn_on" if new_state else "turn_off"
+        ha_response = await ha_client.post(f"/api/services/light/{ha_service}", json={"entity_id": entity_id}, timeout=1)
+
+        if ha_response.status_code == 401:
+            return JSONResponse({"error": "Unauthorized - Invalid Home Assistant token"}, status_code=401)
+
+        if ha_response.status_code != 200:
+            print(f"WARNING: Failed to toggle {entity_id}. Response: {ha_response.text}")
+            return JSONResponse({"error": "Failed to toggle Home Assistant device"}, status_code=ha_response.status_code)
+
+        if device:
+            await devices.update_one({"_id": device["_id"]}, db.device_update({"isOn": new_state}))
+            device_registry.apply(device["_id"], {"isOn": new_state})
+
+        return JSONResponse({
+            "success": True,
+            "entity_id": entity_id,
+            "new_state": "on" if new_state else "off"
+        })
+
+    except Exception as e:
+        print(f"Error toggling device: {str(e)}")
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+routes = [
+    Route('/api/devices/toggle-all-lights', toggle_all_lights, methods=['POST']),
+    Route('/api/devices/{device_id}/toggle', toggle_device, methods=['POST']),
+    Route('/api/devices/{device_id}/temperature', set_temperature, methods=['POST']),
+    Route('/api/home-assistant/states', get_home_assistant_states, methods=['GET']),
+    Route('/api/home-assistant/toggle/{entity_id}', toggle_ha_device, methods=['POST']),
+    # Everything else is handled by the Flask app
+    Mount('/', app=WSGIMiddleware(flask_app)),
+]
+
+app = Starlette(
+    routes=routes,
+    middleware=[Middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"], expose_headers=["X-Devices-Version"])],
+    lifespan=lifespan
+)
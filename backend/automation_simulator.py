@@ -0,0 +1,171 @@
+import math
+import time
+from datetime import datetime, timedelta
+from bson import ObjectId
+from bson.errors import InvalidId
+from automation_triggers import parse_state_trigger
+from config import AUTOMATION_BATCH_CHUNK_SIZE, AUTOMATION_BATCH_MAX_WORKERS
+from device_registry import device_registry
+from scheduler import get_automation_time
+
+# Longest window a simulation may cover
+SIMULATION_MAX_DAYS = 366
+
+def _action_target(automation):
+    """(device id string, command) of an automation's action, or None"""
+    action = automation.get('action') or {}
+    device_id = action.get('deviceId')
+    command = str(action.get('command', 'toggle')).lower()
+    if not device_id or command not in ('turn_on', 'turn_off', 'toggle'):
+        return None
+    try:
+        return str(ObjectId(device_id)), command
+    except (InvalidId, TypeError):
+        return None
+
+def _fire_days(minute_of_day, start, end):
+    """How many times a daily HH:MM fires in [start, end)"""
+    first_day = start.replace(hour=0, minute=0, second=0, microsecond=0)
+    first = first_day + timedelta(minutes=minute_of_day)
+    if first < start:
+        first += timedelta(days=1)
+    if first >= end:
+        return 0
+    return (end - first - timedelta(microseconds=1)).days + 1
+
+def _slot_calls(members, devices):
+    """
+    Home Assistant calls one batch would make: one per (domain, service)
+    chunk, see execute_automation_batch. Toggles count as their own service
+    since their direction depends on the device state at that moment.
+    """
+    groups = {}
+    for _, (device_id, command) in members:
+        device = devices.get(device_id)
+        if not device or not device.get('isHomeAssistant') or not device.get('entityId'):
+            continue
+        domain = device['entityId'].split('.', 1)[0]
+        groups.setdefault((domain, command), set()).add(device_id)
+    return sum(math.ceil(len(ids) / AUTOMATION_BATCH_CHUNK_SIZE) for ids in groups.values())
+
+def simulate_automations(automations, start, end, top=20):
+    """
+    Dry-run automations over [start, end) without touching devices.
+    Time automations fire daily, so the work is grouped by minute of day:
+    cost is O(automations + days) rather than O(automations x minutes).
+    State-triggered automations cannot be timed without device events; they
+    are reported with the cascades where one automation's action can trigger
+    another.
+    """
+    started = time.perf_counter()
+    slots = {}          # minute of day -> [(automation, (device id, command))]
+    state_rules = []
+    invalid = []
+    for automation in automations:
+        if not automation.get('enabled', True):
+            continue
+        trigger, error = parse_state_trigger(automation)
+        target = _action_target(automation)
+        if error or target is None:
+            invalid.append({"id": str(automation.get('_id')), "name": automation.get('name'),
+                            "error": error or "Invalid action"})
+            continue
+        if trigger:
+            state_rules.append((automation, trigger, target))
+            continue
+        scheduled_time = get_automation_time(automation)
+        if scheduled_time is None:
+            invalid.append({"id": str(automation.get('_id')), "name": automation.get('name'),
+                            "error": "No trigger time"})
+            continue
+        hour, minute = scheduled_time
+        slots.setdefault(hour * 60 + minute, []).append((automation, target))
+
+    device_ids = {target[0] for members in slots.values() for _, target in members}
+    device_ids |= {target[0] for _, _, target in state_rules}
+    devices = {str(device_id): device for device_id, device in device_registry.get_many(device_ids).items()}
+
+    minutes = []
+    conflicts = []
+    total_fires = total_calls = 0
+    for minute_of_day in sorted(slots):
+        members = slots[minute_of_day]
+        days = _fire_days(minute_of_day, start, end)
+        if not days:
+            continue
+        label = f"{minute_of_day // 60:02d}:{minute_of_day % 60:02d}"
+        calls = _slot_calls(members, devices)
+        total_fires += len(members) * days
+        total_calls += calls * days
+        minutes.append({"time": label, "fires": len(members), "home_assistant_calls": calls, "days": days})
+
+        by_device = {}
+        for automation, (device_id, command) in members:
+            by_device.setdefault(device_id, []).append(
+                {"id": str(automation.get('_id')), "name": automation.get('name'), "command": command})
+        for device_id, actions in by_device.items():
+            commands = {action["command"] for action in actions}
+            # Opposite commands, a toggle racing another command, or toggles cancelling out
+            if len(actions) > 1 and (len(commands) > 1 or commands == {"toggle"}):
+                conflicts.append({"time": label, "deviceId": device_id,
+                                  "deviceFound": device_id in devices, "actions": actions})
+
+    # Cascades: an action that changes a device some state trigger watches
+    watchers = {}
+    for automation, trigger, _ in state_rules:
+        if trigger["attribute"] == "isOn":
+            watchers.setdefault(trigger["deviceId"], []).append(automation)
+    cascades = []
+    for members in [[(a, t) for a, _, t in state_rules]] + list(slots.values()):
+        for automation, (device_id, _) in members:
+            for watcher in watchers.get(device_id, []):
+                cascades.append({"from": {"id": str(automation.get('_id')), "name": automation.get('name')},
+                                 "to": {"id": str(watcher.get('_id')), "name": watcher.get('name')},
+                                 "deviceId": device_id})
+
+    busiest = sorted(minutes, key=lambda m: (-m["fires"], m["time"]))
+    peak = busiest[0] if busiest else None
+    window_minutes = max((end - start).total_seconds() / 60, 1)
+    return {
+        "window": {"start": start.isoformat(), "end": end.isoformat()},
+        "automations": {
+            "time": sum(len(members) for members in slots.values()),
+            "state": len(state_rules),
+            "invalid": invalid
+        },
+        "total_fires": total_fires,
+        "total_home_assistant_calls": total_calls,
+        "active_minutes_per_day": len(minutes),
+        "avg_fires_per_active_minute": round(
+            sum(m["fires"] for m in minutes) / len(minutes), 2) if minutes else 0,
+        "avg_home_assistant_calls_per_minute": round(total_calls / window_minutes, 4),
+        "peak": {
+            "time": peak["time"] if peak else None,
+            "fires": peak["fires"] if peak else 0,
+            "home_assistant_calls": peak["home_assistant_calls"] if peak else 0,
+            # Calls of one batch run concurrently up to the batch worker limit
+            "concurrent_home_assistant_calls": min(peak["home_assistant_calls"], AUTOMATION_BATCH_MAX_WORKERS) if peak else 0
+        },
+        "busiest_minutes": busiest[:top],
+        "conflicts": conflicts,
+        "cascades": cascades,
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 2)
+    }
+
+def parse_simulation_window(data, now=None):
+    """Return (start, end, error) from {"start": iso, "end": iso} or {"days": n}"""
+    now = now or datetime.now()
+    try:
+        start = datetime.fromisoformat(data['start']) if data.get('start') else now
+        if data.get('end'):
+            end = datetime.fromisoformat(data['end'])
+        else:
+            end = start + timedelta(days=float(data.get('days', 1)))
+    except (TypeError, ValueError):
+        return None, None, "Invalid start, end or days"
+    start, end = start.replace(tzinfo=None), end.replace(tzinfo=None)
+    if end <= start:
+        return None, None, "end must be after start"
+    if end - start > timedelta(days=SIMULATION_MAX_DAYS):
+        return None, None, f"Window can cover at most {SIMULATION_MAX_DAYS} days"
+    return start, end, None
@@ -0,0 +1,160 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from bson import ObjectId
+from bson.errors import InvalidId
+from config import AUTOMATION_TRIGGER_MAX_WORKERS, AUTOMATION_TRIGGER_COOLDOWN
+
+# Automations of this type fire on device state changes instead of a time:
+# {"type": "state", "condition": {"deviceId": "...", "attribute": "isOn",
+#  "operator": "eq", "value": true}, "action": {...}}
+STATE_TRIGGER_TYPE = "state"
+
+# Device attributes a state trigger can watch
+TRIGGER_ATTRIBUTES = ("isOn", "temperature")
+
+TRIGGER_OPERATORS = {
+    "eq": lambda value, target: value == target,
+    "ne": lambda value, target: value != target,
+    "gt": lambda value, target: value is not None and value > target,
+    "gte": lambda value, target: value is not None and value >= target,
+    "lt": lambda value, target: value is not None and value < target,
+    "lte": lambda value, target: value is not None and value <= target,
+    "changed": None  # any change of the attribute
+}
+
+def parse_state_trigger(automation):
+    """
+    Validate the condition of a state automation, returning (trigger, error).
+    Returns (None, None) for automations that are not state triggered.
+    """
+    if not automation or automation.get("type") != STATE_TRIGGER_TYPE:
+        return None, None
+
+    condition = automation.get("condition")
+    if not isinstance(condition, dict) or not condition.get("deviceId"):
+        return None, "State trigger needs a deviceId"
+    try:
+        device_id = str(ObjectId(condition["deviceId"]))
+    except (InvalidId, TypeError):
+        return None, "Invalid deviceId format"
+
+    attribute = condition.get("attribute", "isOn")
+    if attribute not in TRIGGER_ATTRIBUTES:
+        return None, f"Unsupported trigger attribute: {attribute}"
+
+    operator = condition.get("operator", "eq")
+    if operator not in TRIGGER_OPERATORS:
+        return None, f"Unsupported trigger operator: {operator}"
+    if operator != "changed" and "value" not in condition:
+        return None, "State trigger needs a value"
+    if operator in ("gt", "gte", "lt", "lte") and (
+            isinstance(condition["value"], bool) or not isinstance(condition["value"], (int, float))):
+        return None, "Trigger value must be a number"
+
+    return {
+        "deviceId": device_id,
+        "attribute": attribute,
+        "operator": operator,
+        "value": condition.get("value")
+    }, None
+
+def trigger_matches(trigger, old_value, new_value):
+    """
+    Edge triggered: fire when the condition becomes true, so "temperature > 20"
+    fires once when crossing 20 and not again on every update above it.
+    """
+    if old_value == new_value:
+        return False
+    if trigger["operator"] == "changed":
+        return True
+    check = TRIGGER_OPERATORS[trigger["operator"]]
+    try:
+        return check(new_value, trigger["value"]) and not check(old_value, trigger["value"])
+    except TypeError:
+        return False
+
+
+class TriggerIndex:
+    """
+    State-triggered automations indexed by (device id, attribute), so a device
+    change only checks the rules watching that device and attribute.
+    Matching automations run on a small thread pool, off the request thread.
+    """
+
+    def __init__(self, execute):
+        self._execute = execute
+        self._lock = threading.RLock()
+        self._index = {}     # (device id, attribute) -> {automation id: (automation, trigger)}
+        self._keys = {}      # automation id -> (device id, attribute)
+        self._last_fired = {}
+        self._executor = ThreadPoolExecutor(
+            max_workers=AUTOMATION_TRIGGER_MAX_WORKERS, thread_name_prefix="automation-trigger"
+        )
+        self.stats_counters = {"evaluations": 0, "rules_checked": 0, "fired": 0, "suppressed": 0}
+
+    def add(self, automation_id, automation, trigger):
+        key = (trigger["deviceId"], trigger["attribute"])
+        with self._lock:
+            self.remove(automation_id)
+            self._index.setdefault(key, {})[automation_id] = (automation, trigger)
+            self._keys[automation_id] = key
+
+    def remove(self, automation_id):
+        with self._lock:
+            key = self._keys.pop(automation_id, None)
+            if key is None:
+                return False
+            rules = self._index.get(key, {})
+            rules.pop(automation_id, None)
+            if not rules:
+                self._index.pop(key, None)
+            self._last_fired.pop(automation_id, None)
+            return True
+
+    def get(self, automation_id):
+        with self._lock:
+            key = self._keys.get(automation_id)
+            return self._index[key][automation_id][0] if key else None
+
+    def ids(self):
+        with self._lock:
+            return list(self._keys)
+
+    def matching(self, device_id, changes):
+        """Automations whose trigger fires for these changes: {attribute: (old, new)}"""
+        device_id = str(device_id)
+        fired = []
+        now = time.monotonic()
+        with self._lock:
+            self.stats_counters["evaluations"] += 1
+            for attribute, (old_value, new_value) in changes.items():
+                rules = self._index.get((device_id, attribute))
+                if not rules:
+                    continue
+                for automation_id, (automation, trigger) in rules.items():
+                    self.stats_counters["rules_checked"] += 1
+                    if not trigger_matches(trigger, old_value, new_value):
+                        continue
+                    # Guard against automations re-triggering each other in a loop
+                    last = self._last_fired.get(automation_id)
+                    if last is not None and now - last < AUTOMATION_TRIGGER_COOLDOWN:
+                        self.stats_counters["suppressed"] += 1
+                        continue
+                    self._last_fired[automation_id] = now
+                    fired.append(automation)
+            self.stats_counters["fired"] += len(fired)
+        return fired
+
+    def evaluate(self, device, changes):
+        """Device change listener: run every automation triggered by the change"""
+        for automation in self.matching(device["_id"], changes):
+            self._executor.submit(self._execute, automation)
+
+    def stats(self):
+        with self._lock:
+            return {
+                **self.stats_counters,
+                "rules": len(self._keys),
+                "watched_keys": len(self._index)
+            }
@@ -0,0 +1,186 @@
+import asyncio
+import threading
+import time
+
+class _Batch:
+    def __init__(self, intent):
+        self.intent = intent
+        self.count = 1
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class _KeyState:
+    """A key with an execution in flight, and the batch of commands waiting for it"""
+    def __init__(self):
+        self.started = time.monotonic()
+        self.finished = threading.Event()
+        self.pending = None
+
+
+class CommandCoalescer:
+    """
+    Coalesces rapid commands for the same key (e.g. a device) into one execution.
+
+    A command for an idle key runs at once. Commands arriving while it runs
+    are merged with `merge(old_intent, new_intent)` into one trailing batch,
+    which runs when that execution has finished and at least `window`
+    seconds after it started, and every merged request receives its result.
+    A lone command never waits, repeats cost one execution with their net
+    effect, and executions for the same key never overlap.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self._lock = threading.Lock()
+        self._keys = {}  # key -> _KeyState of the execution in flight
+        self.executed = 0
+        self.coalesced = 0
+
+    def submit(self, key, intent, merge, execute):
+        if self.window <= 0:
+            return execute(intent)
+
+        with self._lock:
+            state = self._keys.get(key)
+            if state is None:
+                state = self._keys[key] = _KeyState()
+                batch = None
+            elif state.pending is not None:
+                batch = state.pending
+                batch.intent = merge(batch.intent, intent)
+                batch.count += 1
+                self.coalesced += 1
+                joined = True
+            else:
+                batch = state.pending = _Batch(intent)
+                joined = False
+
+        if batch is None:
+            # Idle key: run right away
+            try:
+                return execute(intent)
+            finally:
+                self._finish(key, state)
+
+        if joined:
+            batch.done.wait()
+            if batch.error is not None:
+                raise batch.error
+            return batch.result
+
+        # Opened the trailing batch: collect followers until the execution in
+        # flight is done and the window since it started has passed
+        state.finished.wait()
+        delay = state.started + self.window - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        with self._lock:
+            next_state = self._keys[key] = _KeyState()
+        try:
+            batch.result = execute(batch.intent)
+            return batch.result
+        except Exception as e:
+            batch.error = e
+            raise
+        finally:
+            self._finish(key, next_state)
+            batch.done.set()
+
+    def _finish(self, key, state):
+        """End an execution: hand the key to its trailing batch, or drop it"""
+        with self._lock:
+            self.executed += 1
+            if state.pending is None:
+                if self._keys.get(key) is state:
+                    del self._keys[key]
+            else:
+                state.finished.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "window_seconds": self.window,
+                "executed": self.executed,
+                "coalesced": self.coalesced,
+                "pending": sum(1 for state in self._keys.values() if state.pending is not None),
+                "active_keys": len(self._keys)
+            }
+
+
+class _AsyncKeyState:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.finished = asyncio.Event()
+        self.pending = None  # (intent, task) of the trailing batch
+
+
+class AsyncCommandCoalescer:
+    """
+    asyncio counterpart of CommandCoalescer, with the same leading execution
+    and trailing batch; `execute` is a coroutine function. Everything runs on
+    one event loop, so key state needs no lock. The trailing batch runs as its
+    own task that every merged request awaits, so a request that goes away
+    does not strand the others.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self._keys = {}  # key -> _AsyncKeyState of the execution in flight
+        self.executed = 0
+        self.coalesced = 0
+
+    async def submit(self, key, intent, merge, execute):
+        if self.window <= 0:
+            return await execute(intent)
+
+        state = self._keys.get(key)
+        if state is None:
+            # Idle key: run right away
+            state = self._keys[key] = _AsyncKeyState()
+            try:
+                return await execute(intent)
+            finally:
+                self._finish(key, state)
+
+        if state.pending is not None:
+            pending_intent, task = state.pending
+            state.pending = (merge(pending_intent, intent), task)
+            self.coalesced += 1
+        else:
+            task = asyncio.ensure_future(self._run_trailing(key, state, execute))
+            state.pending = (intent, task)
+        return await asyncio.shield(task)
+
+    async def _run_trailing(self, key, state, execute):
+        # Collect followers until the execution in flight is done and the
+        # window since it started has passed
+        await state.finished.wait()
+        delay = state.started + self.window - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        intent, _ = state.pending
+        next_state = self._keys[key] = _AsyncKeyState()
+        try:
+            return await execute(intent)
+        finally:
+            self._finish(key, next_state)
+
+    def _finish(self, key, state):
+        """End an execution: hand the key to its trailing batch, or drop it"""
+        self.executed += 1
+        if state.pending is None:
+            if self._keys.get(key) is state:
+                del self._keys[key]
+        else:
+            state.finished.set()
+
+    def stats(self):
+        return {
+            "window_seconds": self.window,
+            "executed": self.executed,
+            "coalesced": self.coalesced,
+            "pending": sum(1 for state in self._keys.values() if state.pending is not None),
+            "active_keys": len(self._keys)
+        }
@@ -22,4 +22,88 @@ PASSWORD_SALT = os.getenv('PASSWORD_SALT', 'techhome_salt')  # Used for password
 # Admin user setup
 ADMIN_USERNAME = os.getenv('ADMIN_USERNAME', 'admin')
 ADMIN_EMAIL = os.getenv('ADMIN_EMAIL', 'admin@techhome.local')
-ADMIN_PASSWORD = os.getenv('ADMIN_PASSWORD', 'admin123')  # Change in production!
\ No newline at end of file
+ADMIN_PASSWORD = os.getenv('ADMIN_PASSWORD', 'admin123')  # Change in production!
+
+# Device change versions are the server clock (ms) of each write. A write can
+# take up to this many seconds from stamping its version to becoming visible,
+# so versions handed out for delta sync stay this far behind the clock
+DEVICE_VERSION_SETTLE_SECONDS = float(os.getenv('DEVICE_VERSION_SETTLE_SECONDS', '5'))
+
+# Device command coalescing: a command for an idle device runs at once, and
+# repeats arriving while it runs are merged into one follow-up execution that
+# starts no sooner than this many seconds after it (0 disables coalescing)
+COMMAND_COALESCE_WINDOW = float(os.getenv('COMMAND_COALESCE_WINDOW', '0.3'))
+
+# Optimistic write-behind toggles: respond before Home Assistant confirms.
+# Can also be requested per call with ?optimistic=true
+OPTIMISTIC_TOGGLES = os.getenv('OPTIMISTIC_TOGGLES', 'false').lower() == 'true'
+WRITE_BEHIND_MAX_WORKERS = int(os.getenv('WRITE_BEHIND_MAX_WORKERS', '8'))
+
+# Background diagnostics (device reset / connectivity test jobs)
+DIAGNOSTIC_JOB_MAX_WORKERS = int(os.getenv('DIAGNOSTIC_JOB_MAX_WORKERS', '4'))
+# Jobs queued or running at once before new ones are refused with 503
+DIAGNOSTIC_JOB_QUEUE_LIMIT = int(os.getenv('DIAGNOSTIC_JOB_QUEUE_LIMIT', '32'))
+
+# Buffered device log writer: entries are queued and written with insert_many
+DEVICE_LOG_QUEUE_SIZE = int(os.getenv('DEVICE_LOG_QUEUE_SIZE', '10000'))
+DEVICE_LOG_BATCH_SIZE = int(os.getenv('DEVICE_LOG_BATCH_SIZE', '200'))
+DEVICE_LOG_FLUSH_INTERVAL = float(os.getenv('DEVICE_LOG_FLUSH_INTERVAL', '0.5'))
+# Device log layout written by the log writer: 2 = compact enum-coded, 1 = original
+DEVICE_LOG_SCHEMA_VERSION = int(os.getenv('DEVICE_LOG_SCHEMA_VERSION', '2'))
+# Identical errors (user, device, action, error_type) within this many seconds
+# are stored as one log document with a count (0 disables deduplication)
+DEVICE_LOG_ERROR_DEDUP_WINDOW = float(os.getenv('DEVICE_LOG_ERROR_DEDUP_WINDOW', '60'))
+
+# Scheduler: keep automation jobs in MongoDB across restarts
+SCHEDULER_PERSISTENT_JOBS = os.getenv('SCHEDULER_PERSISTENT_JOBS', 'true').lower() == 'true'
+# Seconds a missed fire (e.g. during downtime) may still run late
+SCHEDULER_MISFIRE_GRACE_TIME = int(os.getenv('SCHEDULER_MISFIRE_GRACE_TIME', '300'))
+# Run several missed fires of the same job only once
+SCHEDULER_COALESCE = os.getenv('SCHEDULER_COALESCE', 'true').lower() == 'true'
+
+# State-triggered automations: worker threads and minimum seconds between
+# two fires of the same automation (stops automations triggering each other in a loop)
+AUTOMATION_TRIGGER_MAX_WORKERS = int(os.getenv('AUTOMATION_TRIGGER_MAX_WORKERS', '4'))
+AUTOMATION_TRIGGER_COOLDOWN = float(os.getenv('AUTOMATION_TRIGGER_COOLDOWN', '1'))
+
+# Automations firing in the same minute run as one batch: Home Assistant
+# entities per service call, concurrent calls, and seconds over which the
+# calls of a large batch are spread (0 sends them all at once)
+AUTOMATION_BATCH_CHUNK_SIZE = int(os.getenv('AUTOMATION_BATCH_CHUNK_SIZE', '50'))
+AUTOMATION_BATCH_MAX_WORKERS = int(os.getenv('AUTOMATION_BATCH_MAX_WORKERS', '4'))
+AUTOMATION_BATCH_JITTER = float(os.getenv('AUTOMATION_BATCH_JITTER', '0'))
+
+# Only the process holding the scheduler lease runs automations, so several
+# workers (e.g. gunicorn) can share one persistent job store. The lease lasts
+# SCHEDULER_LEASE_TTL seconds and is renewed every SCHEDULER_LEASE_RENEW_INTERVAL.
+SCHEDULER_LEADER_ELECTION = os.getenv('SCHEDULER_LEADER_ELECTION', 'true').lower() == 'true'
+SCHEDULER_LEASE_TTL = int(os.getenv('SCHEDULER_LEASE_TTL', '30'))
+SCHEDULER_LEASE_RENEW_INTERVAL = int(os.getenv('SCHEDULER_LEASE_RENEW_INTERVAL', '10'))
+
+# Automation execution: worker threads for automation jobs, concurrent runs of
+# one job (further fires are skipped and recorded), Home Assistant timeout
+AUTOMATION_EXECUTOR_WORKERS = int(os.getenv('AUTOMATION_EXECUTOR_WORKERS', '8'))
+AUTOMATION_MAX_INSTANCES = int(os.getenv('AUTOMATION_MAX_INSTANCES', '1'))
+AUTOMATION_HA_TIMEOUT = float(os.getenv('AUTOMATION_HA_TIMEOUT', '5'))
+# Buffered writer for the automation execution history
+AUTOMATION_HISTORY_QUEUE_SIZE = int(os.getenv('AUTOMATION_HISTORY_QUEUE_SIZE', '5000'))
+AUTOMATION_HISTORY_BATCH_SIZE = int(os.getenv('AUTOMATION_HISTORY_BATCH_SIZE', '200'))
+AUTOMATION_HISTORY_FLUSH_INTERVAL = float(os.getenv('AUTOMATION_HISTORY_FLUSH_INTERVAL', '1'))
+
+# Usage predictions: "online" (incremental counts, updated on every state
+# change) or "forest" (per-device RandomForest, retrained in batch)
+ML_MODEL_MODE = os.getenv('ML_MODEL_MODE', 'online').lower()
+# Pseudo-count pulling sparse hour/weekday cells towards broader usage rates
+ML_ONLINE_SMOOTHING = float(os.getenv('ML_ONLINE_SMOOTHING', '2'))
+# Seconds a process reuses a device's counts before reloading (other workers' updates)
+ML_ONLINE_CACHE_SECONDS = float(os.getenv('ML_ONLINE_CACHE_SECONDS', '60'))
+# Hours between batch retrains of the forest models (0 disables them)
+ML_FOREST_RETRAIN_HOURS = float(os.getenv('ML_FOREST_RETRAIN_HOURS', '0'))
+
+# Background forest training: worker threads, and when a device with new
+# state changes is retrained (quiet for N seconds, N new events, or waiting
+# at most N seconds)
+ML_TRAIN_WORKERS = int(os.getenv('ML_TRAIN_WORKERS', '2'))
+ML_TRAIN_QUIET_SECONDS = float(os.getenv('ML_TRAIN_QUIET_SECONDS', '30'))
+ML_TRAIN_EVENT_THRESHOLD = int(os.getenv('ML_TRAIN_EVENT_THRESHOLD', '20'))
+ML_TRAIN_MAX_DELAY_SECONDS = float(os.getenv('ML_TRAIN_MAX_DELAY_SECONDS', '600'))
@@ -1,13 +1,20 @@
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument
 from pymongo.errors import ServerSelectionTimeoutError
-from config import MONGO_URI, DATABASE_NAME
+from config import MONGO_URI, DATABASE_NAME, DEVICE_VERSION_SETTLE_SECONDS
 from datetime import datetime, timezone
+from collections import OrderedDict
+import threading
+import time
 
 # Add local MongoDB URI
 LOCAL_URI = 'mongodb://localhost:27017'
 
+# URI of the server we actually connected to, reused by the async client
+ACTIVE_URI = MONGO_URI
+
 def get_database_connection():
     """Try Atlas first, fall back to local if needed"""
+    global ACTIVE_URI
     try:
         # Try to connect to Atlas with a short timeout
         atlas_client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=5000)
@@ -19,6 +26,7 @@ def get_database_connection():
         print("Could not connect to MongoDB Atlas, falling back to local MongoDB")
         # Try local connection
         local_client = MongoClient(LOCAL_URI)
+        ACTIVE_URI = LOCAL_URI
         print("Connected to local MongoDB")
         return local_client[DATABASE_NAME]
 
@@ -34,6 +42,14 @@ refresh_tokens_collection = db['refresh_tokens']
 device_history_collection = db['device_history']
 prediction_feedback_collection = db['prediction_feedback']
 device_logs = db['device_logs']
+counters_collection = db['counters']
+device_tombstones_collection = db['device_tombstones']
+device_commands_collection = db['device_commands']
+device_jobs_collection = db['device_jobs']
+scenes_collection = db['scenes']
+scheduler_leases_collection = db['scheduler_leases']
+automation_executions_collection = db['automation_executions']
+device_usage_models_collection = db['device_usage_models']
 
 # Create indexes with error handling
 try:
@@ -45,6 +61,23 @@ try:
     refresh_tokens_collection.create_index("user_id")
     refresh_tokens_collection.create_index("token", unique=True)
     refresh_tokens_collection.create_index("expires_at")
+
+    # Indexes for delta sync of devices
+    devices_collection.create_index("version")
+    device_tombstones_collection.create_index("version")
+
+    # Write-behind command records only need to live long enough to be polled
+    device_commands_collection.create_index("created_at", expireAfterSeconds=86400)
+    device_jobs_collection.create_index("created_at", expireAfterSeconds=86400)
+
+    # Compact (v2) device logs are filtered by time range
+    device_logs.create_index([("v", 1), ("t", 1)])
+    # Lookup of the open error-storm document a repeated error is folded into
+    device_logs.create_index([("w", 1), ("d", 1)], sparse=True)
+
+    # Automation run history, listed per automation and kept for 30 days
+    automation_executions_collection.create_index([("automation_id", 1), ("executed_at", -1)])
+    automation_executions_collection.create_index("executed_at", expireAfterSeconds=30 * 86400)
     
     print("Successfully created all indexes")
 except Exception as e:
@@ -59,6 +92,112 @@ except Exception as e:
     print(f"MongoDB connection error: {e}")
 
 
+_async_client = None
+
+def get_async_database():
+    """
+    Return the database through PyMongo's asyncio client, created lazily on
+    first use so it binds to the running event loop of the ASGI server.
+    """
+    global _async_client
+    if _async_client is None:
+        from pymongo import AsyncMongoClient
+        _async_client = AsyncMongoClient(ACTIVE_URI, serverSelectionTimeoutMS=5000)
+    return _async_client[DATABASE_NAME]
+
+async def close_async_database():
+    """Close the asyncio client, if one was opened"""
+    global _async_client
+    if _async_client is not None:
+        await _async_client.close()
+        _async_client = None
+
+
+# Helper methods for device change versions (delta sync)
+# A device's change version is the server clock of its last write in epoch
+# milliseconds, stamped by that write itself ($$NOW), so a versioned write is a
+# single round trip and no shared counter is involved. Writes may become
+# visible slightly out of version order; see device_version_marks.
+DEVICE_VERSION = {"$toLong": "$$NOW"}
+
+# Highest version of a collection, served by its version index
+_LATEST_VERSION_STAGES = [{"$sort": {"version": -1}}, {"$limit": 1}, {"$project": {"version": 1}}]
+
+def device_version_marks():
+    """
+    Return (latest visible change version, safe version) in one round trip.
+    The safe version is the latest one held back to DEVICE_VERSION_SETTLE_SECONDS
+    behind the server clock: a write that is not visible yet was stamped
+    within that window, so it always lands above the safe version. Readers
+    take the marks before querying and poll from the safe version next; they
+    may see a device again, but never miss one. Both are equal once writes settled.
+    """
+    rows = list(devices_collection.aggregate(_LATEST_VERSION_STAGES + [
+        {"$unionWith": {
+            "coll": device_tombstones_collection.name,
+            "pipeline": _LATEST_VERSION_STAGES
+        }},
+        {"$group": {"_id": None, "latest": {"$max": "$version"}}},
+        {"$project": {"latest": 1, "now": DEVICE_VERSION}}
+    ]))
+    if not rows or rows[0].get("latest") is None:
+        return 0, 0
+    latest = rows[0]["latest"]
+    return latest, min(latest, rows[0]["now"] - int(DEVICE_VERSION_SETTLE_SECONDS * 1000))
+
+def device_update(fields, unset=()):
+    """
+    Pipeline update setting the given fields to their (literal) values,
+    removing the unset ones and stamping the change version
+    """
+    stages = [{"$set": {
+        **{field: {"$literal": value} for field, value in fields.items()},
+        "version": DEVICE_VERSION
+    }}]
+    if unset:
+        stages.append({"$unset": list(unset)})
+    return stages
+
+def insert_device(device):
+    """Insert a new device with its change version in one round trip; returns its _id"""
+    from bson.objectid import ObjectId
+    device = dict(device)
+    device_id = device.pop("_id", None) or ObjectId()
+    devices_collection.update_one({"_id": device_id}, device_update(device), upsert=True)
+    return device_id
+
+def record_device_deletion(device_id):
+    """Leave a tombstone so delta-sync clients learn about the deletion"""
+    from bson.objectid import ObjectId
+    return device_tombstones_collection.update_one(
+        {"_id": ObjectId(device_id)},
+        device_update({"deleted_at": datetime.now(timezone.utc)}),
+        upsert=True
+    )
+
+def set_device_power(device_id, is_on=None):
+    """
+    Atomically set a device's isOn (or flip it when is_on is None) and stamp
+    its change version in a single round trip, superseding any pending
+    write-behind command. Returns the updated document, or None if the device
+    does not exist.
+    """
+    from bson.objectid import ObjectId
+    return devices_collection.find_one_and_update(
+        {"_id": ObjectId(device_id)},
+        device_power_update(is_on),
+        return_document=ReturnDocument.AFTER
+    )
+
+def device_power_update(is_on=None):
+    """Pipeline update behind set_device_power, for the asyncio client too"""
+    new_state = {"$not": [{"$ifNull": ["$isOn", False]}]} if is_on is None else bool(is_on)
+    return [
+        {"$set": {"isOn": new_state, "version": DEVICE_VERSION}},
+        {"$unset": "pendingCommand"}
+    ]
+
+
 # Helper methods for user management
 def create_user(username, email, password_hash, first_name=None, last_name=None, role="user"):
     """Create a new user in the database"""
@@ -89,6 +228,48 @@ def find_user_by_id(user_id):
     from bson.objectid import ObjectId
     return users_collection.find_one({"_id": ObjectId(user_id)})
 
+# Bounded TTL cache of user id -> username, used when a token has no username claim
+USERNAME_CACHE_TTL = 300  # seconds
+USERNAME_CACHE_SIZE = 1024
+_username_cache = OrderedDict()
+_username_cache_lock = threading.Lock()
+
+def get_cached_username(user_id):
+    """Return the cached username for a user id, or None if missing or expired"""
+    with _username_cache_lock:
+        entry = _username_cache.get(user_id)
+        if entry is None:
+            return None
+        username, cached_at = entry
+        if time.monotonic() - cached_at >= USERNAME_CACHE_TTL:
+            del _username_cache[user_id]
+            return None
+        _username_cache.move_to_end(user_id)
+        return username
+
+def cache_username(user_id, username):
+    with _username_cache_lock:
+        _username_cache[user_id] = (username, time.monotonic())
+        _username_cache.move_to_end(user_id)
+        while len(_username_cache) > USERNAME_CACHE_SIZE:
+            _username_cache.popitem(last=False)
+
+def invalidate_username(user_id):
+    with _username_cache_lock:
+        _username_cache.pop(user_id, None)
+
+def find_username_by_id(user_id):
+    """Resolve a username, hitting the database only on a cache miss"""
+    username = get_cached_username(user_id)
+    if username is not None:
+        return username
+    from bson.objectid import ObjectId
+    user = users_collection.find_one({"_id": ObjectId(user_id)}, {"username": 1})
+    if not user or 'username' not in user:
+        return None
+    cache_username(user_id, user['username'])
+    return user['username']
+
 def update_last_login(user_id):
     """Update the user's last login timestamp"""
     from bson.objectid import ObjectId
@@ -0,0 +1,275 @@
+import threading
+import time
+from bson import ObjectId
+import db
+
+# Seconds between incremental re-syncs (devices with a newer change version)
+REGISTRY_SYNC_INTERVAL = 5
+# Seconds between full reloads, catching writes that bypassed versioning
+REGISTRY_FULL_RELOAD_INTERVAL = 300
+
+
+class DeviceRegistry:
+    """
+    In-process cache of the devices collection, indexed by _id, entityId,
+    room and type. Writes made by this process are applied directly; writes
+    from other processes are picked up by re-syncing on the change version.
+    Lookups return shallow copies so callers cannot corrupt the cache.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        # Held while refreshing from Mongo; readers never wait on it once loaded
+        self._refresh_lock = threading.Lock()
+        self._by_id = {}
+        self._by_entity = {}
+        self._by_room = {}
+        self._by_type = {}
+        self._version = 0
+        self._loaded_at = None
+        self._synced_at = None
+        self._listeners = []
+        self.hits = 0
+        self.misses = 0
+        self.syncs = 0
+        self.full_loads = 0
+
+    # Loading and syncing
+    def load(self):
+        """(Re)load every device from Mongo"""
+        # Marks first: writes landing during the query are above the safe version
+        _, version = db.device_version_marks()
+        devices = list(db.devices_collection.find())
+        with self._lock:
+            self._by_id, self._by_entity, self._by_room, self._by_type = {}, {}, {}, {}
+            for device in devices:
+                self._index(device)
+            self._version = version
+            self._loaded_at = self._synced_at = time.monotonic()
+            self.full_loads += 1
+
+    def sync(self):
+        """Apply devices changed or deleted since the last seen change version"""
+        with self._lock:
+            since = self._version
+        _, version = db.device_version_marks()
+        changed = list(db.devices_collection.find({"version": {"$gt": since}}))
+        deleted = list(db.device_tombstones_collection.find({"version": {"$gt": since}}, {"_id": 1, "version": 1}))
+        with self._lock:
+            for device in changed:
+                self._index(device)
+            for tombstone in deleted:
+                self._unindex(tombstone["_id"])
+            self._version = max(self._version, version)
+            self._synced_at = time.monotonic()
+            self.syncs += 1
+
+    def _refresh_due(self):
+        now = time.monotonic()
+        if self._loaded_at is None or now - self._loaded_at > REGISTRY_FULL_RELOAD_INTERVAL:
+            return "load"
+        if now - self._synced_at > REGISTRY_SYNC_INTERVAL:
+            return "sync"
+        return None
+
+    def _ensure_fresh(self):
+        """
+        Reload or re-sync when due. Runs without the index lock, so readers
+        keep being served from the current cache; only one thread refreshes,
+        and only the very first load makes other threads wait for it.
+        """
+        if self._refresh_due() is None:
+            return
+        if not self._refresh_lock.acquire(blocking=self._loaded_at is None):
+            return
+        try:
+            due = self._refresh_due()
+            if due == "load":
+                self.load()
+            elif due == "sync":
+                self.sync()
+        finally:
+            self._refresh_lock.release()
+
+    # Index maintenance
+    def _index(self, device):
+        device_id = device["_id"]
+        self._unindex(device_id)
+        self._by_id[device_id] = device
+        if device.get("entityId"):
+            self._by_entity[device["entityId"]] = device_id
+        self._by_room.setdefault(device.get("roomId"), set()).add(device_id)
+        self._by_type.setdefault(device.get("type"), set()).add(device_id)
+
+    def _unindex(self, device_id):
+        device = self._by_id.pop(device_id, None)
+        if device is None:
+            return
+        if device.get("entityId") and self._by_entity.get(device["entityId"]) == device_id:
+            del self._by_entity[device["entityId"]]
+        self._by_room.get(device.get("roomId"), set()).discard(device_id)
+        self._by_type.get(device.get("type"), set()).discard(device_id)
+
+    # Lookups
+    def get(self, device_id):
+        """Return a device by _id (ObjectId or string), or None"""
+        if not isinstance(device_id, ObjectId):
+            device_id = ObjectId(device_id)
+        self._ensure_fresh()
+        with self._lock:
+            device = self._by_id.get(device_id)
+            if device is not None:
+                self.hits += 1
+                return dict(device)
+            self.misses += 1
+
+        # Possibly created by another process since the last sync
+        device = db.devices_collection.find_one({"_id": device_id})
+        if device is not None:
+            with self._lock:
+                self._index(device)
+            return dict(device)
+        return None
+
+    def get_many(self, device_ids):
+        """Return {ObjectId: device} for the given ids, fetching any misses in one query"""
+        ids = [i if isinstance(i, ObjectId) else ObjectId(i) for i in device_ids]
+        found, missing = {}, []
+        self._ensure_fresh()
+        with self._lock:
+            for device_id in ids:
+                device = self._by_id.get(device_id)
+                if device is not None:
+                    found[device_id] = dict(device)
+                else:
+                    missing.append(device_id)
+            self.hits += len(found)
+            self.misses += len(missing)
+
+        if missing:
+            fetched = list(db.devices_collection.find({"_id": {"$in": missing}}))
+            with self._lock:
+                for device in fetched:
+                    self._index(device)
+            for device in fetched:
+                found[device["_id"]] = dict(device)
+        return found
+
+    def find_by_entity(self, entity_id):
+        self._ensure_fresh()
+        with self._lock:
+            device_id = self._by_entity.get(entity_id)
+            if device_id is not None:
+                self.hits += 1
+                return dict(self._by_id[device_id])
+            self.misses += 1
+
+        device = db.devices_collection.find_one({"entityId": entity_id})
+        if device is not None:
+            with self._lock:
+                self._index(device)
+            return dict(device)
+        return None
+
+    def by_room(self, room_id):
+        if room_id is not None and not isinstance(room_id, ObjectId):
+            room_id = ObjectId(room_id)
+        self._ensure_fresh()
+        with self._lock:
+            self.hits += 1
+            return [dict(self._by_id[i]) for i in self._by_room.get(room_id, ())]
+
+    def by_type(self, device_type):
+        self._ensure_fresh()
+        with self._lock:
+            self.hits += 1
+            return [dict(self._by_id[i]) for i in self._by_type.get(device_type, ())]
+
+    def all(self):
+        self._ensure_fresh()
+        with self._lock:
+            self.hits += 1
+            return [dict(device) for device in self._by_id.values()]
+
+    # Change listeners
+    def add_listener(self, listener):
+        """
+        Call listener(device, changes) after this process changes a device,
+        with changes as {field: (old value, new value)}. Devices picked up by
+        sync() were changed by another process, which notified its own listeners.
+        """
+        self._listeners.append(listener)
+
+    def _notify(self, previous, device):
+        if previous is None or not self._listeners:
+            return
+        changes = {
+            field: (previous.get(field), value)
+            for field, value in device.items()
+            if field != "version" and previous.get(field) != value
+        }
+        if not changes:
+            return
+        for listener in self._listeners:
+            try:
+                listener(dict(device), changes)
+            except Exception as e:
+                print(f"[Device Listener Error] {e}")
+
+    # Write-through from this process
+    def apply(self, device_id, fields, unset=()):
+        """Patch a cached device after the backend updated it in Mongo"""
+        if not isinstance(device_id, ObjectId):
+            device_id = ObjectId(device_id)
+        with self._lock:
+            previous = self._by_id.get(device_id)
+            if previous is not None:
+                device = self._patched(previous, fields, unset)
+        if previous is None:
+            # Not cached yet (e.g. created by another worker since the last
+            # sync): read it through so listeners still see the change. Mongo
+            # already holds the new values, so the old ones are unknown.
+            stored = db.devices_collection.find_one({"_id": device_id})
+            if stored is None:
+                return
+            previous = {field: value for field, value in stored.items() if field not in fields}
+            with self._lock:
+                device = self._patched(previous, fields, unset)
+        self._notify(previous, device)
+
+    def _patched(self, previous, fields, unset):
+        device = {**previous, **fields}
+        for field in unset:
+            device.pop(field, None)
+        self._index(device)
+        return device
+
+    def upsert(self, device):
+        """Store a full device document (after an insert or find_one_and_update)"""
+        device = dict(device)
+        with self._lock:
+            previous = self._by_id.get(device["_id"])
+            self._index(device)
+        self._notify(previous, device)
+
+    def remove(self, device_id):
+        if not isinstance(device_id, ObjectId):
+            device_id = ObjectId(device_id)
+        with self._lock:
+            self._unindex(device_id)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "devices": len(self._by_id),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+                "syncs": self.syncs,
+                "full_loads": self.full_loads,
+                "version": self._version
+            }
+
+
+device_registry = DeviceRegistry()
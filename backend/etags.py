@@ -0,0 +1,60 @@
+from functools import wraps
+from flask import request, make_response
+from pymongo import ReturnDocument
+import db
+
+# Every listing has a change version shared by all worker processes: a counter
+# bumped by invalidate_listing after each write, or for devices the change
+# versions the device writes stamp (see db.device_version_marks).
+
+def invalidate_listing(name):
+    """Bump a listing's change version after its collection changed"""
+    counter = db.counters_collection.find_one_and_update(
+        {"_id": name},
+        {"$inc": {"seq": 1}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return counter["seq"]
+
+def current_listing_version(name):
+    counter = db.counters_collection.find_one({"_id": name})
+    return counter["seq"] if counter else 0
+
+def listing_etag(name, version):
+    return f"{name}-{version}"
+
+def conditional_listing(name, version=None):
+    """
+    Serve a listing with a strong ETag derived from its change version.
+    If the client's If-None-Match matches the current version, return 304
+    without calling the view (one version lookup instead of the listing query).
+    The version is read before the view runs, so a write racing the view only
+    makes the next request re-render. version() defaults to the listing's
+    counter; it may return None while the version cannot be pinned down yet,
+    and the listing is then served without an ETag.
+    Requests with query parameters bypass this since they vary the body.
+    """
+    get_version = version or (lambda: current_listing_version(name))
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.args:
+                return view(*args, **kwargs)
+
+            current = get_version()
+            if current is None:
+                return view(*args, **kwargs)
+            etag = listing_etag(name, current)
+            if request.if_none_match.contains(etag):
+                response = make_response('', 304)
+                response.set_etag(etag)
+                return response
+
+            response = make_response(view(*args, **kwargs))
+            if response.status_code == 200:
+                response.set_etag(etag)
+            return response
+        return wrapper
+    return decorator
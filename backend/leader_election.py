@@ -0,0 +1,138 @@
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timezone, timedelta
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, PyMongoError
+from db import scheduler_leases_collection
+
+
+class LeaderElector:
+    """
+    Mongo-backed lease: at most one process holds the named lease at a time.
+    The holder renews it every renew_interval seconds; if it stops renewing
+    (crash, hang, lost connection) the lease expires after ttl seconds and
+    another process takes over. A holder that cannot renew demotes itself
+    before its lease can expire, so two leaders never overlap.
+    """
+
+    def __init__(self, name, ttl, renew_interval, on_elected=None, on_demoted=None, on_step=None):
+        self.name = name
+        self.ttl = ttl
+        self.renew_interval = renew_interval
+        self.on_elected = on_elected
+        self.on_demoted = on_demoted
+        self.on_step = on_step
+        self.identity = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.is_leader = False
+        self._deadline = 0.0  # monotonic time our lease surely expires by
+        self._stop = threading.Event()
+        self._thread = None
+        self.elections = 0
+        self.demotions = 0
+        self.renew_errors = 0
+
+    def try_acquire(self):
+        """Take the lease if it is free or expired, or renew it if we hold it"""
+        now = datetime.now(timezone.utc)
+        started = time.monotonic()
+        try:
+            lease = scheduler_leases_collection.find_one_and_update(
+                {"_id": self.name, "$or": [{"owner": self.identity}, {"expires_at": {"$lt": now}}]},
+                [{"$set": {
+                    # Expressions see the document before this update, so
+                    # acquired_at only moves when the lease changes hands
+                    "acquired_at": {"$cond": [{"$eq": ["$owner", self.identity]}, "$acquired_at", now]},
+                    "owner": self.identity,
+                    "expires_at": now + timedelta(seconds=self.ttl),
+                    "renewed_at": now
+                }}],
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # Someone else holds a live lease (the upsert raced their document)
+            return False
+        if lease.get("owner") != self.identity:
+            return False
+        self._deadline = started + self.ttl
+        return True
+
+    def release(self):
+        """Give up the lease so another process can take over immediately"""
+        try:
+            scheduler_leases_collection.delete_one({"_id": self.name, "owner": self.identity})
+        except PyMongoError as e:
+            print(f"[Leader Election] Could not release lease: {e}")
+        self._set_leader(False)
+
+    def current_leader(self):
+        lease = scheduler_leases_collection.find_one({"_id": self.name})
+        if not lease or lease["expires_at"].replace(tzinfo=timezone.utc) < datetime.now(timezone.utc):
+            return None
+        return lease
+
+    def _set_leader(self, leader):
+        if leader == self.is_leader:
+            return
+        self.is_leader = leader
+        callback = self.on_elected if leader else self.on_demoted
+        if leader:
+            self.elections += 1
+            print(f"[Leader Election] {self.identity} is now leader of '{self.name}'")
+        else:
+            self.demotions += 1
+            print(f"[Leader Election] {self.identity} is no longer leader of '{self.name}'")
+        if callback:
+            try:
+                callback()
+            except Exception as e:
+                print(f"[Leader Election] Callback error: {e}")
+
+    def step(self):
+        """One election round: acquire or renew, demoting on loss or near expiry"""
+        try:
+            self._set_leader(self.try_acquire())
+        except PyMongoError as e:
+            self.renew_errors += 1
+            print(f"[Leader Election] Lease renewal failed: {e}")
+            # Step down before the lease can expire and someone else takes over
+            if self.is_leader and time.monotonic() > self._deadline - self.renew_interval:
+                self._set_leader(False)
+        if self.on_step:
+            try:
+                self.on_step(self.is_leader)
+            except Exception as e:
+                print(f"[Leader Election] Step callback error: {e}")
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.step()
+            self._stop.wait(self.renew_interval)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=f"leader-{self.name}", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.renew_interval)
+            self._thread = None
+        if self.is_leader:
+            self.release()
+
+    def stats(self):
+        return {
+            "name": self.name,
+            "identity": self.identity,
+            "is_leader": self.is_leader,
+            "ttl": self.ttl,
+            "renew_interval": self.renew_interval,
+            "elections": self.elections,
+            "demotions": self.demotions,
+            "renew_errors": self.renew_errors
+        }
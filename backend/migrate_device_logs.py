@@ -0,0 +1,94 @@
+"""
+Convert existing device_logs documents between the original long-name layout
+(version 1) and the compact enum-coded layout (version 2, see models/log_schema.py).
+
+Usage (from the backend directory):
+    python migrate_device_logs.py              # convert v1 documents to v2
+    python migrate_device_logs.py --dry-run    # only count what would change
+    python migrate_device_logs.py --downgrade  # convert v2 documents back to v1
+
+Documents are rewritten in _id order with one bulk_write per batch, so the
+migration can be interrupted and re-run safely. Collection and index sizes and
+the time of a representative $group are printed before and after.
+"""
+import argparse
+import time
+from pymongo import ReplaceOne
+import db
+from models.log_schema import (
+    LOG_SCHEMA_VERSION, encode_log_entry, decode_log_entry, aggregate_logs
+)
+
+def collection_sizes():
+    stats = db.db.command("collStats", "device_logs")
+    return {
+        "documents": stats.get("count", 0),
+        "size_bytes": stats.get("size", 0),
+        "storage_bytes": stats.get("storageSize", 0),
+        "index_bytes": stats.get("totalIndexSize", 0)
+    }
+
+def time_group_stage():
+    """Milliseconds for an errors-per-device style $group over the whole collection"""
+    started = time.perf_counter()
+    list(aggregate_logs([
+        {"$match": {"is_error": True}},
+        {"$group": {"_id": "$device", "errors": {"$sum": 1}, "error_types": {"$addToSet": "$error_type"}}}
+    ]))
+    return round((time.perf_counter() - started) * 1000, 2)
+
+def migrate(batch_size=1000, dry_run=False, downgrade=False):
+    if downgrade:
+        query = {"v": LOG_SCHEMA_VERSION}
+        convert = decode_log_entry
+    else:
+        query = {"v": {"$exists": False}}
+        convert = encode_log_entry
+
+    pending = db.device_logs.count_documents(query)
+    print(f"{pending} device log documents to convert")
+    if dry_run or not pending:
+        return 0
+
+    converted = 0
+    last_id = None
+    while True:
+        batch_query = dict(query)
+        if last_id is not None:
+            batch_query["_id"] = {"$gt": last_id}
+        batch = list(db.device_logs.find(batch_query).sort("_id", 1).limit(batch_size))
+        if not batch:
+            break
+
+        # Filter on the source layout so documents converted concurrently are left alone
+        db.device_logs.bulk_write([
+            ReplaceOne({"_id": doc["_id"], **query}, convert(doc))
+            for doc in batch
+        ], ordered=False)
+        converted += len(batch)
+        last_id = batch[-1]["_id"]
+        print(f"  converted {converted}/{pending}")
+
+    return converted
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate device_logs between schema versions")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--dry-run", action="store_true", help="only count documents to convert")
+    parser.add_argument("--downgrade", action="store_true", help="convert compact documents back to the original layout")
+    args = parser.parse_args()
+
+    before, before_ms = collection_sizes(), time_group_stage()
+    migrate(args.batch_size, args.dry_run, args.downgrade)
+    if args.dry_run:
+        return
+    after, after_ms = collection_sizes(), time_group_stage()
+
+    print(f"{'':16}{'before':>16}{'after':>16}")
+    for key in before:
+        print(f"{key:16}{before[key]:>16}{after[key]:>16}")
+    print(f"{'group_ms':16}{before_ms:>16}{after_ms:>16}")
+    print("Note: storage_bytes shrinks once MongoDB compacts the collection (see the compact command).")
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,3 @@
-import pandas as pd
 import numpy as np
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.model_selection import train_test_split
@@ -7,10 +6,153 @@ from sklearn.pipeline import Pipeline
 from datetime import datetime, timedelta, timezone
 import joblib
 import os
+import threading
+import time as time_module
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from bson import ObjectId
+from pymongo import ReturnDocument
 
 # Import the database connection
 import db
+from device_registry import device_registry
+from config import (
+    ML_MODEL_MODE, ML_ONLINE_SMOOTHING, ML_ONLINE_CACHE_SECONDS,
+    ML_TRAIN_WORKERS, ML_TRAIN_QUIET_SECONDS, ML_TRAIN_EVENT_THRESHOLD, ML_TRAIN_MAX_DELAY_SECONDS
+)
+
+# Fewer recorded state changes than this and no prediction is made
+MIN_HISTORY_EVENTS = 10
+
+# Online model cells: hour of day x weekday x previous state x resulting state
+USAGE_MODEL_SHAPE = (24, 7, 2, 2)
+
+class OnlineUsageModel:
+    """
+    Per-device usage model updated in O(1) per state change: counts of the
+    resulting state for each (hour, weekday, previous_state) cell, stored as
+    one $inc on a small document. Predictions smooth each cell towards the
+    device's hour-of-day rate, and that towards its overall on-rate, so sparse
+    cells still give sensible probabilities.
+    """
+
+    def __init__(self, smoothing=ML_ONLINE_SMOOTHING, cache_seconds=ML_ONLINE_CACHE_SECONDS):
+        self.smoothing = smoothing
+        self.cache_seconds = cache_seconds
+        self._cache = {}  # device id -> (counts array, monotonic load time)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def cell_index(timestamp, previous_state, state):
+        return int(np.ravel_multi_index(
+            (timestamp.hour, timestamp.weekday(), int(bool(previous_state)), int(bool(state))),
+            USAGE_MODEL_SHAPE
+        ))
+
+    def observe(self, device_id, timestamp, previous_state, state):
+        """Count one state change"""
+        device_id = ObjectId(device_id)
+        index = self.cell_index(timestamp, previous_state, state)
+        db.device_usage_models_collection.update_one(
+            {"_id": device_id},
+            {
+                "$inc": {f"counts.{index}": 1, "events": 1},
+                "$set": {"updated_at": timestamp},
+                "$setOnInsert": {"counting_since": timestamp}
+            },
+            upsert=True
+        )
+        with self._lock:
+            cached = self._cache.get(device_id)
+            if cached is not None:
+                cached[0].flat[index] += 1
+
+    def _bootstrap(self, device_id):
+        """
+        Add the history recorded before the device's counts started to them,
+        once. Changes from counting_since on are counted by observe(), so only
+        older history is aggregated and it is added with $inc, never replacing
+        counts observed in the meantime.
+        """
+        doc = db.device_usage_models_collection.find_one_and_update(
+            {"_id": device_id},
+            {"$setOnInsert": {"counting_since": datetime.now(timezone.utc)}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        if doc.get("bootstrapped"):
+            return
+        cutoff = doc.get("counting_since") or datetime.now(timezone.utc)
+        rows = db.device_history_collection.aggregate([
+            {"$match": {"device_id": device_id, "timestamp": {"$type": "date", "$lt": cutoff}}},
+            {"$group": {
+                "_id": {
+                    "hour": {"$hour": "$timestamp"},
+                    "weekday": {"$dayOfWeek": "$timestamp"},
+                    "previous": {"$cond": ["$previous_state", 1, 0]},
+                    "state": {"$cond": ["$state", 1, 0]}
+                },
+                "count": {"$sum": 1}
+            }}
+        ])
+        increments = {}
+        for row in rows:
+            key = row["_id"]
+            # $dayOfWeek is 1 (Sunday) to 7 (Saturday); Python weekdays start on Monday
+            weekday = (key["weekday"] + 5) % 7
+            index = int(np.ravel_multi_index((key["hour"], weekday, key["previous"], key["state"]), USAGE_MODEL_SHAPE))
+            increments[f"counts.{index}"] = row["count"]
+        # Only the first process to get here adds the history
+        db.device_usage_models_collection.update_one(
+            {"_id": device_id, "bootstrapped": {"$ne": True}},
+            {
+                "$inc": {**increments, "events": sum(increments.values())},
+                "$set": {"bootstrapped": True}
+            }
+        )
+
+    def counts(self, device_id):
+        """Counts array of a device (cached for cache_seconds)"""
+        device_id = ObjectId(device_id)
+        with self._lock:
+            cached = self._cache.get(device_id)
+            if cached is not None and time_module.monotonic() - cached[1] < self.cache_seconds:
+                return cached[0]
+
+        doc = db.device_usage_models_collection.find_one({"_id": device_id})
+        if not doc or not doc.get("bootstrapped"):
+            self._bootstrap(device_id)
+            doc = db.device_usage_models_collection.find_one({"_id": device_id}) or {}
+
+        counts = np.zeros(USAGE_MODEL_SHAPE, dtype=np.int64)
+        for index, count in doc.get("counts", {}).items():
+            counts.flat[int(index)] = count
+        with self._lock:
+            self._cache[device_id] = (counts, time_module.monotonic())
+        return counts
+
+    def predict(self, device_id, when, previous_state):
+        """Return (probability of on, events seen), or None without enough history"""
+        counts = self.counts(device_id)
+        events = int(counts.sum())
+        if events < MIN_HISTORY_EVENTS:
+            return None
+
+        alpha = self.smoothing
+        previous = int(bool(previous_state))
+        overall = (counts[..., 1].sum() + alpha) / (events + 2 * alpha)
+        hour_cells = counts[when.hour, :, previous]
+        hour_rate = (hour_cells[:, 1].sum() + alpha * overall) / (hour_cells.sum() + alpha)
+        cell = counts[when.hour, when.weekday(), previous]
+        probability = (cell[1] + alpha * hour_rate) / (cell.sum() + alpha)
+        return float(probability), events
+
+    def forget(self, device_id):
+        with self._lock:
+            self._cache.pop(ObjectId(device_id), None)
+
+
+usage_model = OnlineUsageModel()
 
 class DeviceUsagePredictor:
     """
@@ -21,6 +163,7 @@ class DeviceUsagePredictor:
     def __init__(self):
         self.model = None
         self.device_models = {}  # Store models for each device
+        self.model_mtimes = {}   # Model file modification time when loaded
         self.model_dir = os.path.join(os.path.dirname(__file__), 'models')
         
         # Create models directory if it doesn't exist
@@ -28,41 +171,61 @@ class DeviceUsagePredictor:
             os.makedirs(self.model_dir)
     
     def _prepare_data_for_device(self, device_id):
-        """Prepare training data for a specific device"""
-        
-        # Get device usage history from database
-        device_history = list(db.device_history_collection.find({"device_id": ObjectId(device_id)}))
-        
-        if len(device_history) < 10:
+        """
+        Prepare training data for a specific device: features
+        [hour, day_of_week, is_weekend, previous_state] and the resulting state.
+        The projected history cursor is streamed into preallocated arrays and
+        the calendar features are derived from int64 epoch milliseconds in one
+        vectorized pass (hours and weekdays in UTC, as stored).
+        """
+        query = {"device_id": ObjectId(device_id)}
+        expected = db.device_history_collection.count_documents(query)
+        if expected < MIN_HISTORY_EVENTS:
             print(f"Not enough history for device {device_id} to train model")
             return None
-            
-        # Create dataset from history
-        data = []
-        for entry in device_history:
-            timestamp = entry.get('timestamp', datetime.now(timezone.utc))
-            if not isinstance(timestamp, datetime):
-                timestamp = datetime.fromisoformat(timestamp)
-                
-            # Features: hour of day, day of week, previous state
-            data.append({
-                'hour': timestamp.hour,
-                'day_of_week': timestamp.weekday(),
-                'is_weekend': 1 if timestamp.weekday() >= 5 else 0,
-                'previous_state': 1 if entry.get('previous_state', False) else 0,
-                'state': 1 if entry.get('state', False) else 0
-            })
-        
-        # Convert to DataFrame
-        df = pd.DataFrame(data)
-        
-        if df.empty:
+
+        timestamps = np.empty(expected, dtype=np.int64)
+        previous_states = np.empty(expected, dtype=np.int8)
+        states = np.empty(expected, dtype=np.int8)
+        now_ms = int(datetime.now(timezone.utc).timestamp() * 1000)
+
+        cursor = db.device_history_collection.find(
+            query, {"_id": 0, "timestamp": 1, "previous_state": 1, "state": 1}
+        ).batch_size(10000)
+        filled = 0
+        for entry in cursor:
+            if filled == expected:
+                break  # Inserted after we counted; left for the next training
+            timestamp = entry.get('timestamp')
+            if timestamp is None:
+                timestamps[filled] = now_ms
+            else:
+                if not isinstance(timestamp, datetime):
+                    timestamp = datetime.fromisoformat(timestamp)
+                if timestamp.tzinfo is None:
+                    timestamp = timestamp.replace(tzinfo=timezone.utc)
+                timestamps[filled] = int(timestamp.timestamp() * 1000)
+            previous_states[filled] = 1 if entry.get('previous_state', False) else 0
+            states[filled] = 1 if entry.get('state', False) else 0
+            filled += 1
+        cursor.close()
+
+        if filled < MIN_HISTORY_EVENTS:
             return None
-            
-        # Features and target
-        X = df[['hour', 'day_of_week', 'is_weekend', 'previous_state']]
-        y = df['state']
-        
+        timestamps = timestamps[:filled]
+
+        # 1970-01-01 was a Thursday (weekday 3)
+        days = timestamps // 86_400_000
+        hours = (timestamps // 3_600_000) % 24
+        weekdays = (days + 3) % 7
+
+        X = np.empty((filled, 4), dtype=np.int64)
+        X[:, 0] = hours
+        X[:, 1] = weekdays
+        X[:, 2] = weekdays >= 5
+        X[:, 3] = previous_states[:filled]
+        y = states[:filled]
+
         return X, y
     
     def train_model_for_device(self, device_id):
@@ -90,31 +253,41 @@ class DeviceUsagePredictor:
         
         # Store in memory too
         self.device_models[device_id] = model
+        self.model_mtimes[device_id] = os.path.getmtime(model_path)
         
         return True
     
     def predict_device_state(self, device_id, time=None):
-        """Predict if a device should be on or off at a given time"""
+        """
+        Predict if a device should be on or off at a given time, with the
+        online usage model, or the per-device forest when ML_MODEL_MODE is "forest"
+        """
         
         if time is None:
             time = datetime.now(timezone.utc)
+
+        if ML_MODEL_MODE != "forest":
+            return self._predict_online(device_id, time)
             
         # Check if model exists
         model_path = os.path.join(self.model_dir, f'device_{device_id}.joblib')
         
-        if device_id not in self.device_models and os.path.exists(model_path):
-            self.device_models[device_id] = joblib.load(model_path)
+        if os.path.exists(model_path):
+            # (Re)load when missing or retrained since, possibly by another worker
+            mtime = os.path.getmtime(model_path)
+            if device_id not in self.device_models or self.model_mtimes.get(device_id, 0) < mtime:
+                self.device_models[device_id] = joblib.load(model_path)
+                self.model_mtimes[device_id] = mtime
         elif device_id not in self.device_models:
-            # Train a new model
-            success = self.train_model_for_device(device_id)
-            if not success:
-                print(f"Could not train model for device {device_id}")
-                return None
+            # Train in the background rather than in this request
+            training_queue.mark_dirty(device_id, immediate=True)
+            print(f"No model yet for device {device_id}, training queued")
+            return None
         
         model = self.device_models[device_id]
         
         # Get device current state
-        device = db.devices_collection.find_one({"_id": ObjectId(device_id)})
+        device = device_registry.get(device_id)
         if not device:
             return None
             
@@ -138,11 +311,43 @@ class DeviceUsagePredictor:
             'current_state': bool(previous_state)
         }
     
+    def _predict_online(self, device_id, time):
+        device = device_registry.get(device_id)
+        if not device:
+            return None
+
+        previous_state = device.get('isOn', False)
+        result = usage_model.predict(device_id, time, previous_state)
+        if result is None:
+            print(f"Not enough history for device {device_id} to predict")
+            return None
+        probability, events = result
+
+        return {
+            'prediction': probability >= 0.5,
+            'probability': probability,
+            'current_state': bool(previous_state),
+            'model': 'online',
+            'events': events
+        }
+
+    def retrain_all(self):
+        """Queue a batch retrain of the forest of every device with enough history"""
+        device_ids = db.device_history_collection.aggregate([
+            {"$group": {"_id": "$device_id", "events": {"$sum": 1}}},
+            {"$match": {"events": {"$gte": MIN_HISTORY_EVENTS}}}
+        ])
+        queued = 0
+        for row in device_ids:
+            training_queue.mark_dirty(str(row["_id"]), immediate=True)
+            queued += 1
+        return queued
+
     def get_device_suggestions(self):
         """Get suggestions for devices that should be toggled based on predictions"""
         
         suggestions = []
-        devices = list(db.devices_collection.find())
+        devices = device_registry.all()
         
         for device in devices:
             device_id = str(device['_id'])
@@ -168,8 +373,150 @@ class DeviceUsagePredictor:
         return suggestions
 
 
+class TrainingQueue:
+    """
+    Debounced background retraining of device forests. State changes mark a
+    device dirty; a dispatcher thread hands it to a bounded worker pool once
+    it has been quiet for `quiet_seconds`, collected `event_threshold` new
+    events, or waited `max_delay` seconds under constant use. A device is
+    queued at most once and never trained twice at the same time; events
+    arriving during its training mark it dirty again.
+    """
+
+    def __init__(self, train, workers, quiet_seconds, event_threshold, max_delay, poll_interval=0.5):
+        self._train_device = train
+        self.workers = workers
+        self.quiet_seconds = quiet_seconds
+        self.event_threshold = event_threshold
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        self._lock = threading.Condition()
+        self._dirty = {}      # device id -> {"first", "last", "events", "immediate"}
+        self._running = set()
+        self._last_trained = {}
+        self._durations = deque(maxlen=200)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="model-training")
+        self._thread = None
+        self.trained = 0
+        self.failed = 0
+        self.skipped = 0
+
+    def _ensure_started(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="model-training-dispatcher", daemon=True)
+            self._thread.start()
+
+    def mark_dirty(self, device_id, immediate=False):
+        """Record a new event for a device; immediate skips the quiet period"""
+        device_id = str(device_id)
+        now = time_module.monotonic()
+        with self._lock:
+            self._ensure_started()
+            entry = self._dirty.setdefault(device_id, {"first": now, "last": now, "events": 0, "immediate": False})
+            entry["last"] = now
+            entry["events"] += 1
+            entry["immediate"] = entry["immediate"] or immediate
+            if immediate or entry["events"] >= self.event_threshold:
+                self._lock.notify()
+
+    def _due(self, now):
+        due = []
+        for device_id, entry in self._dirty.items():
+            if device_id in self._running:
+                continue
+            if (entry["immediate"] or entry["events"] >= self.event_threshold
+                    or now - entry["last"] >= self.quiet_seconds
+                    or now - entry["first"] >= self.max_delay):
+                due.append(device_id)
+        # Longest waiting first
+        return sorted(due, key=lambda device_id: self._dirty[device_id]["first"])
+
+    def _run(self):
+        while True:
+            with self._lock:
+                self._lock.wait(self.poll_interval)
+                free = self.workers - len(self._running)
+                for device_id in self._due(time_module.monotonic())[:max(free, 0)]:
+                    del self._dirty[device_id]
+                    self._running.add(device_id)
+                    self._executor.submit(self._train, device_id)
+
+    def _train(self, device_id):
+        started = time_module.perf_counter()
+        try:
+            trained = self._train_device(device_id)
+        except Exception as e:
+            trained = None
+            print(f"Error training model for device {device_id}: {e}")
+        duration = time_module.perf_counter() - started
+        with self._lock:
+            self._running.discard(device_id)
+            self._durations.append(duration)
+            if trained:
+                self.trained += 1
+                self._last_trained[device_id] = datetime.now(timezone.utc)
+            elif trained is None:
+                self.failed += 1
+            else:
+                self.skipped += 1  # Not enough history yet
+            self._lock.notify()
+
+    def last_trained(self, device_id):
+        with self._lock:
+            return self._last_trained.get(str(device_id))
+
+    def pending_devices(self):
+        with self._lock:
+            return set(self._dirty)
+
+    def stats(self):
+        now = time_module.monotonic()
+        with self._lock:
+            durations = list(self._durations)
+            oldest = min((entry["first"] for entry in self._dirty.values()), default=None)
+            return {
+                "queue_depth": len(self._dirty),
+                "pending_events": sum(entry["events"] for entry in self._dirty.values()),
+                "oldest_pending_seconds": round(now - oldest, 1) if oldest is not None else None,
+                "running": len(self._running),
+                "workers": self.workers,
+                "trained": self.trained,
+                "failed": self.failed,
+                "skipped": self.skipped,
+                "avg_training_seconds": round(sum(durations) / len(durations), 3) if durations else None,
+                "max_training_seconds": round(max(durations), 3) if durations else None
+            }
+
+
 # Initialize the predictor
 device_predictor = DeviceUsagePredictor()
+training_queue = TrainingQueue(
+    device_predictor.train_model_for_device, ML_TRAIN_WORKERS,
+    ML_TRAIN_QUIET_SECONDS, ML_TRAIN_EVENT_THRESHOLD, ML_TRAIN_MAX_DELAY_SECONDS
+)
+
+def get_model_freshness(limit=50):
+    """
+    Age of each device's forest model, stalest first, from the model files so
+    models trained by other workers count too. Devices with a pending retrain
+    are flagged.
+    """
+    now = time_module.time()
+    pending = training_queue.pending_devices()
+    models = []
+    for filename in os.listdir(device_predictor.model_dir):
+        if not (filename.startswith('device_') and filename.endswith('.joblib')):
+            continue
+        device_id = filename[len('device_'):-len('.joblib')]
+        mtime = os.path.getmtime(os.path.join(device_predictor.model_dir, filename))
+        models.append({
+            "device_id": device_id,
+            "trained_at": datetime.fromtimestamp(mtime, timezone.utc).isoformat(),
+            "age_seconds": round(now - mtime),
+            "retrain_pending": device_id in pending
+        })
+    models.sort(key=lambda model: -model["age_seconds"])
+    return models[:limit]
 
 def update_device_history(device_id, state, user_id=None):
     """
@@ -178,7 +525,7 @@ def update_device_history(device_id, state, user_id=None):
     device_id_obj = ObjectId(device_id) if not isinstance(device_id, ObjectId) else device_id
     
     # Get current device state (before change)
-    device = db.devices_collection.find_one({"_id": device_id_obj})
+    device = device_registry.get(device_id_obj)
     previous_state = device.get('isOn', False) if device else False
     
     # Log the state change
@@ -193,11 +540,13 @@ def update_device_history(device_id, state, user_id=None):
     # Add to history collection
     db.device_history_collection.insert_one(history_entry)
     
-    # Try to train/update the model
+    # Update the online model in O(1); forests are retrained in the background
     try:
-        device_predictor.train_model_for_device(str(device_id))
+        usage_model.observe(device_id_obj, history_entry['timestamp'], previous_state, state)
     except Exception as e:
-        print(f"Error training model for device {device_id}: {e}")
+        print(f"Error updating usage model for device {device_id}: {e}")
+    if ML_MODEL_MODE == "forest":
+        training_queue.mark_dirty(device_id_obj)
 
 def get_device_suggestions(room_ids=None):
     """
@@ -213,11 +562,8 @@ def get_device_suggestions(room_ids=None):
             for s in suggestions:
                 try:
                     # Check if device exists in the specified rooms
-                    device_exists = db.devices_collection.find_one({
-                        "_id": ObjectId(s["device_id"]), 
-                        "room_id": {"$in": room_ids}
-                    })
-                    if device_exists:
+                    device = device_registry.get(s["device_id"])
+                    if device and device.get("room_id") in room_ids:
                         filtered_suggestions.append(s)
                 except Exception as device_error:
                     print(f"Error filtering device {s.get('device_id')}: {device_error}")
@@ -0,0 +1,91 @@
+import atexit
+import threading
+from collections import deque
+from datetime import datetime, timezone
+import db
+from config import AUTOMATION_HISTORY_QUEUE_SIZE, AUTOMATION_HISTORY_BATCH_SIZE, AUTOMATION_HISTORY_FLUSH_INTERVAL
+from models.device_log import DeviceLogWriter
+
+# Outcome of one automation run
+EXECUTION_SUCCESS = "success"
+EXECUTION_FAILED = "failed"
+EXECUTION_SKIPPED = "skipped"  # previous run of its job still busy (max instances reached)
+EXECUTION_MISSED = "missed"    # fired later than the misfire grace time
+
+def build_execution_entry(automation, outcome, duration_ms=None, trigger="time", error=None):
+    entry = {
+        "automation_id": str(automation.get("_id")),
+        "name": automation.get("name"),
+        "trigger": trigger,
+        "outcome": outcome,
+        "duration_ms": duration_ms,
+        "executed_at": datetime.now(timezone.utc)
+    }
+    if error:
+        entry["error"] = error
+    return entry
+
+
+class AutomationExecutionWriter(DeviceLogWriter):
+    """Execution history, queued and inserted in batches like the device logs"""
+
+    thread_name = "automation-execution-writer"
+
+    def _store(self, batch):
+        db.automation_executions_collection.insert_many(batch, ordered=False)
+        return 0
+
+
+class AutomationMetrics:
+    """
+    In-process run counters and latency of automation batches. Percentiles are
+    taken over the last `window` batches.
+    """
+
+    def __init__(self, window=500):
+        self._lock = threading.Lock()
+        self._durations = deque(maxlen=window)
+        self.outcomes = {EXECUTION_SUCCESS: 0, EXECUTION_FAILED: 0, EXECUTION_SKIPPED: 0, EXECUTION_MISSED: 0}
+        self.batches = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.last_ms = None
+
+    def record_batch(self, duration_ms, outcomes):
+        """outcomes: the outcome of every automation the batch ran"""
+        with self._lock:
+            self.batches += 1
+            self.total_ms += duration_ms
+            self.max_ms = max(self.max_ms, duration_ms)
+            self.last_ms = duration_ms
+            self._durations.append(duration_ms)
+            for outcome in outcomes:
+                self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+
+    def record(self, outcome, count=1):
+        with self._lock:
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + count
+
+    def stats(self):
+        with self._lock:
+            durations = sorted(self._durations)
+            return {
+                "outcomes": dict(self.outcomes),
+                "batches": self.batches,
+                "avg_ms": round(self.total_ms / self.batches, 2) if self.batches else None,
+                "p95_ms": round(durations[int(len(durations) * 0.95) - 1 if len(durations) > 1 else 0], 2) if durations else None,
+                "max_ms": round(self.max_ms, 2),
+                "last_ms": round(self.last_ms, 2) if self.last_ms is not None else None
+            }
+
+
+automation_execution_writer = AutomationExecutionWriter(
+    AUTOMATION_HISTORY_QUEUE_SIZE, AUTOMATION_HISTORY_BATCH_SIZE, AUTOMATION_HISTORY_FLUSH_INTERVAL
+)
+atexit.register(automation_execution_writer.close)
+
+automation_metrics = AutomationMetrics()
+
+def record_executions(entries):
+    """Queue execution history entries for the next batched insert"""
+    automation_execution_writer.submit_many(entries)
@@ -1,14 +1,23 @@
+import atexit
+import queue
+import threading
+import time
 from datetime import datetime, timezone
 import db
+from pymongo import UpdateOne
+from config import (
+    DEVICE_LOG_QUEUE_SIZE, DEVICE_LOG_BATCH_SIZE, DEVICE_LOG_FLUSH_INTERVAL,
+    DEVICE_LOG_SCHEMA_VERSION, DEVICE_LOG_ERROR_DEDUP_WINDOW
+)
+from models.log_schema import LOG_SCHEMA_VERSION, encode_log_entry, encode_log_query, encode_log_update
 
-def log_device_action(user, device, action, result, is_error=False, error_type=None):
-    # DEBUG - print("About to log to MongoDB")
+def build_log_entry(user, device, action, result, is_error=False, error_type=None):
     # Safe fallback values for all fields
     user = user or "unknown"
     device = device or "unknown"
     action = action or "unknown"
     result = result or "unknown"
-    
+
     # Determine if this is an error based on result content
     if not is_error and result and ("error" in result.lower() or "failed" in result.lower() or "timeout" in result.lower()):
         is_error = True
@@ -21,17 +30,221 @@ def log_device_action(user, device, action, result, is_error=False, error_type=N
         else:
             error_type = "general_error"
 
-    # Insert into device_logs collection
     log_entry = {
-        "user": user,  
+        "user": user,
         "device": device,
         "action": action,
         "result": result,
         "timestamp": datetime.now(timezone.utc),
         "is_error": is_error
     }
-    
+
     if error_type:
         log_entry["error_type"] = error_type
-    
-    db.device_logs.insert_one(log_entry)
+
+    return log_entry
+
+class DeviceLogWriter:
+    """
+    Buffers device log entries in a bounded queue and writes them from a
+    background thread with insert_many, once `batch_size` entries are waiting
+    or `flush_interval` seconds have passed. When the queue is full a caller
+    waits up to `put_timeout` seconds (backpressure) before the entry is dropped.
+
+    With a `dedup_window` (seconds), identical errors (same user, device, action
+    and error_type) falling in the same window are collapsed into one document
+    carrying a count and first/last timestamps.
+    """
+
+    thread_name = "device-log-writer"
+
+    def __init__(self, max_queue, batch_size, flush_interval, put_timeout=0.05, dedup_window=0):
+        self.batch_size = batch_size
+        self.dedup_window = dedup_window
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopping = threading.Event()
+        self.enqueued = 0
+        self.written = 0
+        self.batches = 0
+        self.backpressured = 0
+        self.dropped = 0
+        self.failed = 0
+        self.deduplicated = 0
+
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopping.clear()
+                self._thread = threading.Thread(target=self._run, name=self.thread_name, daemon=True)
+                self._thread.start()
+
+    def submit(self, entry):
+        """Queue one entry; returns False if it had to be dropped"""
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            with self._lock:
+                self.backpressured += 1
+            try:
+                self._queue.put(entry, timeout=self.put_timeout)
+            except queue.Full:
+                with self._lock:
+                    self.dropped += 1
+                return False
+        with self._lock:
+            self.enqueued += 1
+        return True
+
+    def submit_many(self, entries):
+        for entry in entries:
+            self.submit(entry)
+
+    def _drain(self, limit):
+        batch = []
+        while len(batch) < limit:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        if not batch:
+            return
+        try:
+            collapsed = self._store(batch)
+            with self._lock:
+                self.written += len(batch)
+                self.batches += 1
+                self.deduplicated += collapsed
+        except Exception as e:
+            with self._lock:
+                self.failed += len(batch)
+            print(f"[Logging Error] {e}")
+        finally:
+            for _ in batch:
+                self._queue.task_done()
+
+    def _store(self, batch):
+        """Write one batch; returns how many entries were folded into existing documents"""
+        inserts, error_upserts, error_entries = self._prepare(batch)
+        if inserts:
+            db.device_logs.insert_many(inserts, ordered=False)
+        if error_upserts:
+            result = db.device_logs.bulk_write(error_upserts, ordered=False)
+            return error_entries - result.upserted_count
+        return 0
+
+    def _prepare(self, batch):
+        """
+        Split a batch into documents to insert and upserts for deduplicated errors.
+        Returns (inserts, upserts, number of error entries folded into upserts).
+        """
+        compact = DEVICE_LOG_SCHEMA_VERSION == LOG_SCHEMA_VERSION
+        inserts = []
+        storms = {}
+        for entry in batch:
+            if self.dedup_window > 0 and entry.get("is_error"):
+                ts = entry["timestamp"]
+                key = (
+                    entry.get("user"), entry.get("device"), entry.get("action"), entry.get("error_type"),
+                    int(ts.timestamp() // self.dedup_window)
+                )
+                storm = storms.get(key)
+                if storm is None:
+                    storms[key] = {"first": ts, "last": ts, "count": 1, "result": entry.get("result")}
+                else:
+                    storm["count"] += 1
+                    storm["first"] = min(storm["first"], ts)
+                    storm["last"] = max(storm["last"], ts)
+                    storm["result"] = entry.get("result")
+            else:
+                inserts.append(encode_log_entry(entry) if compact else entry)
+
+        upserts = []
+        for (user, device, action, error_type, bucket), storm in storms.items():
+            query = {
+                "user": user, "device": device, "action": action, "error_type": error_type,
+                "is_error": True, "dedup_bucket": bucket
+            }
+            update = {
+                "$min": {"timestamp": storm["first"]},
+                "$set": {"result": storm["result"]},
+                "$inc": {"count": storm["count"]},
+                "$max": {"last_timestamp": storm["last"]}
+            }
+            if compact:
+                query = {"v": LOG_SCHEMA_VERSION, **encode_log_query(query)}
+                update = encode_log_update(update)
+            upserts.append(UpdateOne(query, update, upsert=True))
+        return inserts, upserts, sum(storm["count"] for storm in storms.values())
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                first = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            batch = [first]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._write(batch)
+
+    def flush(self):
+        """Synchronously write everything queued so far"""
+        while True:
+            batch = self._drain(self.batch_size)
+            if not batch:
+                break
+            self._write(batch)
+        # Wait for a batch the background thread may be writing
+        self._queue.join()
+
+    def close(self, timeout=5):
+        """Stop the background thread and flush what is left (called on shutdown)"""
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self.flush()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queued": self._queue.qsize(),
+                "enqueued": self.enqueued,
+                "written": self.written,
+                "batches": self.batches,
+                "backpressured": self.backpressured,
+                "dropped": self.dropped,
+                "failed": self.failed,
+                "deduplicated": self.deduplicated
+            }
+
+
+device_log_writer = DeviceLogWriter(
+    DEVICE_LOG_QUEUE_SIZE, DEVICE_LOG_BATCH_SIZE, DEVICE_LOG_FLUSH_INTERVAL,
+    dedup_window=DEVICE_LOG_ERROR_DEDUP_WINDOW
+)
+atexit.register(device_log_writer.close)
+
+def log_device_action(user, device, action, result, is_error=False, error_type=None):
+    """Queue a log entry; it is written by the background log writer"""
+    device_log_writer.submit(build_log_entry(user, device, action, result, is_error, error_type))
+
+def log_device_actions(entries):
+    """Queue several prepared log entries for the next batched write"""
+    device_log_writer.submit_many(entries)
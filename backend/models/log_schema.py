@@ -0,0 +1,299 @@
+import db
+
+# Compact device log layout (schema version 2).
+# Long field names are replaced by short keys, and action, result and error_type
+# are stored as small integer codes when the value is in the lookup tables below.
+# Values outside the tables (free-form results like "error: ...") are kept as strings.
+# Documents without a "v" field use the original long-name layout (version 1).
+LOG_SCHEMA_VERSION = 2
+
+LOG_FIELDS = {
+    "user": "u",
+    "device": "d",
+    "action": "a",
+    "result": "r",
+    "timestamp": "t",
+    "is_error": "e",
+    "error_type": "et",
+    # Deduplicated error storms: occurrences, last occurrence and window bucket
+    "count": "n",
+    "last_timestamp": "lt",
+    "dedup_bucket": "w"
+}
+
+# Lookup tables: a value's code is its index. Append only, never reorder,
+# since stored documents refer to these positions. Index 0 is reserved.
+LOG_ACTIONS = (
+    None, "toggle", "toggle_all", "set_temperature", "add", "remove", "refresh",
+    "refresh_auth", "reset", "test", "bulk_commands", "group_refresh", "scene", "unknown"
+)
+LOG_RESULTS = (
+    None, "on", "off", "success", "failed", "passed", "unknown", "device not found",
+    "error: device not found"
+)
+LOG_ERROR_TYPES = (
+    None, "device_not_found", "timeout", "connection_error", "general_error",
+    "home_assistant_error", "unsupported_operation", "device_creation_error", "unknown"
+)
+LOG_CODES = {
+    "action": LOG_ACTIONS,
+    "result": LOG_RESULTS,
+    "error_type": LOG_ERROR_TYPES
+}
+_CODE_LOOKUP = {field: {value: code for code, value in enumerate(table) if value}
+                for field, table in LOG_CODES.items()}
+
+def encode_value(field, value):
+    """Code for an enum field value, or the value itself if it has none"""
+    if field in _CODE_LOOKUP and isinstance(value, str):
+        return _CODE_LOOKUP[field].get(value, value)
+    return value
+
+def decode_value(field, value):
+    if field in LOG_CODES and isinstance(value, int) and not isinstance(value, bool):
+        table = LOG_CODES[field]
+        return table[value] if 0 < value < len(table) else None
+    return value
+
+def encode_log_entry(entry):
+    """Convert a long-name log entry (see build_log_entry) to the compact layout"""
+    doc = {"v": LOG_SCHEMA_VERSION}
+    for field, value in entry.items():
+        key = LOG_FIELDS.get(field)
+        if key is None:
+            doc[field] = value
+        elif value is not None:
+            doc[key] = encode_value(field, value)
+    return doc
+
+def decode_log_entry(doc):
+    """Return a log document with long field names, whichever layout it was stored in"""
+    if doc.get("v") is None:
+        return doc
+    short_to_long = {short: field for field, short in LOG_FIELDS.items()}
+    entry = {}
+    for key, value in doc.items():
+        if key == "v":
+            continue
+        field = short_to_long.get(key, key)
+        entry[field] = decode_value(field, value)
+    return entry
+
+def _encode_condition(field, condition):
+    if isinstance(condition, dict) and any(k.startswith("$") for k in condition):
+        encoded = {}
+        for op, operand in condition.items():
+            if op in ("$in", "$nin", "$all"):
+                encoded[op] = [encode_value(field, v) for v in operand]
+            elif op in ("$eq", "$ne", "$gt", "$gte", "$lt", "$lte"):
+                encoded[op] = encode_value(field, operand)
+            else:
+                encoded[op] = operand
+        return encoded
+    return encode_value(field, condition)
+
+def encode_log_query(query):
+    """Translate a filter written against long field names to the compact layout"""
+    encoded = {}
+    for key, condition in query.items():
+        if key in ("$and", "$or", "$nor"):
+            encoded[key] = [encode_log_query(q) for q in condition]
+        elif key in LOG_FIELDS:
+            encoded[LOG_FIELDS[key]] = _encode_condition(key, condition)
+        else:
+            encoded[key] = condition
+    return encoded
+
+def encode_log_update(update):
+    """Translate an update document ($set, $inc, ...) to the compact layout"""
+    return {
+        op: {LOG_FIELDS.get(field, field): encode_value(field, value) for field, value in fields.items()}
+        for op, fields in update.items()
+    }
+
+def log_match(query):
+    """
+    $match filter covering both layouts: compact documents are matched on
+    their short keys and codes, documents not yet migrated on the long names.
+    """
+    query = query or {}
+    return {"$or": [
+        {"v": LOG_SCHEMA_VERSION, **encode_log_query(query)},
+        {"v": {"$exists": False}, **query}
+    ]}
+
+def _decode_expression(field):
+    short = f"${LOG_FIELDS[field]}"
+    stored = {"$ifNull": [short, f"${field}"]}
+    if field in LOG_CODES:
+        # Only compact documents hold codes; long-name values are used as they are
+        stored = {"$cond": [
+            {"$isNumber": short},
+            {"$arrayElemAt": [list(LOG_CODES[field]), short]},
+            stored
+        ]}
+    # Leave the field out rather than null, as the original documents did
+    return {"$ifNull": [stored, "$$REMOVE"]}
+
+# Number of actions a log document stands for (deduplicated errors carry a count)
+LOG_COUNT = {"$ifNull": ["$count", 1]}
+
+# Aggregation stage restoring long field names and decoded values
+LOG_DECODE_STAGE = {"$addFields": {
+    **{field: _decode_expression(field) for field in LOG_FIELDS},
+    **{short: "$$REMOVE" for short in LOG_FIELDS.values()},
+    "v": "$$REMOVE"
+}}
+
+def _encode_expression(field):
+    stored = f"${field}"
+    if field in LOG_CODES:
+        # Values outside the table stay strings, as encode_value leaves them
+        stored = {"$let": {
+            "vars": {"code": {"$indexOfArray": [list(LOG_CODES[field]), stored]}},
+            "in": {"$cond": [{"$gt": ["$$code", 0]}, "$$code", stored]}
+        }}
+    return {"$ifNull": [stored, "$$REMOVE"]}
+
+# Aggregation stage bringing long-name (version 1) documents to the compact layout
+LOG_ENCODE_STAGE = {"$addFields": {
+    **{short: _encode_expression(field) for field, short in LOG_FIELDS.items()},
+    **{field: "$$REMOVE" for field in LOG_FIELDS},
+    "v": LOG_SCHEMA_VERSION
+}}
+
+def _stored_refs(value, shadowed=()):
+    """Point field paths like "$action" or "$timestamp" at the stored short keys"""
+    if isinstance(value, str):
+        if value.startswith("$") and not value.startswith("$$"):
+            head, dot, rest = value[1:].partition(".")
+            if head in LOG_FIELDS and head not in shadowed:
+                return f"${LOG_FIELDS[head]}{dot}{rest}"
+        return value
+    if isinstance(value, dict):
+        return {key: _stored_refs(item, shadowed) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_stored_refs(item, shadowed) for item in value]
+    return value
+
+def _stored_stage(stage, shadowed):
+    """Translate a stage that still runs on stored documents"""
+    (op, spec), = stage.items()
+    if op == "$match":
+        return {op: encode_log_query(spec)}
+    if op == "$sort":
+        return {op: {key if key in shadowed else LOG_FIELDS.get(key, key): direction
+                     for key, direction in spec.items()}}
+    if op in ("$addFields", "$set"):
+        translated = {key: _stored_refs(item, shadowed) for key, item in spec.items()}
+        # Later stages refer to these outputs by name
+        shadowed.update(spec)
+        return {op: translated}
+    return {op: _stored_refs(spec, shadowed)}
+
+def _decode_code(expression, field):
+    return {"$cond": [
+        {"$isNumber": expression},
+        {"$arrayElemAt": [list(LOG_CODES[field]), expression]},
+        expression
+    ]}
+
+def _enum_field(value, shadowed):
+    if isinstance(value, str) and value.startswith("$") and value[1:] in LOG_CODES and value[1:] not in shadowed:
+        return value[1:]
+    return None
+
+def _group_decode_stage(group, shadowed):
+    """$addFields decoding the enum codes a $group copied into its output, if any"""
+    decoded = {}
+    group_id = group.get("_id")
+    field = _enum_field(group_id, shadowed)
+    if field:
+        decoded["_id"] = _decode_code("$_id", field)
+    elif isinstance(group_id, dict):
+        for key, value in group_id.items():
+            field = _enum_field(value, shadowed)
+            if field:
+                decoded[f"_id.{key}"] = _decode_code(f"$_id.{key}", field)
+    for name, accumulator in group.items():
+        if name == "_id" or not isinstance(accumulator, dict) or len(accumulator) != 1:
+            continue
+        (op, value), = accumulator.items()
+        field = _enum_field(value, shadowed)
+        if not field:
+            continue
+        if op in ("$addToSet", "$push"):
+            decoded[name] = {"$map": {"input": f"${name}", "in": _decode_code("$$this", field)}}
+        elif op in ("$first", "$last", "$min", "$max"):
+            decoded[name] = _decode_code(f"${name}", field)
+    return {"$addFields": decoded} if decoded else None
+
+def aggregate_logs(pipeline):
+    """
+    Run an aggregation over device_logs written against long field names.
+    Documents are filtered, grouped and sorted on their stored short keys and
+    codes (so a leading $match can use the (v, t) index), and only what the
+    first $group outputs is decoded; long-name documents are encoded on the way
+    in. Stages after the first $group see its output as usual. Without a
+    $group, the output documents are decoded at the end.
+    """
+    stages = list(pipeline)
+    match = stages.pop(0)["$match"] if stages and "$match" in stages[0] else {}
+    translated = [
+        {"$match": {"v": LOG_SCHEMA_VERSION, **encode_log_query(match)}},
+        {"$unionWith": {"coll": db.device_logs.name, "pipeline": [
+            {"$match": {"v": {"$exists": False}, **match}},
+            LOG_ENCODE_STAGE
+        ]}}
+    ]
+    shadowed = set()
+    while stages:
+        stage = stages.pop(0)
+        if "$group" in stage:
+            translated.append(_stored_stage(stage, shadowed))
+            decode = _group_decode_stage(stage["$group"], shadowed)
+            if decode:
+                translated.append(decode)
+            return db.device_logs.aggregate(translated + stages)
+        translated.append(_stored_stage(stage, shadowed))
+    translated.append(LOG_DECODE_STAGE)
+    return db.device_logs.aggregate(translated)
+
+def _sort_value(value):
+    return (value is not None, value)
+
+def find_logs(query=None, sort=None, limit=None):
+    """
+    find() counterpart of aggregate_logs; sort is a list of (field, direction).
+    Compact documents are filtered, sorted and limited on their stored keys,
+    so a timestamp sort uses the (v, t) index; documents not yet migrated are
+    queried on the long names and the two are merged.
+    """
+    query = query or {}
+    compact = db.device_logs.find({"v": LOG_SCHEMA_VERSION, **encode_log_query(query)})
+    legacy = db.device_logs.find({"v": {"$exists": False}, **query})
+    if sort:
+        compact = compact.sort([(LOG_FIELDS.get(field, field), direction) for field, direction in sort])
+        legacy = legacy.sort(list(sort))
+    if limit:
+        compact = compact.limit(limit)
+        legacy = legacy.limit(limit)
+
+    logs = [decode_log_entry(doc) for doc in compact]
+    legacy_logs = list(legacy)
+    if not legacy_logs:
+        return logs
+    logs += legacy_logs
+    if sort:
+        for field, direction in reversed(sort):
+            logs.sort(key=lambda log: _sort_value(log.get(field)), reverse=direction < 0)
+    return logs[:limit] if limit else logs
+
+def distinct_log_values(field, query=None):
+    """Distinct decoded values of a log field"""
+    pipeline = [{"$match": query or {}}, {"$group": {"_id": f"${field}"}}]
+    return [row["_id"] for row in aggregate_logs(pipeline)]
+
+def delete_logs(query):
+    """delete_many over both layouts"""
+    return db.device_logs.delete_many(log_match(query))
@@ -4,6 +4,8 @@ from bson import ObjectId
 from datetime import datetime, timedelta
 from pytz import timezone, utc
 import db
+from device_registry import device_registry
+from models.log_schema import aggregate_logs, find_logs, distinct_log_values, LOG_COUNT
 from flask import Response
 import csv
 import io
@@ -60,12 +62,12 @@ def apply_device_room_filters(match):
         try:
             if ObjectId.is_valid(device):
                 # If it's a valid ObjectId, find the device and add its entityId too
-                device_doc = db.devices_collection.find_one({"_id": ObjectId(device)})
+                device_doc = device_registry.get(device)
                 if device_doc and "entityId" in device_doc:
                     device_ids.append(device_doc["entityId"])
             else:
                 # If it's an entityId, find the device and add its _id too
-                device_doc = db.devices_collection.find_one({"entityId": device})
+                device_doc = device_registry.find_by_entity(device)
                 if device_doc:
                     device_ids.append(str(device_doc["_id"]))
         except Exception as e:
@@ -76,7 +78,7 @@ def apply_device_room_filters(match):
     elif room and room != 'ALL':
         # Get all devices in the specified room
         try:
-            room_devices = list(db.devices_collection.find({"roomId": ObjectId(room)}))
+            room_devices = device_registry.by_room(room)
             device_ids = []
             for d in room_devices:
                 device_ids.append(str(d["_id"]))
@@ -98,7 +100,7 @@ def apply_device_room_filters(match):
 def get_devices():
     """Get list of all devices for filtering dropdown"""
     try:
-        devices = list(db.devices_collection.find())
+        devices = device_registry.all()
         device_list = []
         seen_names = set()  # Track device names to avoid duplicates
         
@@ -152,7 +154,7 @@ def get_rooms():
 # Users List Endpoint
 @analytics_routes.route('/users', methods=['GET'])
 def get_users():
-    users = db.device_logs.distinct('user')
+    users = distinct_log_values('user')
     users = [u for u in users if u and u.strip()]
     users.sort()
     return jsonify(users)
@@ -173,10 +175,10 @@ def usage_per_user():
     if match:
         pipeline.append({"$match": match})
     pipeline += [
-        {"$group": {"_id": "$user", "action_count": {"$sum": 1}}},
+        {"$group": {"_id": "$user", "action_count": {"$sum": LOG_COUNT}}},
         {"$sort": {"action_count": -1}}
     ]
-    results = list(db.device_logs.aggregate(pipeline))
+    results = list(aggregate_logs(pipeline))
     data = [{"user": r["_id"], "actions": r["action_count"]} for r in results]
     return jsonify(data)
 
@@ -196,10 +198,10 @@ def usage_per_device():
     if match:
         pipeline.append({"$match": match})
     pipeline += [
-        {"$group": {"_id": "$device", "actions": {"$sum": 1}}},
+        {"$group": {"_id": "$device", "actions": {"$sum": LOG_COUNT}}},
         {"$sort": {"actions": -1}}
     ]
-    results = list(db.device_logs.aggregate(pipeline))
+    results = list(aggregate_logs(pipeline))
     object_ids = []
     entity_ids = []
     for r in results:
@@ -228,11 +230,11 @@ def device_actions(device_id):
         match["timestamp"] = {"$gte": start, "$lt": end}
     pipeline = [
         {"$match": match},
-        {"$group": {"_id": "$action", "count": {"$sum": 1}}},
+        {"$group": {"_id": "$action", "count": {"$sum": LOG_COUNT}}},
         {"$sort": {"count": -1}},
         {"$limit": 1}
     ]
-    result = list(db.device_logs.aggregate(pipeline))
+    result = list(aggregate_logs(pipeline))
     if not result:
         return jsonify({"action": None, "count": 0})
     return jsonify({"action": result[0]["_id"], "count": result[0]["count"]})
@@ -246,11 +248,11 @@ def user_actions(username):
         match["timestamp"] = {"$gte": start, "$lt": end}
     pipeline = [
         {"$match": match},
-        {"$group": {"_id": "$action", "count": {"$sum": 1}}},
+        {"$group": {"_id": "$action", "count": {"$sum": LOG_COUNT}}},
         {"$sort": {"count": -1}},
         {"$limit": 1}
     ]
-    result = list(db.device_logs.aggregate(pipeline))
+    result = list(aggregate_logs(pipeline))
     if not result:
         return jsonify({"action": None, "count": 0})
     return jsonify({"action": result[0]["_id"], "count": result[0]["count"]})
@@ -264,11 +266,11 @@ def device_top_actions(device_id):
         match["timestamp"] = {"$gte": start, "$lt": end}
     pipeline = [
         {"$match": match},
-        {"$group": {"_id": "$action", "count": {"$sum": 1}}},
+        {"$group": {"_id": "$action", "count": {"$sum": LOG_COUNT}}},
         {"$sort": {"count": -1}},
         {"$limit": 3}
     ]
-    result = list(db.device_logs.aggregate(pipeline))
+    result = list(aggregate_logs(pipeline))
     return jsonify([
         {"action": row["_id"], "count": row["count"]}
         for row in result
@@ -283,11 +285,11 @@ def user_top_actions(username):
         match["timestamp"] = {"$gte": start, "$lt": end}
     pipeline = [
         {"$match": match},
-        {"$group": {"_id": "$action", "count": {"$sum": 1}}},
+        {"$group": {"_id": "$action", "count": {"$sum": LOG_COUNT}}},
         {"$sort": {"count": -1}},
         {"$limit": 3}
     ]
-    result = list(db.device_logs.aggregate(pipeline))
+    result = list(aggregate_logs(pipeline))
     return jsonify([
         {"action": row["_id"], "count": row["count"]}
         for row in result
@@ -305,7 +307,7 @@ def recent_actions():
         q["user"] = user
     # Apply device/room filters
     q = apply_device_room_filters(q)
-    logs = list(db.device_logs.find(q).sort("timestamp", -1).limit(20))
+    logs = find_logs(q, sort=[("timestamp", -1)], limit=20)
     object_ids = set()
     entity_ids = set()
     for log in logs:
@@ -383,13 +385,13 @@ def usage_per_hour():
         q["user"] = user
     # Apply device/room filters
     q = apply_device_room_filters(q)
-    logs = list(db.device_logs.find(q))
+    logs = find_logs(q)
     hour_counts = [0] * 24
     for log in logs:
         ts = log.get("timestamp")
         if ts:
             local_hour = ts.astimezone(irl).hour
-            hour_counts[local_hour] += 1
+            hour_counts[local_hour] += log.get("count", 1)
     data = [{"hour": h, "actions": hour_counts[h]} for h in range(24)]
     return jsonify(data)
 
@@ -420,7 +422,7 @@ def actions_in_hour(hour):
                 end_utc = end_local.astimezone(utc)
                 q = {"timestamp": {"$gte": start_utc, "$lt": end_utc}}
                 q = add_user_filter(q)
-                day_logs = list(db.device_logs.find(q).sort("timestamp", 1))
+                day_logs = find_logs(q, sort=[("timestamp", 1)])
                 day_logs = [
                     log for log in day_logs
                     if log.get("timestamp") and log["timestamp"].astimezone(irl).hour == hour
@@ -438,7 +440,7 @@ def actions_in_hour(hour):
             end_utc = end_local.astimezone(utc)
             q = {"timestamp": {"$gte": start_utc, "$lt": end_utc}}
             q = add_user_filter(q)
-            logs = list(db.device_logs.find(q).sort("timestamp", 1))
+            logs = find_logs(q, sort=[("timestamp", 1)])
             logs = [
                 log for log in logs
                 if log.get("timestamp") and log["timestamp"].astimezone(irl).hour == hour
@@ -454,7 +456,7 @@ def actions_in_hour(hour):
         end_utc = end_local.astimezone(utc)
         q = {"timestamp": {"$gte": start_utc, "$lt": end_utc}}
         q = add_user_filter(q)
-        logs = list(db.device_logs.find(q).sort("timestamp", 1))
+        logs = find_logs(q, sort=[("timestamp", 1)])
         logs = [
             log for log in logs
             if log.get("timestamp") and log["timestamp"].astimezone(irl).hour == hour
@@ -537,14 +539,14 @@ def export_usage_csv():
     # Apply device/room filters
     query = apply_device_room_filters(query)
 
-    logs = list(db.device_logs.find(query).sort('timestamp', 1))
+    logs = find_logs(query, sort=[("timestamp", 1)])
     
     if not logs:
         return jsonify({"error": "No logs found for the selected date or range."}), 404
 
     # Build device lookup for friendly names
     try:
-        all_devices = list(db.devices_collection.find({}))
+        all_devices = device_registry.all()
     except Exception:
         all_devices = []
     
@@ -623,7 +625,7 @@ def usage_per_week():
         {
             "$group": {
                 "_id": "$week",
-                "actions": {"$sum": 1},
+                "actions": {"$sum": LOG_COUNT},
                 "year": {"$first": "$year"},
                 "weekNum": {"$first": "$weekNum"}
             }
@@ -631,7 +633,7 @@ def usage_per_week():
         {"$sort": {"year": 1, "weekNum": 1}}
     ]
     
-    results = list(db.device_logs.aggregate(pipeline))
+    results = list(aggregate_logs(pipeline))
     
     # Format the results with readable week labels
     data = []
@@ -690,7 +692,7 @@ def usage_per_month():
         {
             "$group": {
                 "_id": "$month",
-                "actions": {"$sum": 1},
+                "actions": {"$sum": LOG_COUNT},
                 "year": {"$first": "$year"},
                 "monthNum": {"$first": "$monthNum"}
             }
@@ -698,7 +700,7 @@ def usage_per_month():
         {"$sort": {"year": 1, "monthNum": 1}}
     ]
     
-    results = list(db.device_logs.aggregate(pipeline))
+    results = list(aggregate_logs(pipeline))
     
     # Format the results with readable month labels
     month_names = [
@@ -752,13 +754,13 @@ def export_usage_csv_grouped():
 
     if group_by == 'day':
         # Use existing logic for daily export
-        logs = list(db.device_logs.find(query).sort('timestamp', 1))
+        logs = find_logs(query, sort=[("timestamp", 1)])
         
         if not logs:
             return jsonify({"error": "No logs found for the selected criteria."}), 404
 
         # Build device lookup
-        all_devices = list(db.devices_collection.find({}))
+        all_devices = device_registry.all()
         device_lookup = {}
         for d in all_devices:
             device_lookup[str(d["_id"])] = d.get("name", str(d["_id"]))
@@ -822,19 +824,19 @@ def export_usage_csv_grouped():
                         "user": "$user",
                         "device": "$device"
                     },
-                    "actions": {"$sum": 1}
+                    "actions": {"$sum": LOG_COUNT}
                 }
             },
             {"$sort": {"_id.period": 1, "_id.user": 1, "_id.device": 1}}
         ]
         
-        results = list(db.device_logs.aggregate(pipeline))
+        results = list(aggregate_logs(pipeline))
         
         if not results:
             return jsonify({"error": "No logs found for the selected criteria."}), 404
         
         # Build device lookup
-        all_devices = list(db.devices_collection.find({}))
+        all_devices = device_registry.all()
         device_lookup = {}
         for d in all_devices:
             device_lookup[str(d["_id"])] = d.get("name", str(d["_id"]))
@@ -927,7 +929,7 @@ def week_breakdown(week_id):
                         "user": "$user",
                         "device": "$device"
                     },
-                    "actions": {"$sum": 1}
+                    "actions": {"$sum": LOG_COUNT}
                 }
             },
             {
@@ -941,10 +943,10 @@ def week_breakdown(week_id):
             {"$sort": {"_id": 1}}
         ]
         
-        results = list(db.device_logs.aggregate(pipeline))
+        results = list(aggregate_logs(pipeline))
         
         # Build device lookup for friendly names
-        all_devices = list(db.devices_collection.find({}))
+        all_devices = device_registry.all()
         device_lookup = {}
         for d in all_devices:
             device_lookup[str(d["_id"])] = d.get("name", str(d["_id"]))
@@ -1029,7 +1031,7 @@ def month_breakdown(month_id):
                         "user": "$user",
                         "device": "$device"
                     },
-                    "actions": {"$sum": 1}
+                    "actions": {"$sum": LOG_COUNT}
                 }
             },
             {
@@ -1043,10 +1045,10 @@ def month_breakdown(month_id):
             {"$sort": {"_id": 1}}
         ]
         
-        results = list(db.device_logs.aggregate(pipeline))
+        results = list(aggregate_logs(pipeline))
         
         # Build device lookup for friendly names
-        all_devices = list(db.devices_collection.find({}))
+        all_devices = device_registry.all()
         device_lookup = {}
         for d in all_devices:
             device_lookup[str(d["_id"])] = d.get("name", str(d["_id"]))
@@ -1118,7 +1120,7 @@ def daily_breakdown(date_str):
                         "user": "$user",
                         "device": "$device"
                     },
-                    "actions": {"$sum": 1}
+                    "actions": {"$sum": LOG_COUNT}
                 }
             },
             {
@@ -1132,10 +1134,10 @@ def daily_breakdown(date_str):
             {"$sort": {"_id": 1}}
         ]
         
-        results = list(db.device_logs.aggregate(pipeline))
+        results = list(aggregate_logs(pipeline))
         
         # Build device lookup for friendly names
-        all_devices = list(db.devices_collection.find({}))
+        all_devices = device_registry.all()
         device_lookup = {}
         for d in all_devices:
             device_lookup[str(d["_id"])] = d.get("name", str(d["_id"]))
@@ -1217,13 +1219,13 @@ def usage_per_day():
         {
             "$group": {
                 "_id": "$date",
-                "actions": {"$sum": 1}
+                "actions": {"$sum": LOG_COUNT}
             }
         },
         {"$sort": {"_id": 1}}
     ]
     
-    results = list(db.device_logs.aggregate(pipeline))
+    results = list(aggregate_logs(pipeline))
     
     # Format the results
     data = []
@@ -1262,11 +1264,11 @@ def errors_per_device():
     if match:
         pipeline.append({"$match": match})
     pipeline += [
-        {"$group": {"_id": "$device", "errors": {"$sum": 1}, "error_types": {"$addToSet": "$error_type"}}},
+        {"$group": {"_id": "$device", "errors": {"$sum": LOG_COUNT}, "error_types": {"$addToSet": "$error_type"}}},
         {"$sort": {"errors": -1}}
     ]
     
-    results = list(db.device_logs.aggregate(pipeline))
+    results = list(aggregate_logs(pipeline))
     
     # Get device names
     object_ids = []
@@ -1315,11 +1317,11 @@ def errors_per_user():
     if match:
         pipeline.append({"$match": match})
     pipeline += [
-        {"$group": {"_id": "$user", "errors": {"$sum": 1}, "error_types": {"$addToSet": "$error_type"}}},
+        {"$group": {"_id": "$user", "errors": {"$sum": LOG_COUNT}, "error_types": {"$addToSet": "$error_type"}}},
         {"$sort": {"errors": -1}}
     ]
     
-    results = list(db.device_logs.aggregate(pipeline))
+    results = list(aggregate_logs(pipeline))
     data = [{"user": r["_id"], "errors": r["errors"], "error_types": [et for et in r["error_types"] if et]} for r in results]
     return jsonify(data)
 
@@ -1342,11 +1344,11 @@ def error_types():
     if match:
         pipeline.append({"$match": match})
     pipeline += [
-        {"$group": {"_id": "$error_type", "count": {"$sum": 1}}},
+        {"$group": {"_id": "$error_type", "count": {"$sum": LOG_COUNT}}},
         {"$sort": {"count": -1}}
     ]
     
-    results = list(db.device_logs.aggregate(pipeline))
+    results = list(aggregate_logs(pipeline))
     data = [{"error_type": r["_id"], "count": r["count"]} for r in results]
     return jsonify(data)
 
@@ -1365,7 +1367,7 @@ def recent_errors():
     # Apply device/room filters
     q = apply_device_room_filters(q)
     
-    logs = list(db.device_logs.find(q).sort("timestamp", -1).limit(10))
+    logs = find_logs(q, sort=[("timestamp", -1)], limit=10)
     
     # Get device names
     object_ids = set()
@@ -1409,6 +1411,8 @@ def recent_errors():
             "result": log.get("result", ""),
             "error_type": log.get("error_type", "unknown"),
             "timestamp": log.get("timestamp").isoformat() if log.get("timestamp") else "",
+            "count": log.get("count", 1),
+            "last_timestamp": log["last_timestamp"].isoformat() if log.get("last_timestamp") else None,
         })
     
     return jsonify(errors)
@@ -1433,7 +1437,7 @@ def device_health():
     if match:
         total_pipeline.append({"$match": match})
     total_pipeline += [
-        {"$group": {"_id": "$device", "total_actions": {"$sum": 1}}},
+        {"$group": {"_id": "$device", "total_actions": {"$sum": LOG_COUNT}}},
     ]
     
     # Get error actions per device
@@ -1442,11 +1446,11 @@ def device_health():
     if error_match:
         error_pipeline.append({"$match": error_match})
     error_pipeline += [
-        {"$group": {"_id": "$device", "error_actions": {"$sum": 1}}},
+        {"$group": {"_id": "$device", "error_actions": {"$sum": LOG_COUNT}}},
     ]
     
-    total_results = list(db.device_logs.aggregate(total_pipeline))
-    error_results = list(db.device_logs.aggregate(error_pipeline))
+    total_results = list(aggregate_logs(total_pipeline))
+    error_results = list(aggregate_logs(error_pipeline))
     
     # Create error map
     error_map = {r["_id"]: r["error_actions"] for r in error_results}
@@ -1624,12 +1628,7 @@ def get_active_users_streaks():
         apply_device_room_filters(match)
         
         # Get all user actions within the date range
-        actions = list(db.device_logs.find(match, {
-            'user': 1, 
-            'timestamp': 1,
-            'device_name': 1,
-            'action': 1
-        }).sort('timestamp', 1))
+        actions = find_logs(match, sort=[('timestamp', 1)])
         
         if not actions:
             return jsonify([])
@@ -1650,7 +1649,7 @@ def get_active_users_streaks():
                 # Convert to date string for grouping
                 date_str = timestamp.strftime('%Y-%m-%d')
                 user_activity[user]['active_dates'].add(date_str)
-                user_activity[user]['total_actions'] += 1
+                user_activity[user]['total_actions'] += action.get('count', 1)
                 
                 # Track first and last activity
                 if not user_activity[user]['first_activity'] or timestamp < user_activity[user]['first_activity']:
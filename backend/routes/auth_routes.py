@@ -84,8 +84,9 @@ def register():
         print(f"New user created with ID: {user_id}")
         
         # Create tokens
-        access_token = create_access_token(identity=user_id)
-        refresh_token = create_refresh_token(identity=user_id)
+        claims = {'username': username}
+        access_token = create_access_token(identity=user_id, additional_claims=claims)
+        refresh_token = create_refresh_token(identity=user_id, additional_claims=claims)
         print(f"Tokens created for new user")
         
         # Store refresh token
@@ -137,9 +138,11 @@ def login():
     
     user_id = str(user['_id'])
     
-    # Create tokens
-    access_token = create_access_token(identity=user_id)
-    refresh_token = create_refresh_token(identity=user_id)
+    # Create tokens, carrying the username so request handlers need no user lookup
+    claims = {'username': user['username']}
+    access_token = create_access_token(identity=user_id, additional_claims=claims)
+    refresh_token = create_refresh_token(identity=user_id, additional_claims=claims)
+    db.cache_username(user_id, user['username'])
     
     # Store refresh token
     expires_at = datetime.now(timezone.utc) + JWT_REFRESH_TOKEN_EXPIRES
@@ -165,8 +168,10 @@ def refresh_token():
     # Get JWT ID from token
     jti = get_jwt()["jti"]
     
-    # Create new access token
-    access_token = create_access_token(identity=user_id)
+    # Create new access token, keeping the username claim (older refresh tokens lack it)
+    username = get_jwt().get('username') or db.find_username_by_id(user_id)
+    claims = {'username': username} if username else {}
+    access_token = create_access_token(identity=user_id, additional_claims=claims)
     
     return jsonify({
         'access_token': access_token
@@ -272,6 +277,7 @@ def update_current_user():
             {"_id": ObjectId(user_id)},
             {"$set": update_data}
         )
+        db.invalidate_username(user_id)
         
         return jsonify({'message': 'User updated successfully'}), 200
     
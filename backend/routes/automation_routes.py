@@ -1,22 +1,35 @@
 from flask import Blueprint, jsonify, request
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from bson import ObjectId
-from db import automations_collection, devices_collection, find_user_by_id
-from scheduler import schedule_automations
+from db import automations_collection, devices_collection, find_user_by_id, automation_executions_collection
+from scheduler import sync_automation, remove_automation_job, get_scheduler_stats, get_scheduler_leader
+from automation_triggers import parse_state_trigger
+from automation_simulator import simulate_automations, parse_simulation_window
+from etags import conditional_listing, invalidate_listing
 
 automation_routes = Blueprint('automations', __name__)
 
+def serialize_ids(value):
+    """Convert ObjectIds anywhere in a document (e.g. action.deviceId) to strings"""
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, dict):
+        return {key: serialize_ids(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [serialize_ids(item) for item in value]
+    return value
+
+def format_automation(automation):
+    automation = serialize_ids(automation)
+    automation['id'] = automation.pop('_id')
+    return automation
+
 @automation_routes.route('/', methods=['GET'])
 @jwt_required()
+@conditional_listing("automations")
 def get_automations():
     try:
-        automations = list(automations_collection.find())
-        for automation in automations:
-            automation['id'] = str(automation['_id'])
-            if 'deviceId' in automation and isinstance(automation['deviceId'], ObjectId):
-                automation['deviceId'] = str(automation['deviceId'])
-            del automation['_id']
-        return jsonify(automations)
+        return jsonify([format_automation(automation) for automation in automations_collection.find()])
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -32,6 +45,10 @@ def create_automation():
         if not all(field in data for field in required_fields):
             return jsonify({"error": "Missing required fields"}), 400
 
+        _, error = parse_state_trigger(data)
+        if error:
+            return jsonify({"error": error}), 400
+
         if 'deviceId' in data and isinstance(data['deviceId'], str):
             try:
                 data['deviceId'] = ObjectId(data['deviceId'])
@@ -47,14 +64,12 @@ def create_automation():
         }
 
         result = automations_collection.insert_one(new_automation)
+        invalidate_listing("automations")
 
-        # Reschedule automations after updating
-        schedule_automations()
+        # Schedule just this automation's job
+        sync_automation(result.inserted_id)
 
-        new_automation['id'] = str(result.inserted_id)
-        del new_automation['_id']
-
-        return jsonify(new_automation), 201
+        return jsonify(format_automation(new_automation)), 201
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -73,19 +88,24 @@ def update_automation(automation_id):
             except Exception:
                 return jsonify({"error": "Invalid deviceId format"}), 400
 
+        if 'type' in data or 'condition' in data:
+            existing = automations_collection.find_one({"_id": ObjectId(automation_id)})
+            _, error = parse_state_trigger({**(existing or {}), **data})
+            if error:
+                return jsonify({"error": error}), 400
+
         result = automations_collection.update_one(
             {"_id": ObjectId(automation_id)},
             {"$set": data}
         )
+        invalidate_listing("automations")
 
         if result.modified_count:
-            # Reschedule automations after updating
-            schedule_automations()
+            # Reschedule just this automation's job
+            sync_automation(automation_id)
 
             automation = automations_collection.find_one({"_id": ObjectId(automation_id)})
-            automation['id'] = str(automation['_id'])
-            del automation['_id']
-            return jsonify(automation)
+            return jsonify(format_automation(automation))
         return jsonify({"error": "Automation not found"}), 404
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -97,8 +117,9 @@ def delete_automation(automation_id):
     try:
         result = automations_collection.delete_one({"_id": ObjectId(automation_id)})
         if result.deleted_count:
-            # Reschedule automations after deleting
-            schedule_automations()
+            invalidate_listing("automations")
+            # Remove just this automation's job
+            remove_automation_job(automation_id)
 
             return jsonify({"message": "Automation deleted successfully"}), 200
         return jsonify({"error": "Automation not found"}), 404
@@ -119,7 +140,72 @@ def toggle_automation(automation_id):
             {"_id": ObjectId(automation_id)},
             {"$set": {"enabled": new_state}}
         )
+        invalidate_listing("automations")
+        sync_automation(automation_id)
 
         return jsonify({"enabled": new_state}), 200
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
\ No newline at end of file
+        return jsonify({"error": str(e)}), 500
+
+@automation_routes.route('/simulate', methods=['POST'])
+@jwt_required()
+def simulate_automation_window():
+    """
+    Dry-run automations over a time window without touching any device.
+    Body: {"start": iso, "end": iso} or {"days": 30}, plus optional draft
+    "automations": entries with an "id" replace that automation, others are
+    added. With "draftsOnly": true only the drafts are simulated.
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        start, end, error = parse_simulation_window(data)
+        if error:
+            return jsonify({"error": error}), 400
+
+        drafts = data.get('automations', [])
+        if not isinstance(drafts, list):
+            return jsonify({"error": "automations must be a list"}), 400
+
+        automations = {} if data.get('draftsOnly') else {
+            str(automation['_id']): automation for automation in automations_collection.find()
+        }
+        for index, draft in enumerate(drafts):
+            if not isinstance(draft, dict):
+                return jsonify({"error": "Each draft automation must be an object"}), 400
+            draft_id = str(draft.get('id') or f"draft-{index}")
+            automations[draft_id] = {**automations.get(draft_id, {}), **draft, "_id": draft_id}
+
+        return jsonify(simulate_automations(list(automations.values()), start, end)), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@automation_routes.route('/<automation_id>/executions', methods=['GET'])
+@jwt_required()
+def get_automation_executions(automation_id):
+    """Most recent runs of an automation: outcome, trigger and batch latency"""
+    try:
+        limit = min(max(request.args.get('limit', 50, type=int), 1), 500)
+        executions = automation_executions_collection.find(
+            {"automation_id": automation_id}, {"_id": 0}
+        ).sort("executed_at", -1).limit(limit)
+        return jsonify([
+            {**execution, "executed_at": execution["executed_at"].isoformat()}
+            for execution in executions
+        ]), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@automation_routes.route('/scheduler/stats', methods=['GET'])
+@jwt_required()
+def get_automation_scheduler_stats():
+    """Job counts and time spent keeping the scheduler in sync with automations"""
+    return jsonify(get_scheduler_stats()), 200
+
+@automation_routes.route('/scheduler/leader', methods=['GET'])
+@jwt_required()
+def get_automation_scheduler_leader():
+    """Which process currently owns scheduling (holds the scheduler lease)"""
+    try:
+        return jsonify(get_scheduler_leader()), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
@@ -1,25 +1,37 @@
 import os
+import threading
+import time
 import requests
 import db
 from flask import Blueprint, jsonify, request
 from bson import ObjectId
 from bson.errors import InvalidId
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pymongo import UpdateOne, ReturnDocument
 from db import devices_collection, rooms_collection
 from dotenv import load_dotenv
-from models.device_log import log_device_action
-from flask_jwt_extended import get_jwt_identity, jwt_required 
-
-# Helper function to get user identity, defaulting to "system" if JWT is not available
+from models.device_log import log_device_action, build_log_entry, log_device_actions, device_log_writer
+from etags import conditional_listing
+from coalescer import CommandCoalescer
+from device_registry import device_registry
+from config import (
+    COMMAND_COALESCE_WINDOW, OPTIMISTIC_TOGGLES, WRITE_BEHIND_MAX_WORKERS,
+    DIAGNOSTIC_JOB_MAX_WORKERS, DIAGNOSTIC_JOB_QUEUE_LIMIT
+)
+from flask_jwt_extended import get_jwt_identity, get_jwt, jwt_required 
+
+# Helper function to get user identity, defaulting to "system" if JWT is not available.
+# Tokens carry the username as a claim; older tokens fall back to the cached lookup.
 def get_user_identity():
     try:
         user_id = get_jwt_identity()
         if not user_id:
             return "system"
-        user = db.find_user_by_id(user_id)
-        if user and 'username' in user:
-            return user['username']
-        else:
-            return "unknown"
+        username = get_jwt().get('username')
+        if username:
+            return username
+        return db.find_username_by_id(user_id) or "unknown"
     except Exception:
         return "system"
 
@@ -39,6 +51,21 @@ device_routes = Blueprint('devices', __name__)
 HOME_ASSISTANT_URL = os.getenv("HOME_ASSISTANT_URL")
 HOME_ASSISTANT_TOKEN = os.getenv("HOME_ASSISTANT_TOKEN")
 
+# Merges rapid toggles / setpoint changes for the same device into one execution
+command_coalescer = CommandCoalescer(COMMAND_COALESCE_WINDOW)
+
+# Background pool confirming optimistic (write-behind) toggles with Home Assistant
+write_behind_executor = ThreadPoolExecutor(max_workers=WRITE_BEHIND_MAX_WORKERS, thread_name_prefix="write-behind")
+
+# Background pool for slow diagnostics (reset, connectivity test); the semaphore
+# bounds queued + running jobs so a burst cannot pile up unbounded work
+diagnostics_executor = ThreadPoolExecutor(max_workers=DIAGNOSTIC_JOB_MAX_WORKERS, thread_name_prefix="diagnostics")
+device_job_slots = threading.BoundedSemaphore(DIAGNOSTIC_JOB_QUEUE_LIMIT)
+
+# Upper bound on concurrent Home Assistant calls made by a single bulk request
+BULK_COMMAND_MAX_WORKERS = 8
+BULK_POWER_COMMANDS = ("toggle", "turn_on", "turn_off")
+
 # Fetch the current state of a device from Home Assistant
 def get_homeassistant_state(entity_id):
     """
@@ -67,30 +94,133 @@ def get_homeassistant_state(entity_id):
         print(f"Error fetching Home Assistant state: {str(e)}")
         return False
 
+# Fetch the full state object of a Home Assistant entity
+def get_homeassistant_state_data(entity_id, timeout=2):
+    """Returns the entity's state object, or None if it could not be fetched"""
+    url = f"{HOME_ASSISTANT_URL}/api/states/{entity_id}"
+    headers = {
+        "Authorization": f"Bearer {HOME_ASSISTANT_TOKEN}",
+        "Content-Type": "application/json"
+    }
+    try:
+        response = requests.get(url, headers=headers, timeout=timeout)
+    except requests.exceptions.RequestException as e:
+        print(f"Error fetching Home Assistant state: {str(e)}")
+        return None
+    if response.status_code != 200:
+        print(f" Warning: Could not fetch state for {entity_id}. HTTP {response.status_code}")
+        return None
+    return response.json()
+
+# Fetch all entity states from Home Assistant in one request
+def get_homeassistant_states(timeout=3):
+    """
+    Returns a dict of entity_id -> state object from Home Assistant's /api/states.
+    Raises on connection errors or non-200 responses so callers can report them.
+    """
+    url = f"{HOME_ASSISTANT_URL}/api/states"
+    headers = {
+        "Authorization": f"Bearer {HOME_ASSISTANT_TOKEN}",
+        "Content-Type": "application/json"
+    }
+    response = requests.get(url, headers=headers, timeout=timeout)
+    response.raise_for_status()
+    return {state["entity_id"]: state for state in response.json() if "entity_id" in state}
+
+def ha_state_is_on(entity_id, state):
+    """Whether a Home Assistant state means the device is on"""
+    if entity_id.split('.', 1)[0] == "climate":
+        # Climate entities report their HVAC mode (heat, cool, auto, ...) rather than "on"
+        return state not in ("off", "unavailable")
+    return state == "on"
+
+# isOn of an entity from the states a Home Assistant service call changed
+def get_reported_is_on(ha_response, entity_id):
+    """Returns None when the response does not include the entity's new state"""
+    try:
+        states = ha_response.json()
+    except ValueError:
+        return None
+    if not isinstance(states, list):
+        return None
+    for state in states:
+        if isinstance(state, dict) and state.get("entity_id") == entity_id:
+            return ha_state_is_on(entity_id, state.get("state"))
+    return None
+
+# Format a device document for the device list responses
+def format_device(device):
+    formatted_device = {
+        'id': str(device['_id']),
+        'name': device['name'],
+        'type': device['type'],
+        'isOn': device['isOn']
+    }
+
+    if 'roomId' in device:
+        formatted_device['roomId'] = str(device['roomId'])
+    if 'temperature' in device:
+        formatted_device['temperature'] = device['temperature']
+    if 'isHomeAssistant' in device:
+        formatted_device['isHomeAssistant'] = device['isHomeAssistant']
+    if 'entityId' in device:
+        formatted_device['entityId'] = device['entityId']
+    return formatted_device
+
+def get_device_listing():
+    """
+    Return (every formatted device, change version to poll from next).
+    The version is the safe mark taken before the query (see
+    db.device_version_marks), so writes still landing are picked up later.
+    """
+    _, version = db.device_version_marks()
+    devices = list(devices_collection.find())
+    return [format_device(device) for device in devices], version
+
+def get_device_changes(since):
+    """
+    Return devices changed and deleted after the given change version.
+    Devices changed close to the returned version may be sent again by the
+    next poll; clients merge them by id.
+    """
+    _, version = db.device_version_marks()
+    changed = list(devices_collection.find({"version": {"$gt": since}}))
+    deleted = list(db.device_tombstones_collection.find({"version": {"$gt": since}}, {"_id": 1}))
+    return {
+        "version": max(since, version),
+        "changed": [format_device(device) for device in changed],
+        "deleted": [str(tombstone['_id']) for tombstone in deleted]
+    }
+
+def settled_device_version():
+    """
+    Latest device change version for the listing ETag, or None while a write
+    stamped below it may still land (a 304 for it would then be stale for good)
+    """
+    latest, safe = db.device_version_marks()
+    return latest if latest == safe else None
+
 @device_routes.route('/', methods=['GET'])
+@conditional_listing("devices", version=settled_device_version)
 def get_devices():
+    """
+    List devices. With ?since=<version> only devices changed or deleted
+    after that version are returned, together with the new version.
+    """
     try:
-        devices = list(devices_collection.find())
-        formatted_devices = []
-        for device in devices:
-            formatted_device = {
-                'id': str(device['_id']),
-                'name': device['name'],
-                'type': device['type'],
-                'isOn': device['isOn']
-            }
-            
-            if 'roomId' in device:
-                formatted_device['roomId'] = str(device['roomId'])
-            if 'temperature' in device:
-                formatted_device['temperature'] = device['temperature']
-            if 'isHomeAssistant' in device:
-                formatted_device['isHomeAssistant'] = device['isHomeAssistant']
-            if 'entityId' in device:
-                formatted_device['entityId'] = device['entityId']
-            formatted_devices.append(formatted_device)
-            
-        return jsonify(formatted_devices)
+        since = request.args.get('since')
+        if since is not None:
+            try:
+                since = int(since)
+            except ValueError:
+                return jsonify({"error": "since must be an integer version"}), 400
+            return jsonify(get_device_changes(since))
+
+        formatted_devices, version = get_device_listing()
+
+        response = jsonify(formatted_devices)
+        response.headers['X-Devices-Version'] = str(version)
+        return response
     except Exception as e:
         # DEBUG - print(f"Error: {str(e)}")  # Debug log
         return jsonify({"error": str(e)}), 500
@@ -141,14 +271,14 @@ def add_device():
             "isOn": is_on,  # Ensure boolean
             "isHomeAssistant": bool(data.get('isHomeAssistant', False)),  # Ensure boolean
             "entityId": str(data['entityId']) if 'entityId' in data and data['entityId'] else None,  
-            "attributes": data['attributes'] if isinstance(data.get('attributes'), dict) else {},  
+            "attributes": data['attributes'] if isinstance(data.get('attributes'), dict) else {}
         }
 
         # Format response
         # DEBUG - print(" Processed device before insert:", new_device)
 
-        result = devices_collection.insert_one(new_device)
-        inserted_device = devices_collection.find_one({"_id": result.inserted_id})
+        inserted_device = devices_collection.find_one({"_id": db.insert_device(new_device)})
+        device_registry.upsert(inserted_device)
 
         # DEBUG - print(" Inserted device in MongoDB:", inserted_device)
 
@@ -188,81 +318,204 @@ def add_device():
         # DEBUG - print(f" Error: {str(e)}")
         return jsonify({"error": "Failed to add device"}), 500
 
-@device_routes.route('/<device_id>/toggle', methods=['POST'])
-@jwt_required()
-def toggle_device(device_id):
-    # Get the user identity from JWT
-    user = get_user_identity() 
+# Log an action once for every user whose commands were coalesced into it
+def log_for_users(users, **kwargs):
+    for user in dict.fromkeys(users):
+        safe_log_device_action(user=user, **kwargs)
+
+# Apply the net result of one or more coalesced toggles (one per entry in
+# users), returning (body, status)
+def apply_toggle(users, device_id, device_obj_id):
+    device = device_registry.get(device_obj_id)
+
+    if not device:
+        # DEBUG - print(f" Device {device_id} not found")
+        # Log the error for device not found
+        log_for_users(
+            users,
+            device=device_id,
+            action="toggle",
+            result="error: device not found",
+            is_error=True,
+            error_type="device_not_found"
+        )
+        return {"error": "Device not found"}, 404
 
-    try:
-        device_obj_id = ObjectId(device_id)
-        device = devices_collection.find_one({"_id": device_obj_id})
+    # An even number of coalesced toggles leaves the device as it is
+    changed = len(users) % 2 == 1
 
-        if not device:
-            # DEBUG - print(f" Device {device_id} not found")
-            # Log the error for device not found
-            safe_log_device_action(
-                user=user,
-                device=device_id,
+    if changed and device.get('isHomeAssistant'):
+        entity_id = device["entityId"]
+        # Home Assistant flips the entity itself; the cached isOn may be stale
+        # when another worker changed the device a moment ago
+        ha_payload = {"entity_id": entity_id}
+        ha_headers = {
+            "Authorization": f"Bearer {HOME_ASSISTANT_TOKEN}",
+            "Content-Type": "application/json"
+        }
+        ha_url = f"{HOME_ASSISTANT_URL}/api/services/{entity_id.split('.', 1)[0]}/toggle"
+        ha_response = requests.post(ha_url, json=ha_payload, headers=ha_headers, timeout=2)
+
+        if ha_response.status_code != 200:
+            # Log the Home Assistant error
+            # DEBUG - print(f" Home Assistant error for {entity_id}: {ha_response.text}")
+            log_for_users(
+                users,
+                device=entity_id,
                 action="toggle",
-                result="error: device not found",
+                result=f"error: Home Assistant error {ha_response.text}",
                 is_error=True,
-                error_type="device_not_found"
+                error_type="home_assistant_error"
             )
-            return jsonify({"error": "Device not found"}), 404
-
-        new_state = not device.get('isOn', False)
+            return {"error": f"Home Assistant error: {ha_response.text}"}, ha_response.status_code
 
-        if device.get('isHomeAssistant'):
-            entity_id = device["entityId"]
-            ha_service = "turn_on" if new_state else "turn_off"
-            ha_payload = {"entity_id": entity_id}
-            ha_headers = {
-                "Authorization": f"Bearer {HOME_ASSISTANT_TOKEN}",
-                "Content-Type": "application/json"
-            }
-            ha_url = f"{HOME_ASSISTANT_URL}/api/services/light/{ha_service}"
-            ha_response = requests.post(ha_url, json=ha_payload, headers=ha_headers, timeout=2)
-
-            if ha_response.status_code != 200:
-                # Log the Home Assistant error
-                # DEBUG - print(f" Home Assistant error for {entity_id}: {ha_response.text}")
-                safe_log_device_action(
-                    user=user,
-                    device=entity_id,
-                    action="toggle",
-                    result=f"error: Home Assistant error {ha_response.text}",
-                    is_error=True,
-                    error_type="home_assistant_error"
-                )
-                return jsonify({"error": f"Home Assistant error: {ha_response.text}"}), ha_response.status_code
-
-        # Update the local database
-        devices_collection.update_one(
-            {"_id": device_obj_id},
-            {"$set": {"isOn": new_state}}
-        )
+        # Record the state Home Assistant reports, or flip ours atomically like it did
+        device = db.set_device_power(device_obj_id, get_reported_is_on(ha_response, entity_id))
+    elif changed:
+        # Local devices flip atomically, so concurrent toggles never lose an update
+        device = db.set_device_power(device_obj_id)
 
-        updated_device = {
-            "id": device_id,
-            "name": device["name"],
-            "type": device["type"],
-            "roomId": str(device.get("roomId")) if device.get("roomId") else None,
-            "isOn": new_state,
-            "isHomeAssistant": device.get("isHomeAssistant", False),
-            "entityId": device.get("entityId", None),
-            "attributes": device.get("attributes", {})
-        }
+    if changed:
+        if not device:
+            return {"error": "Device not found"}, 404
+        device_registry.upsert(device)
+    new_state = device.get('isOn', False)
+
+    updated_device = {
+        "id": device_id,
+        "name": device["name"],
+        "type": device["type"],
+        "roomId": str(device.get("roomId")) if device.get("roomId") else None,
+        "isOn": new_state,
+        "isHomeAssistant": device.get("isHomeAssistant", False),
+        "entityId": device.get("entityId", None),
+        "attributes": device.get("attributes", {})
+    }
 
-        # If the device is Home Assistant, update its state
+    # If the device is Home Assistant, update its state
+    log_for_users(
+        users,
+        device=device.get("entityId") if device.get("isHomeAssistant") else device_id,
+        action="toggle",
+        result="on" if new_state else "off"
+    )
+
+    return updated_device, 200
+
+# Flip a device in Mongo right away and confirm with Home Assistant in the background
+def apply_toggle_optimistic(user, device_id, device_obj_id):
+    command_id = ObjectId()
+
+    # Atomic flip; Home Assistant devices are marked with the pending command
+    device = devices_collection.find_one_and_update(
+        {"_id": device_obj_id},
+        [{"$set": {
+            "isOn": {"$not": [{"$ifNull": ["$isOn", False]}]},
+            "version": db.DEVICE_VERSION,
+            "pendingCommand": {"$cond": [{"$eq": ["$isHomeAssistant", True]}, command_id, "$$REMOVE"]}
+        }}],
+        return_document=ReturnDocument.AFTER
+    )
+
+    if not device:
         safe_log_device_action(
             user=user,
-            device=device.get("entityId") if device.get("isHomeAssistant") else device_id,
+            device=device_id,
             action="toggle",
-            result="on" if new_state else "off"
+            result="error: device not found",
+            is_error=True,
+            error_type="device_not_found"
         )
+        return {"error": "Device not found"}, 404
+
+    device_registry.upsert(device)
+    new_state = device["isOn"]
+    updated_device = {
+        "id": device_id,
+        "name": device["name"],
+        "type": device["type"],
+        "roomId": str(device.get("roomId")) if device.get("roomId") else None,
+        "isOn": new_state,
+        "isHomeAssistant": device.get("isHomeAssistant", False),
+        "entityId": device.get("entityId", None),
+        "attributes": device.get("attributes", {})
+    }
 
-        return jsonify(updated_device), 200
+    # Local devices have nothing to confirm
+    if not device.get('isHomeAssistant'):
+        safe_log_device_action(user=user, device=device_id, action="toggle", result="on" if new_state else "off")
+        return {"status": "confirmed", "device": updated_device}, 200
+
+    db.device_commands_collection.insert_one({
+        "_id": command_id,
+        "device_id": device_obj_id,
+        "command": "toggle",
+        "desired_state": new_state,
+        "status": "pending",
+        "user": user,
+        "created_at": datetime.now(timezone.utc)
+    })
+    write_behind_executor.submit(confirm_optimistic_toggle, user, command_id, device, new_state)
+
+    return {"status": "pending", "commandId": str(command_id), "device": updated_device}, 202
+
+def confirm_optimistic_toggle(user, command_id, device, new_state):
+    """Send a write-behind toggle to Home Assistant, then finalize or roll it back"""
+    entity_id = device["entityId"]
+    try:
+        ha_service = "turn_on" if new_state else "turn_off"
+        ok, error = send_homeassistant_command(entity_id.split('.', 1)[0], ha_service, {"entity_id": entity_id})
+
+        # Only touch the device if no later command has replaced ours
+        pending_filter = {"_id": device["_id"], "pendingCommand": command_id}
+        if ok:
+            if devices_collection.update_one(pending_filter, {"$unset": {"pendingCommand": ""}}).modified_count:
+                device_registry.apply(device["_id"], {}, unset=("pendingCommand",))
+            status = "confirmed"
+            safe_log_device_action(user=user, device=entity_id, action="toggle", result="on" if new_state else "off")
+        else:
+            rollback = devices_collection.update_one(
+                pending_filter, db.device_update({"isOn": not new_state}, unset=("pendingCommand",))
+            )
+            if rollback.modified_count:
+                device_registry.apply(device["_id"], {"isOn": not new_state}, unset=("pendingCommand",))
+            status = "rolled_back"
+            safe_log_device_action(
+                user=user,
+                device=entity_id,
+                action="toggle",
+                result=f"error: {error}",
+                is_error=True,
+                error_type="home_assistant_error"
+            )
+    except Exception as e:
+        status, error = "failed", str(e)
+        print(f"[Write-behind Error] {e}")
+
+    db.device_commands_collection.update_one(
+        {"_id": command_id},
+        {"$set": {"status": status, "error": error, "completed_at": datetime.now(timezone.utc)}}
+    )
+
+def run_toggle(user, device_id, optimistic=False):
+    """
+    Toggle a device, returning (body, status). Rapid toggles are coalesced
+    and optimistic mode is honoured, as in the ASGI route (asgi.py).
+    """
+    try:
+        device_obj_id = ObjectId(device_id)
+
+        # Opt-in write-behind mode answers before Home Assistant does
+        if OPTIMISTIC_TOGGLES or optimistic:
+            return apply_toggle_optimistic(user, device_id, device_obj_id)
+
+        # Rapid toggles of the same device are merged into their net effect
+        return command_coalescer.submit(
+            (device_id, "toggle"),
+            [user],
+            lambda pending, new: pending + new,
+            lambda users: apply_toggle(users, device_id, device_obj_id)
+        )
 
     except InvalidId:
         # Log the error for invalid ObjectId
@@ -273,7 +526,7 @@ def toggle_device(device_id):
             action="toggle",
             result="error: invalid device id"
         )
-        return jsonify({"error": "Invalid device ID format"}), 400
+        return {"error": "Invalid device ID format"}, 400
     
     except Exception as e:
         # Log the error
@@ -284,7 +537,16 @@ def toggle_device(device_id):
             action="toggle",
             result=f"error: {str(e)}"
         )
-        return jsonify({"error": str(e)}), 500
+        return {"error": str(e)}, 500
+
+@device_routes.route('/<device_id>/toggle', methods=['POST'])
+@jwt_required()
+def toggle_device(device_id):
+    # Get the user identity from JWT
+    user = get_user_identity() 
+    optimistic = request.args.get('optimistic', '').lower() in ('1', 'true')
+    body, status = run_toggle(user, device_id, optimistic)
+    return jsonify(body), status
 
 @device_routes.route('/toggle-all-lights', methods=['POST'])
 @jwt_required()
@@ -299,7 +561,7 @@ def toggle_all_lights():
         desired_state = data['desiredState']  # True = ON, False = OFF
 
         # Fetch all light devices
-        lights = list(devices_collection.find({"type": "light"}))
+        lights = device_registry.by_type("light")
 
         updated_lights = []
 
@@ -326,8 +588,9 @@ def toggle_all_lights():
             # Update MongoDB state
             devices_collection.update_one(
                 {"_id": ObjectId(device["_id"])},
-                {"$set": {"isOn": desired_state}}
+                db.device_update({"isOn": desired_state})
             )
+            device_registry.apply(device["_id"], {"isOn": desired_state})
 
             # Log each light toggle
             # DEBUG - print(f"Toggling device {device['name']} to {'ON' if desired_state else 'OFF'}")
@@ -367,14 +630,54 @@ def toggle_all_lights():
         # DEBUG - print(f" Error: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
-@device_routes.route('/<device_id>/temperature', methods=['POST'])
-@jwt_required()
-def set_temperature(device_id):
-    # Get the user identity from JWT
-    user = get_user_identity()
+# Apply the final (coalesced) setpoint to a thermostat on behalf of every
+# user that sent one, returning (body, status)
+def apply_temperature(users, device, device_id, temperature):
+    if device.get('isHomeAssistant') and device.get('entityId'):
+        ok, error = send_homeassistant_command(
+            "climate", "set_temperature",
+            {"entity_id": device["entityId"], "temperature": float(temperature)}
+        )
+        if not ok:
+            log_for_users(
+                users,
+                device=device["entityId"],
+                action="set_temperature",
+                result=f"error: {error}",
+                is_error=True,
+                error_type="home_assistant_error"
+            )
+            return {"error": error}, 502
+
+    devices_collection.update_one({"_id": device["_id"]}, db.device_update({"temperature": temperature}))
+    device_registry.apply(device["_id"], {"temperature": temperature})
+
+    updated_device = {
+        "id": device_id,
+        "name": device["name"],
+        "type": device["type"],
+        "roomId": str(device.get("roomId")) if device.get("roomId") else None,
+        "temperature": temperature
+    }
+
+    # If the device is Home Assistant, update its state
+    log_for_users(
+        users,
+        device=device_id,
+        action="set_temperature",
+        result=str(temperature)
+    )
+
+    return updated_device, 200
+
+def run_set_temperature(user, device_id, data):
+    """
+    Set a thermostat from a request body {"temperature": n}, returning
+    (body, status). The ASGI route (asgi.py) mirrors it on asyncio.
+    """
     try:
         device_obj_id = ObjectId(device_id)
-        device = devices_collection.find_one({"_id": device_obj_id})
+        device = device_registry.get(device_obj_id)
 
         if not device:
             # DEBUG - print(f" Device {device_id} not found")
@@ -385,7 +688,7 @@ def set_temperature(device_id):
                 action="set_temperature",
                 result="error: device not found"
             )
-            return jsonify({"error": "Device not found"}), 404
+            return {"error": "Device not found"}, 404
 
         if device['type'] != 'thermostat':
             # DEBUG - print(f" Device {device_id} is not a thermostat")
@@ -396,9 +699,8 @@ def set_temperature(device_id):
                 action="set_temperature",
                 result="error: not a thermostat"
             )
-            return jsonify({"error": "Not a thermostat"}), 400
+            return {"error": "Not a thermostat"}, 400
 
-        data = request.get_json()
         if not data or 'temperature' not in data:
             # DEBUG - print(" Temperature data missing")
             # Log the error for missing temperature data
@@ -408,31 +710,16 @@ def set_temperature(device_id):
                 action="set_temperature",
                 result="error: temperature required"
             )
-            return jsonify({"error": "Temperature required"}), 400
-
-        devices_collection.update_one(
-            {"_id": device_obj_id},
-            {"$set": {"temperature": data['temperature']}}
-        )
-
-        updated_device = {
-            "id": device_id,
-            "name": device["name"],
-            "type": device["type"],
-            "roomId": str(device.get("roomId")) if device.get("roomId") else None,
-            "temperature": data['temperature']
-        }
-
-        # If the device is Home Assistant, update its state
-        safe_log_device_action(
-            user=user,
-            device=device_id,
-            action="set_temperature",
-            result=str(data['temperature'])
+            return {"error": "Temperature required"}, 400
+
+        # Setpoints sent while a slider is dragged collapse to the last value
+        return command_coalescer.submit(
+            (device_id, "temperature"),
+            (data['temperature'], [user]),
+            lambda pending, new: (new[0], pending[1] + new[1]),
+            lambda intent: apply_temperature(intent[1], device, device_id, intent[0])
         )
 
-        return jsonify(updated_device), 200
-
     except InvalidId:
         # Log the error for invalid ObjectId
         # DEBUG - print(f" Invalid device ID format: {device_id}")
@@ -442,7 +729,7 @@ def set_temperature(device_id):
             action="set_temperature",
             result="error: invalid device id"
         )
-        return jsonify({"error": "Invalid device ID format"}), 400
+        return {"error": "Invalid device ID format"}, 400
     except Exception as e:
         # Log the error
         # DEBUG - print(f" Error setting temperature for device {device_id}: {str(e)}")
@@ -452,8 +739,228 @@ def set_temperature(device_id):
             action="set_temperature",
             result=f"error: {str(e)}"
         )
+        return {"error": str(e)}, 500
+
+@device_routes.route('/<device_id>/temperature', methods=['POST'])
+@jwt_required()
+def set_temperature(device_id):
+    # Get the user identity from JWT
+    user = get_user_identity()
+    body, status = run_set_temperature(user, device_id, request.get_json(silent=True))
+    return jsonify(body), status
+
+# Call a Home Assistant service, returning (success, error message)
+def send_homeassistant_command(domain, service, payload, timeout=2):
+    url = f"{HOME_ASSISTANT_URL}/api/services/{domain}/{service}"
+    headers = {
+        "Authorization": f"Bearer {HOME_ASSISTANT_TOKEN}",
+        "Content-Type": "application/json"
+    }
+    try:
+        response = requests.post(url, json=payload, headers=headers, timeout=timeout)
+    except requests.exceptions.RequestException as e:
+        return False, f"Home Assistant connection error {str(e)}"
+
+    if response.status_code != 200:
+        return False, f"Home Assistant error {response.text}"
+    return True, None
+
+@device_routes.route('/commands', methods=['POST'])
+@jwt_required()
+def run_device_commands():
+    """
+    Apply several device commands in one request.
+    Body: {"commands": [{"deviceId": "...", "command": "toggle" | "turn_on" | "turn_off" | "set_temperature", "temperature": 21}]}
+    All devices are loaded with one query, Home Assistant calls run concurrently,
+    and state changes and logs are written in a single batch each.
+    """
+    user = get_user_identity()
+    try:
+        data = request.get_json(silent=True)
+        commands = data.get('commands') if isinstance(data, dict) else None
+        if not isinstance(commands, list) or not commands:
+            return jsonify({"error": "Commands list required"}), 400
+
+        results = [None] * len(commands)
+        log_entries = []
+        parsed = []  # (index, device ObjectId, command, temperature)
+        seen_ids = set()
+
+        # Validate every command before touching the database
+        for index, cmd in enumerate(commands):
+            device_id = cmd.get('deviceId') if isinstance(cmd, dict) else None
+            command = str(cmd.get('command', '')).lower() if isinstance(cmd, dict) else ''
+            error = None
+
+            if not device_id:
+                error = "deviceId required"
+            elif command not in BULK_POWER_COMMANDS and command != "set_temperature":
+                error = f"Unsupported command '{command}'"
+            elif command == "set_temperature" and cmd.get('temperature') is None:
+                error = "Temperature required"
+            elif command == "set_temperature" and (isinstance(cmd.get('temperature'), bool)
+                                                   or not isinstance(cmd.get('temperature'), (int, float))):
+                error = "Temperature must be a number"
+            else:
+                try:
+                    device_obj_id = ObjectId(device_id)
+                except (InvalidId, TypeError):
+                    error = "Invalid device ID format"
+                else:
+                    if device_obj_id in seen_ids:
+                        error = "Duplicate device in batch"
+                    else:
+                        seen_ids.add(device_obj_id)
+                        parsed.append((index, device_obj_id, command, cmd.get('temperature')))
+
+            if error:
+                results[index] = {"deviceId": device_id, "command": command, "status": "error", "error": error}
+
+        # Load all target devices from the registry (misses fetched with one $in query)
+        devices = device_registry.get_many(seen_ids) if seen_ids else {}
+
+        planned = []  # (index, device, update, log action, log result)
+        ha_calls = {}  # index -> (domain, service, payload)
+        for index, device_obj_id, command, temperature in parsed:
+            device = devices.get(device_obj_id)
+            device_id = str(device_obj_id)
+            action = "set_temperature" if command == "set_temperature" else "toggle"
+
+            if not device:
+                results[index] = {"deviceId": device_id, "command": command, "status": "error", "error": "Device not found"}
+                log_entries.append(build_log_entry(user, device_id, action, "error: device not found", True, "device_not_found"))
+                continue
+
+            if command == "set_temperature":
+                if device.get('type') != 'thermostat':
+                    results[index] = {"deviceId": device_id, "command": command, "status": "error", "error": "Not a thermostat"}
+                    log_entries.append(build_log_entry(user, device_id, action, "error: not a thermostat"))
+                    continue
+                update = {"temperature": temperature}
+                log_result = str(temperature)
+                if device.get('isHomeAssistant') and device.get('entityId'):
+                    ha_calls[index] = ("climate", "set_temperature", {"entity_id": device["entityId"], "temperature": float(temperature)})
+            else:
+                if command == "toggle":
+                    new_state = not device.get('isOn', False)
+                else:
+                    new_state = command == "turn_on"
+                update = {"isOn": new_state}
+                log_result = "on" if new_state else "off"
+                if device.get('isHomeAssistant') and device.get('entityId'):
+                    ha_service = "turn_on" if new_state else "turn_off"
+                    ha_calls[index] = (device["entityId"].split('.', 1)[0], ha_service, {"entity_id": device["entityId"]})
+
+            planned.append((index, device, update, action, log_result))
+
+        # Dispatch Home Assistant calls concurrently
+        ha_errors = {}
+        if ha_calls:
+            with ThreadPoolExecutor(max_workers=min(BULK_COMMAND_MAX_WORKERS, len(ha_calls))) as pool:
+                futures = {
+                    index: pool.submit(send_homeassistant_command, domain, service, payload)
+                    for index, (domain, service, payload) in ha_calls.items()
+                }
+                for index, future in futures.items():
+                    ok, error = future.result()
+                    if not ok:
+                        ha_errors[index] = error
+
+        # Write all successful state changes with one bulk_write
+        state_updates = []
+        for index, device, update, action, log_result in planned:
+            device_id = str(device["_id"])
+            log_device = device.get("entityId") if device.get("isHomeAssistant") else device_id
+
+            if index in ha_errors:
+                results[index] = {"deviceId": device_id, "command": commands[index].get('command'), "status": "error", "error": ha_errors[index]}
+                log_entries.append(build_log_entry(user, log_device, action, f"error: {ha_errors[index]}", True, "home_assistant_error"))
+                continue
+
+            state_updates.append((device["_id"], update))
+            updated_device = {
+                "id": device_id,
+                "name": device["name"],
+                "type": device["type"],
+                "roomId": str(device.get("roomId")) if device.get("roomId") else None,
+                "isOn": device.get("isOn", False),
+                "isHomeAssistant": device.get("isHomeAssistant", False),
+                "entityId": device.get("entityId", None)
+            }
+            if "temperature" in device:
+                updated_device["temperature"] = device["temperature"]
+            updated_device.update(update)
+
+            results[index] = {"deviceId": device_id, "command": commands[index].get('command'), "status": "success", "device": updated_device}
+            log_entries.append(build_log_entry(user, log_device, action, log_result))
+
+        if state_updates:
+            devices_collection.bulk_write([
+                UpdateOne({"_id": device_obj_id}, db.device_update(update))
+                for device_obj_id, update in state_updates
+            ], ordered=False)
+            for device_obj_id, update in state_updates:
+                device_registry.apply(device_obj_id, update)
+
+        try:
+            log_device_actions(log_entries)
+        except Exception as e:
+            print(f"[Logging Error] {e}")
+
+        succeeded = sum(1 for r in results if r["status"] == "success")
+        return jsonify({
+            "results": results,
+            "succeeded": succeeded,
+            "failed": len(results) - succeeded
+        }), 200
+
+    except Exception as e:
+        safe_log_device_action(
+            user=user,
+            device="bulk_commands",
+            action="bulk_commands",
+            result=f"error: {str(e)}"
+        )
         return jsonify({"error": str(e)}), 500
 
+@device_routes.route('/registry/stats', methods=['GET'])
+@jwt_required()
+def get_registry_stats():
+    """Hit rate and sync counters of the in-process device registry"""
+    return jsonify(device_registry.stats()), 200
+
+@device_routes.route('/logs/writer-stats', methods=['GET'])
+@jwt_required()
+def get_log_writer_stats():
+    """Queue depth, batch and dropped/backpressured counters of the device log writer"""
+    return jsonify(device_log_writer.stats()), 200
+
+@device_routes.route('/commands/<command_id>', methods=['GET'])
+@jwt_required()
+def get_command_status(command_id):
+    """
+    Look up the outcome of an optimistic (write-behind) command.
+    Status is one of pending, confirmed, rolled_back or failed.
+    """
+    try:
+        command = db.device_commands_collection.find_one({"_id": ObjectId(command_id)})
+    except InvalidId:
+        return jsonify({"error": "Invalid command ID format"}), 400
+
+    if not command:
+        return jsonify({"error": "Command not found"}), 404
+
+    return jsonify({
+        "commandId": command_id,
+        "deviceId": str(command["device_id"]),
+        "command": command["command"],
+        "desiredState": command.get("desired_state"),
+        "status": command["status"],
+        "error": command.get("error"),
+        "createdAt": command["created_at"].isoformat(),
+        "completedAt": command["completed_at"].isoformat() if command.get("completed_at") else None
+    }), 200
+
 @device_routes.route('/<device_id>', methods=['DELETE'])
 @jwt_required()
 def remove_device(device_id):
@@ -463,6 +970,9 @@ def remove_device(device_id):
         result = devices_collection.delete_one({"_id": ObjectId(device_id)})
 
         if result.deleted_count:
+            db.record_device_deletion(device_id)
+            device_registry.remove(device_id)
+
             # If the device was successfully deleted, log the action
             safe_log_device_action(
                 user=user,
@@ -508,20 +1018,25 @@ def refresh_device_state(device_id):
             safe_log_device_action(user, device_id, "refresh", "device not found", True, "device_not_found")
             return jsonify({"error": "Device not found"}), 404
         
-        entity_id = device['entity_id']
+        entity_id = device.get('entityId') or device.get('entity_id')
+        if not entity_id:
+            safe_log_device_action(user, device['name'], "refresh", "no entity_id configured", True, "unsupported_operation")
+            return jsonify({"error": "Device has no Home Assistant entity"}), 400
         
         # Fetch fresh state from Home Assistant
-        state_data = get_homeassistant_state(entity_id)
+        state_data = get_homeassistant_state_data(entity_id)
         if state_data:
-            # Update device state in database
-            devices_collection.update_one(
-                {"_id": ObjectId(device_id)},
-                {"$set": {
-                    "state": state_data.get('state', 'unknown'),
-                    "last_updated": state_data.get('last_updated'),
-                    "attributes": state_data.get('attributes', {})
-                }}
-            )
+            # Update device state in database and in the registry, so delta
+            # sync clients see the refreshed isOn
+            state = state_data.get('state', 'unknown')
+            update = {
+                "isOn": ha_state_is_on(entity_id, state),
+                "state": state,
+                "last_updated": state_data.get('last_updated'),
+                "attributes": state_data.get('attributes', {})
+            }
+            devices_collection.update_one({"_id": device["_id"]}, db.device_update(update))
+            device_registry.apply(device["_id"], update)
             safe_log_device_action(user, device['name'], "refresh", "success", False)
             return jsonify({"message": "Device state refreshed successfully", "state": state_data})
         else:
@@ -571,163 +1086,262 @@ def refresh_device_auth(device_id):
         return jsonify({"error": str(e)}), 500
 
 
-@device_routes.route('/<device_id>/reset', methods=['POST'])
-def reset_device(device_id):
+def get_homeassistant_state_data(entity_id, timeout=5):
+    """Return the full Home Assistant state object for an entity, or None"""
+    url = f"{HOME_ASSISTANT_URL}/api/states/{entity_id}"
+    headers = {
+        "Authorization": f"Bearer {HOME_ASSISTANT_TOKEN}",
+        "Content-Type": "application/json"
+    }
+    try:
+        response = requests.get(url, headers=headers, timeout=timeout)
+    except requests.exceptions.RequestException as e:
+        print(f"Error fetching state for {entity_id}: {e}")
+        return None
+    if response.status_code != 200:
+        print(f" Warning: Could not fetch state for {entity_id}. HTTP {response.status_code}")
+        return None
+    return response.json()
+
+def run_device_reset(user, device):
     """
-    Attempt to reset/restart a device
+    Reset/restart a device. Returns (body, status_code).
+    Runs on the diagnostics executor since it waits between Home Assistant calls.
     """
-    try:
-        user = get_user_identity()
-        
-        # Get device from database
-        device = devices_collection.find_one({"_id": ObjectId(device_id)})
-        if not device:
-            safe_log_device_action(user, device_id, "reset", "device not found", True, "device_not_found")
-            return jsonify({"error": "Device not found"}), 404
-        
-        entity_id = device['entity_id']
-        device_type = device.get('device_type', '').lower()
-        
-        # Different reset strategies based on device type
-        if 'switch' in device_type or 'light' in device_type:
-            # For switches and lights, try turning off then on
-            try:
-                # Turn off
-                url = f"{HOME_ASSISTANT_URL}/api/services/{device_type}/turn_off"
-                headers = {
-                    "Authorization": f"Bearer {HOME_ASSISTANT_TOKEN}",
-                    "Content-Type": "application/json"
-                }
-                data = {"entity_id": entity_id}
-                
+    entity_id = device.get('entityId')
+    device_type = device.get('type', '').lower()
+
+    # Different reset strategies based on device type
+    if 'switch' in device_type or 'light' in device_type:
+        # For switches and lights, try turning off then on
+        try:
+            # Turn off
+            url = f"{HOME_ASSISTANT_URL}/api/services/{device_type}/turn_off"
+            headers = {
+                "Authorization": f"Bearer {HOME_ASSISTANT_TOKEN}",
+                "Content-Type": "application/json"
+            }
+            data = {"entity_id": entity_id}
+
+            response = requests.post(url, headers=headers, json=data, timeout=10)
+            if response.status_code == 200:
+                # Wait a moment then turn back on
+                time.sleep(2)
+
+                url = f"{HOME_ASSISTANT_URL}/api/services/{device_type}/turn_on"
                 response = requests.post(url, headers=headers, json=data, timeout=10)
+
                 if response.status_code == 200:
-                    # Wait a moment then turn back on
-                    import time
-                    time.sleep(2)
-                    
-                    url = f"{HOME_ASSISTANT_URL}/api/services/{device_type}/turn_on"
-                    response = requests.post(url, headers=headers, json=data, timeout=10)
-                    
-                    if response.status_code == 200:
-                        safe_log_device_action(user, device['name'], "reset", "success", False)
-                        return jsonify({"message": f"Device {device['name']} reset successfully"})
-                
-                safe_log_device_action(user, device['name'], "reset", "failed to toggle device", True, "connection_error")
-                return jsonify({"error": "Failed to reset device"}), 500
-                
-            except requests.RequestException as e:
-                safe_log_device_action(user, device['name'], "reset", f"network error: {str(e)}", True, "connection_error")
-                return jsonify({"error": f"Network error during reset: {str(e)}"}), 500
-        else:
-            # For other device types, we can't perform a standard reset
-            safe_log_device_action(user, device['name'], "reset", "reset not supported for device type", True, "unsupported_operation")
-            return jsonify({"error": f"Reset not supported for device type: {device_type}"}), 400
-            
+                    safe_log_device_action(user, device['name'], "reset", "success", False)
+                    return {"message": f"Device {device['name']} reset successfully"}, 200
+
+            safe_log_device_action(user, device['name'], "reset", "failed to toggle device", True, "connection_error")
+            return {"error": "Failed to reset device"}, 500
+
+        except requests.RequestException as e:
+            safe_log_device_action(user, device['name'], "reset", f"network error: {str(e)}", True, "connection_error")
+            return {"error": f"Network error during reset: {str(e)}"}, 500
+    else:
+        # For other device types, we can't perform a standard reset
+        safe_log_device_action(user, device['name'], "reset", "reset not supported for device type", True, "unsupported_operation")
+        return {"error": f"Reset not supported for device type: {device_type}"}, 400
+
+def run_connectivity_test(user, device):
+    """
+    Test device connectivity and responsiveness. Returns (body, status_code).
+    Runs on the diagnostics executor since it waits between Home Assistant calls.
+    """
+    entity_id = device.get('entityId')
+
+    # Test 1: Check if device is reachable
+    state_data = get_homeassistant_state_data(entity_id)
+    if not state_data:
+        safe_log_device_action(user, device['name'], "test", "no response from HA", True, "connection_error")
+        return {
+            "status": "failed",
+            "message": "Device not reachable through Home Assistant",
+            "tests": {
+                "reachable": False,
+                "responsive": False,
+                "state_valid": False
+            }
+        }, 200
+
+    # Test 2: Check if device state is valid
+    state = state_data.get('state', 'unknown')
+    state_valid = state not in ['unavailable', 'unknown', None]
+
+    # Test 3: For controllable devices, test responsiveness
+    responsive = True
+    device_type = device.get('type', '').lower()
+
+    if 'switch' in device_type or 'light' in device_type:
+        try:
+            # Get current state
+            current_state = state_data.get('state')
+
+            # Try a quick toggle test (turn off then back to original state)
+            if current_state == 'on':
+                # Quick off/on test
+                test_url = f"{HOME_ASSISTANT_URL}/api/services/{device_type}/turn_off"
+            else:
+                # Quick on/off test
+                test_url = f"{HOME_ASSISTANT_URL}/api/services/{device_type}/turn_on"
+
+            headers = {
+                "Authorization": f"Bearer {HOME_ASSISTANT_TOKEN}",
+                "Content-Type": "application/json"
+            }
+            data = {"entity_id": entity_id}
+
+            test_response = requests.post(test_url, headers=headers, json=data, timeout=5)
+            responsive = test_response.status_code == 200
+
+            if responsive and current_state:
+                # Restore original state
+                time.sleep(1)
+                restore_url = f"{HOME_ASSISTANT_URL}/api/services/{device_type}/turn_{current_state}"
+                requests.post(restore_url, headers=headers, json=data, timeout=5)
+
+        except Exception:
+            responsive = False
+
+    # Overall test result
+    overall_success = state_valid and responsive
+
+    test_results = {
+        "status": "passed" if overall_success else "failed",
+        "message": f"Device {device['name']} connectivity test completed",
+        "tests": {
+            "reachable": True,
+            "responsive": responsive,
+            "state_valid": state_valid
+        },
+        "current_state": state,
+        "last_updated": state_data.get('last_updated')
+    }
+
+    safe_log_device_action(
+        user,
+        device['name'],
+        "test",
+        "passed" if overall_success else "failed",
+        not overall_success,
+        "connection_error" if not responsive else None
+    )
+
+    return test_results, 200
+
+# Diagnostic job runners, keyed by job type
+DEVICE_JOB_RUNNERS = {
+    "reset": run_device_reset,
+    "test": run_connectivity_test
+}
+
+def run_device_job(job_id, job_type, user, device):
+    """Execute a queued diagnostic job and record its outcome"""
+    try:
+        db.device_jobs_collection.update_one(
+            {"_id": job_id},
+            {"$set": {"status": "running", "started_at": datetime.now(timezone.utc)}}
+        )
+        try:
+            body, status_code = DEVICE_JOB_RUNNERS[job_type](user, device)
+            status = "succeeded" if status_code < 400 else "failed"
+        except Exception as e:
+            safe_log_device_action(user, str(device["_id"]), job_type, f"error: {str(e)}", True, "unknown")
+            body, status_code, status = {"error": str(e)}, 500, "failed"
+
+        db.device_jobs_collection.update_one(
+            {"_id": job_id},
+            {"$set": {
+                "status": status,
+                "result": body,
+                "result_code": status_code,
+                "completed_at": datetime.now(timezone.utc)
+            }}
+        )
     except Exception as e:
-        safe_log_device_action(user, device_id, "reset", f"error: {str(e)}", True, "unknown")
+        print(f"[Device Job Error] {e}")
+    finally:
+        device_job_slots.release()
+
+def start_device_job(job_type, device_id):
+    """Queue a diagnostic job for a device and answer with its id right away"""
+    user = get_user_identity()
+    try:
+        device = device_registry.get(device_id)
+    except InvalidId:
+        return jsonify({"error": "Invalid device ID format"}), 400
+    if not device:
+        safe_log_device_action(user, device_id, job_type, "device not found", True, "device_not_found")
+        return jsonify({"error": "Device not found"}), 404
+
+    if not device_job_slots.acquire(blocking=False):
+        return jsonify({"error": "Too many diagnostic jobs in progress, try again later"}), 503
+
+    try:
+        job_id = ObjectId()
+        db.device_jobs_collection.insert_one({
+            "_id": job_id,
+            "device_id": device["_id"],
+            "type": job_type,
+            "status": "queued",
+            "user": user,
+            "created_at": datetime.now(timezone.utc)
+        })
+        diagnostics_executor.submit(run_device_job, job_id, job_type, user, device)
+    except Exception as e:
+        device_job_slots.release()
         return jsonify({"error": str(e)}), 500
 
+    return jsonify({
+        "jobId": str(job_id),
+        "type": job_type,
+        "status": "queued",
+        "statusUrl": f"/api/devices/jobs/{job_id}"
+    }), 202
+
+@device_routes.route('/<device_id>/reset', methods=['POST'])
+def reset_device(device_id):
+    """
+    Queue a reset/restart of a device. Poll GET /jobs/<job_id> for the outcome.
+    """
+    return start_device_job("reset", device_id)
+
 
 @device_routes.route('/<device_id>/test', methods=['POST'])
 def test_device_connectivity(device_id):
     """
-    Test device connectivity and responsiveness
+    Queue a connectivity and responsiveness test. Poll GET /jobs/<job_id> for the results.
+    """
+    return start_device_job("test", device_id)
+
+@device_routes.route('/jobs/<job_id>', methods=['GET'])
+def get_device_job(job_id):
+    """
+    Status of a diagnostic job: queued, running, succeeded or failed.
+    Finished jobs include the result the synchronous endpoint used to return.
     """
     try:
-        user = get_user_identity()
-        
-        # Get device from database
-        device = devices_collection.find_one({"_id": ObjectId(device_id)})
-        if not device:
-            safe_log_device_action(user, device_id, "test", "device not found", True, "device_not_found")
-            return jsonify({"error": "Device not found"}), 404
-        
-        entity_id = device['entity_id']
-        
-        # Test 1: Check if device is reachable
-        state_data = get_homeassistant_state(entity_id)
-        if not state_data:
-            safe_log_device_action(user, device['name'], "test", "no response from HA", True, "connection_error")
-            return jsonify({
-                "status": "failed",
-                "message": "Device not reachable through Home Assistant",
-                "tests": {
-                    "reachable": False,
-                    "responsive": False,
-                    "state_valid": False
-                }
-            }), 200
-        
-        # Test 2: Check if device state is valid
-        state = state_data.get('state', 'unknown')
-        state_valid = state not in ['unavailable', 'unknown', None]
-        
-        # Test 3: For controllable devices, test responsiveness
-        responsive = True
-        device_type = device.get('device_type', '').lower()
-        
-        if 'switch' in device_type or 'light' in device_type:
-            try:
-                # Get current state
-                current_state = state_data.get('state')
-                
-                # Try a quick toggle test (turn off then back to original state)
-                if current_state == 'on':
-                    # Quick off/on test
-                    test_url = f"{HOME_ASSISTANT_URL}/api/services/{device_type}/turn_off"
-                else:
-                    # Quick on/off test
-                    test_url = f"{HOME_ASSISTANT_URL}/api/services/{device_type}/turn_on"
-                
-                headers = {
-                    "Authorization": f"Bearer {HOME_ASSISTANT_TOKEN}",
-                    "Content-Type": "application/json"
-                }
-                data = {"entity_id": entity_id}
-                
-                test_response = requests.post(test_url, headers=headers, json=data, timeout=5)
-                responsive = test_response.status_code == 200
-                
-                if responsive and current_state:
-                    # Restore original state
-                    import time
-                    time.sleep(1)
-                    restore_url = f"{HOME_ASSISTANT_URL}/api/services/{device_type}/turn_{current_state}"
-                    requests.post(restore_url, headers=headers, json=data, timeout=5)
-                
-            except Exception:
-                responsive = False
-        
-        # Overall test result
-        overall_success = state_valid and responsive
-        
-        test_results = {
-            "status": "passed" if overall_success else "failed",
-            "message": f"Device {device['name']} connectivity test completed",
-            "tests": {
-                "reachable": True,
-                "responsive": responsive,
-                "state_valid": state_valid
-            },
-            "current_state": state,
-            "last_updated": state_data.get('last_updated')
-        }
-        
-        safe_log_device_action(
-            user, 
-            device['name'], 
-            "test", 
-            "passed" if overall_success else "failed", 
-            not overall_success,
-            "connection_error" if not responsive else None
-        )
-        
-        return jsonify(test_results)
-        
-    except Exception as e:
-        safe_log_device_action(user, device_id, "test", f"error: {str(e)}", True, "unknown")
-        return jsonify({"error": str(e)}), 500
+        job = db.device_jobs_collection.find_one({"_id": ObjectId(job_id)})
+    except InvalidId:
+        return jsonify({"error": "Invalid job ID format"}), 400
+
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+
+    return jsonify({
+        "jobId": job_id,
+        "deviceId": str(job["device_id"]),
+        "type": job["type"],
+        "status": job["status"],
+        "result": job.get("result"),
+        "resultCode": job.get("result_code"),
+        "createdAt": job["created_at"].isoformat(),
+        "startedAt": job["started_at"].isoformat() if job.get("started_at") else None,
+        "completedAt": job["completed_at"].isoformat() if job.get("completed_at") else None
+    }), 200
 
 @device_routes.route('/group/<group_id>/refresh', methods=['POST'])
 def refresh_device_group(group_id):
@@ -766,65 +1380,75 @@ def refresh_device_group(group_id):
             "failed": 0,
             "results": []
         }
-        
-        # Refresh each device in the group
+
+        # Fetch every entity state from Home Assistant in a single round trip
+        try:
+            ha_states = get_homeassistant_states()
+            ha_error = None
+        except Exception as e:
+            ha_states = {}
+            ha_error = f"Failed to fetch Home Assistant states: {str(e)}"
+
+        state_updates = []
+        log_entries = []
+        refreshed_at = datetime.now(timezone.utc)
+
         for device in devices:
             device_id = str(device.get('_id', ''))
             device_name = device.get('name', device_id)
-            
-            try:
-                # Get current state from Home Assistant
-                entity_id = device.get('entity_id')
-                if entity_id:
-                    state_result = get_homeassistant_state(entity_id)
-                    if state_result.get('success'):
-                        refresh_results["refreshed"] += 1
-                        refresh_results["results"].append({
-                            "device": device_name,
-                            "status": "success",
-                            "state": state_result.get('state', 'unknown')
-                        })
-                        
-                        # Log the refresh action
-                        safe_log_device_action(
-                            user=user,
-                            device=device_id,
-                            action="group_refresh",
-                            result="success"
-                        )
-                    else:
-                        refresh_results["failed"] += 1
-                        refresh_results["results"].append({
-                            "device": device_name,
-                            "status": "failed",
-                            "error": state_result.get('error', 'Unknown error')
-                        })
-                        
-                        # Log the failed refresh
-                        safe_log_device_action(
-                            user=user,
-                            device=device_id,
-                            action="group_refresh",
-                            result="failed",
-                            is_error=True,
-                            error_type="refresh_failed"
-                        )
-                else:
-                    refresh_results["failed"] += 1
-                    refresh_results["results"].append({
-                        "device": device_name,
-                        "status": "failed",
-                        "error": "No entity_id configured"
-                    })
-                    
-            except Exception as device_error:
+            entity_id = device.get('entityId') or device.get('entity_id')
+
+            if not entity_id:
                 refresh_results["failed"] += 1
                 refresh_results["results"].append({
                     "device": device_name,
                     "status": "failed",
-                    "error": str(device_error)
+                    "error": "No entity_id configured"
                 })
-        
+                continue
+
+            state_data = ha_states.get(entity_id)
+            if state_data is None:
+                error = ha_error or f"Entity {entity_id} not found in Home Assistant"
+                refresh_results["failed"] += 1
+                refresh_results["results"].append({
+                    "device": device_name,
+                    "status": "failed",
+                    "error": error
+                })
+                log_entries.append(build_log_entry(
+                    user, device_id, "group_refresh", "failed", True, "refresh_failed"
+                ))
+                continue
+
+            state = state_data.get('state', 'unknown')
+            state_updates.append((device["_id"], {
+                "isOn": ha_state_is_on(entity_id, state),
+                "state": state,
+                "last_updated": state_data.get('last_updated'),
+                "last_refreshed": refreshed_at
+            }))
+            refresh_results["refreshed"] += 1
+            refresh_results["results"].append({
+                "device": device_name,
+                "status": "success",
+                "state": state
+            })
+            log_entries.append(build_log_entry(user, device_id, "group_refresh", "success"))
+
+        if state_updates:
+            devices_collection.bulk_write([
+                UpdateOne({"_id": device_obj_id}, db.device_update(update))
+                for device_obj_id, update in state_updates
+            ], ordered=False)
+            for device_obj_id, update in state_updates:
+                device_registry.apply(device_obj_id, update)
+
+        try:
+            log_device_actions(log_entries)
+        except Exception as e:
+            print(f"[Logging Error] {e}")
+
         return jsonify(refresh_results)
         
     except Exception as e:
@@ -2,8 +2,9 @@ from flask import Blueprint, jsonify, request
 from flask_jwt_extended import jwt_required, get_jwt_identity
 import requests
 from config import HOME_ASSISTANT_URL, HOME_ASSISTANT_TOKEN
-from db import find_user_by_id, devices_collection
+from db import find_user_by_id, devices_collection, device_update
 from bson import ObjectId
+from device_registry import device_registry
 
 home_assistant_routes = Blueprint('home_assistant', __name__)
 
@@ -33,7 +34,9 @@ def toggle_ha_device(entity_id):
         print(f"Toggling Home Assistant entity: {entity_id}")
         
         # Find device in database to know the current state
-        device = devices_collection.find_one({"entityId": entity_id, "isHomeAssistant": True})
+        device = device_registry.find_by_entity(entity_id)
+        if device and not device.get('isHomeAssistant'):
+            device = None
         
         # If we have the device in our database, use its state, otherwise query HA
         if device:
@@ -91,8 +94,9 @@ def toggle_ha_device(entity_id):
             print(f"Updating database for device {device_id}")
             devices_collection.update_one(
                 {"_id": ObjectId(device_id)},
-                {"$set": {"isOn": new_state}}
+                device_update({"isOn": new_state})
             )
+            device_registry.apply(device_id, {"isOn": new_state})
             
         return jsonify({
             "success": True,
@@ -102,4 +106,53 @@ def toggle_ha_device(entity_id):
         
     except Exception as e:
         print(f"Error toggling device: {str(e)}")
-        return jsonify({"error": str(e)}), 500
\ No newline at end of file
+        return jsonify({"error": str(e)}), 500
+
+@home_assistant_routes.route('/events', methods=['POST'])
+@jwt_required()
+def receive_ha_event():
+    """
+    Receive a Home Assistant state_changed event (e.g. forwarded by a
+    rest_command or webhook automation) and mirror it onto the matching device,
+    which also evaluates state-triggered automations watching that device.
+    """
+    try:
+        event = request.get_json(silent=True)
+        if not event or event.get('event_type', 'state_changed') != 'state_changed':
+            return jsonify({"error": "Expected a state_changed event"}), 400
+
+        event_data = event.get('data', {})
+        entity_id = event_data.get('entity_id')
+        new_state = event_data.get('new_state') or {}
+        if not entity_id:
+            return jsonify({"error": "entity_id required"}), 400
+
+        device = device_registry.find_by_entity(entity_id)
+        if not device or not device.get('isHomeAssistant'):
+            return jsonify({"error": "Device not found"}), 404
+
+        update = {}
+        if new_state.get('state') in ('on', 'off'):
+            update['isOn'] = new_state['state'] == 'on'
+        elif new_state.get('state') in ('heat', 'cool', 'heat_cool', 'auto'):
+            update['isOn'] = True
+        temperature = new_state.get('attributes', {}).get('temperature')
+        if isinstance(temperature, (int, float)) and not isinstance(temperature, bool):
+            update['temperature'] = temperature
+
+        changed = {field: value for field, value in update.items() if device.get(field) != value}
+        if changed:
+            devices_collection.update_one(
+                {"_id": device['_id']},
+                device_update(changed)
+            )
+            device_registry.apply(device['_id'], changed)
+
+        return jsonify({
+            "deviceId": str(device['_id']),
+            "entity_id": entity_id,
+            "changed": changed
+        }), 200
+    except Exception as e:
+        print(f"Error handling Home Assistant event: {str(e)}")
+        return jsonify({"error": str(e)}), 500
@@ -2,7 +2,8 @@ from flask import Blueprint, jsonify, request
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from bson import ObjectId
 import db
-from ml_models import device_predictor, get_device_suggestions, update_device_history
+from ml_models import device_predictor, get_device_suggestions, update_device_history, training_queue, get_model_freshness
+from config import ML_MODEL_MODE
 from datetime import datetime, timezone, timedelta
 import random
 
@@ -175,3 +176,16 @@ def feedback():
         })
     except Exception as e:
         return jsonify({"error": str(e)}), 500
+
+@ml_routes.route('/training/stats', methods=['GET'])
+@jwt_required()
+def get_training_stats():
+    """Background training queue depth, training durations and model freshness"""
+    try:
+        return jsonify({
+            "mode": ML_MODEL_MODE,
+            "queue": training_queue.stats(),
+            "models": get_model_freshness(request.args.get('limit', 50, type=int))
+        }), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
@@ -2,11 +2,13 @@ from flask import Blueprint, jsonify, request
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from db import rooms_collection, devices_collection, find_user_by_id
 from bson import ObjectId
+from etags import conditional_listing, invalidate_listing
 
 room_routes = Blueprint('rooms', __name__)
 
 @room_routes.route('/', methods=['GET'])
 @jwt_required()
+@conditional_listing("rooms")
 def get_rooms():
     try:
         rooms = list(rooms_collection.find())
@@ -37,6 +39,7 @@ def add_room():
         }
         
         result = rooms_collection.insert_one(new_room)
+        invalidate_listing("rooms")
         inserted_room = rooms_collection.find_one({"_id": result.inserted_id})
         inserted_room['id'] = str(inserted_room['_id'])
         del inserted_room['_id']
@@ -65,6 +68,7 @@ def update_room(room_id):
             {"_id": ObjectId(room_id)},
             {"$set": {"name": data['name']}}
         )
+        invalidate_listing("rooms")
         
         if result.matched_count == 0:
             return jsonify({"error": "Room not found"}), 404
@@ -89,6 +93,7 @@ def delete_room(room_id):
 
         result = rooms_collection.delete_one({"_id": ObjectId(room_id)})
         if result.deleted_count:
+            invalidate_listing("rooms")
             return jsonify({"message": "Room deleted successfully"}), 200
         return jsonify({"error": "Room not found"}), 404
     except Exception as e:
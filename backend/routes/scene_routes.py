@@ -0,0 +1,295 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from flask import Blueprint, jsonify, request
+from flask_jwt_extended import jwt_required
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import UpdateOne
+import db
+from db import scenes_collection, devices_collection
+from device_registry import device_registry
+from etags import conditional_listing, invalidate_listing
+from models.device_log import build_log_entry, log_device_actions
+from routes.device_routes import get_user_identity, send_homeassistant_command, BULK_COMMAND_MAX_WORKERS
+
+scene_routes = Blueprint('scenes', __name__)
+
+def format_scene(scene):
+    formatted = {
+        "id": str(scene["_id"]),
+        "name": scene["name"],
+        "actions": [
+            {**action, "deviceId": str(action["deviceId"])}
+            for action in scene.get("actions", [])
+        ]
+    }
+    if scene.get("last_applied_at"):
+        formatted["lastAppliedAt"] = scene["last_applied_at"].isoformat()
+        formatted["lastTiming"] = scene.get("last_timing")
+    return formatted
+
+def parse_scene_actions(actions):
+    """
+    Validate scene actions, returning (actions, error).
+    Each action targets one device: {"deviceId": "...", "isOn": true, "temperature": 21}
+    with at least one of isOn / temperature.
+    """
+    if not isinstance(actions, list) or not actions:
+        return None, "Scene actions required"
+
+    parsed = []
+    seen_ids = set()
+    for action in actions:
+        if not isinstance(action, dict) or not action.get('deviceId'):
+            return None, "Each action needs a deviceId"
+        try:
+            device_obj_id = ObjectId(action['deviceId'])
+        except (InvalidId, TypeError):
+            return None, f"Invalid device ID format: {action['deviceId']}"
+        if device_obj_id in seen_ids:
+            return None, f"Device {action['deviceId']} appears more than once"
+        seen_ids.add(device_obj_id)
+
+        target = {"deviceId": device_obj_id}
+        if 'isOn' in action:
+            if not isinstance(action['isOn'], bool):
+                return None, "isOn must be a boolean"
+            target['isOn'] = action['isOn']
+        if 'temperature' in action:
+            if isinstance(action['temperature'], bool) or not isinstance(action['temperature'], (int, float)):
+                return None, "Temperature must be a number"
+            target['temperature'] = action['temperature']
+        if len(target) == 1:
+            return None, "Each action needs isOn or temperature"
+        parsed.append(target)
+    return parsed, None
+
+@scene_routes.route('/', methods=['GET'])
+@jwt_required()
+@conditional_listing("scenes")
+def get_scenes():
+    try:
+        return jsonify([format_scene(scene) for scene in scenes_collection.find()])
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@scene_routes.route('/', methods=['POST'])
+@jwt_required()
+def add_scene():
+    try:
+        data = request.get_json(silent=True)
+        if not data or not data.get('name'):
+            return jsonify({"error": "Scene name required"}), 400
+
+        actions, error = parse_scene_actions(data.get('actions'))
+        if error:
+            return jsonify({"error": error}), 400
+
+        scene = {
+            "name": data['name'],
+            "actions": actions,
+            "created_by": get_user_identity(),
+            "created_at": datetime.now(timezone.utc)
+        }
+        result = scenes_collection.insert_one(scene)
+        invalidate_listing("scenes")
+        scene["_id"] = result.inserted_id
+        return jsonify(format_scene(scene)), 201
+    except Exception as e:
+        print(f"Error adding scene: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@scene_routes.route('/<scene_id>', methods=['GET'])
+@jwt_required()
+def get_scene(scene_id):
+    try:
+        scene = scenes_collection.find_one({"_id": ObjectId(scene_id)})
+    except InvalidId:
+        return jsonify({"error": "Invalid scene ID format"}), 400
+    if not scene:
+        return jsonify({"error": "Scene not found"}), 404
+    return jsonify(format_scene(scene))
+
+@scene_routes.route('/<scene_id>', methods=['PUT'])
+@jwt_required()
+def update_scene(scene_id):
+    try:
+        data = request.get_json(silent=True)
+        if not data:
+            return jsonify({"error": "No data provided"}), 400
+
+        update = {}
+        if 'name' in data:
+            if not data['name']:
+                return jsonify({"error": "Scene name required"}), 400
+            update['name'] = data['name']
+        if 'actions' in data:
+            actions, error = parse_scene_actions(data['actions'])
+            if error:
+                return jsonify({"error": error}), 400
+            update['actions'] = actions
+        if not update:
+            return jsonify({"error": "Nothing to update"}), 400
+
+        result = scenes_collection.update_one({"_id": ObjectId(scene_id)}, {"$set": update})
+        if result.matched_count == 0:
+            return jsonify({"error": "Scene not found"}), 404
+        invalidate_listing("scenes")
+
+        return jsonify(format_scene(scenes_collection.find_one({"_id": ObjectId(scene_id)})))
+    except InvalidId:
+        return jsonify({"error": "Invalid scene ID format"}), 400
+    except Exception as e:
+        print(f"Error updating scene: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@scene_routes.route('/<scene_id>', methods=['DELETE'])
+@jwt_required()
+def delete_scene(scene_id):
+    try:
+        result = scenes_collection.delete_one({"_id": ObjectId(scene_id)})
+        if result.deleted_count:
+            invalidate_listing("scenes")
+            return jsonify({"message": "Scene deleted successfully"}), 200
+        return jsonify({"error": "Scene not found"}), 404
+    except InvalidId:
+        return jsonify({"error": "Invalid scene ID format"}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+def apply_scene(scene, user):
+    """
+    Apply every action of a scene in one pass:
+    one device load, concurrent Home Assistant calls grouped per domain/service,
+    one bulk_write and one batched log insert. Returns (results, timing).
+    """
+    started = time.perf_counter()
+    timing = {}
+
+    # Load all target devices (registry misses are fetched with one $in query)
+    devices = device_registry.get_many([action["deviceId"] for action in scene["actions"]])
+    timing["load_ms"] = round((time.perf_counter() - started) * 1000, 2)
+
+    results = []
+    log_entries = []
+    planned = []    # (device, update)
+    ha_groups = {}  # (domain, service, frozen extra payload) -> [(device, entity_id)]
+    for action in scene["actions"]:
+        device = devices.get(action["deviceId"])
+        device_id = str(action["deviceId"])
+        if not device:
+            results.append({"deviceId": device_id, "status": "error", "error": "Device not found"})
+            log_entries.append(build_log_entry(user, device_id, "scene", f"error: device not found in scene {scene['name']}", True, "device_not_found"))
+            continue
+
+        update = {}
+        if 'temperature' in action:
+            if device.get('type') != 'thermostat':
+                results.append({"deviceId": device_id, "status": "error", "error": "Not a thermostat"})
+                log_device = device.get("entityId") if device.get("isHomeAssistant") else device_id
+                log_entries.append(build_log_entry(user, log_device, "scene", "error: not a thermostat", True, "unsupported_operation"))
+                continue
+            update["temperature"] = action["temperature"]
+        if 'isOn' in action:
+            update["isOn"] = action["isOn"]
+
+        if device.get('isHomeAssistant') and device.get('entityId'):
+            entity_id = device["entityId"]
+            domain = entity_id.split('.', 1)[0]
+            if 'isOn' in update:
+                service = "turn_on" if update["isOn"] else "turn_off"
+                ha_groups.setdefault((domain, service, ()), []).append((device, entity_id))
+            if 'temperature' in update:
+                extra = (("temperature", float(update["temperature"])),)
+                ha_groups.setdefault(("climate", "set_temperature", extra), []).append((device, entity_id))
+
+        planned.append((device, update))
+
+    # One Home Assistant call per (domain, service) group, all groups concurrently
+    ha_started = time.perf_counter()
+    ha_errors = {}  # device ObjectId -> error
+    if ha_groups:
+        with ThreadPoolExecutor(max_workers=min(BULK_COMMAND_MAX_WORKERS, len(ha_groups))) as pool:
+            futures = {
+                key: pool.submit(
+                    send_homeassistant_command, key[0], key[1],
+                    {"entity_id": [entity_id for _, entity_id in members], **dict(key[2])}
+                )
+                for key, members in ha_groups.items()
+            }
+            for key, future in futures.items():
+                ok, error = future.result()
+                if not ok:
+                    for device, _ in ha_groups[key]:
+                        ha_errors[device["_id"]] = error
+    timing["home_assistant_ms"] = round((time.perf_counter() - ha_started) * 1000, 2)
+
+    write_started = time.perf_counter()
+    state_updates = []
+    for device, update in planned:
+        device_id = str(device["_id"])
+        log_device = device.get("entityId") if device.get("isHomeAssistant") else device_id
+        if device["_id"] in ha_errors:
+            error = ha_errors[device["_id"]]
+            results.append({"deviceId": device_id, "status": "error", "error": error})
+            log_entries.append(build_log_entry(user, log_device, "scene", f"error: {error}", True, "home_assistant_error"))
+            continue
+
+        state_updates.append((device["_id"], update))
+        results.append({"deviceId": device_id, "status": "success", **update})
+        if "isOn" in update:
+            log_entries.append(build_log_entry(user, log_device, "toggle", "on" if update["isOn"] else "off"))
+        if "temperature" in update:
+            log_entries.append(build_log_entry(user, log_device, "set_temperature", str(update["temperature"])))
+
+    if state_updates:
+        devices_collection.bulk_write([
+            UpdateOne({"_id": device_obj_id}, db.device_update(update))
+            for device_obj_id, update in state_updates
+        ], ordered=False)
+        for device_obj_id, update in state_updates:
+            device_registry.apply(device_obj_id, update)
+
+    try:
+        log_device_actions(log_entries)
+    except Exception as e:
+        print(f"[Logging Error] {e}")
+    timing["write_ms"] = round((time.perf_counter() - write_started) * 1000, 2)
+    timing["total_ms"] = round((time.perf_counter() - started) * 1000, 2)
+
+    return results, timing
+
+@scene_routes.route('/<scene_id>/apply', methods=['POST'])
+@jwt_required()
+def apply_scene_route(scene_id):
+    user = get_user_identity()
+    try:
+        scene = scenes_collection.find_one({"_id": ObjectId(scene_id)})
+    except InvalidId:
+        return jsonify({"error": "Invalid scene ID format"}), 400
+    if not scene:
+        return jsonify({"error": "Scene not found"}), 404
+
+    try:
+        results, timing = apply_scene(scene, user)
+
+        # Keep the latest timing on the scene so slow scenes can be spotted
+        scenes_collection.update_one(
+            {"_id": scene["_id"]},
+            {"$set": {"last_applied_at": datetime.now(timezone.utc), "last_timing": timing}}
+        )
+        invalidate_listing("scenes")
+
+        succeeded = sum(1 for r in results if r["status"] == "success")
+        return jsonify({
+            "sceneId": scene_id,
+            "name": scene["name"],
+            "results": results,
+            "succeeded": succeeded,
+            "failed": len(results) - succeeded,
+            "timing": timing
+        }), 200
+    except Exception as e:
+        print(f"[Scene Error] {e}")
+        return jsonify({"error": str(e)}), 500
@@ -1,95 +1,581 @@
 from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.jobstores.memory import MemoryJobStore
+from apscheduler.jobstores.mongodb import MongoDBJobStore
+from apscheduler.executors.pool import ThreadPoolExecutor as JobThreadPoolExecutor
+from apscheduler.events import EVENT_JOB_MAX_INSTANCES, EVENT_JOB_MISSED, EVENT_JOB_ERROR
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from db import automations_collection, devices_collection
+import db
+from db import automations_collection
 from bson import ObjectId
-import requests
-from config import HOME_ASSISTANT_URL, HOME_ASSISTANT_TOKEN
+from pymongo import UpdateOne
+import random
+import threading
+import time
+import atexit
+from config import (
+    DATABASE_NAME, SCHEDULER_PERSISTENT_JOBS, SCHEDULER_MISFIRE_GRACE_TIME, SCHEDULER_COALESCE,
+    AUTOMATION_BATCH_JITTER, AUTOMATION_BATCH_CHUNK_SIZE, AUTOMATION_BATCH_MAX_WORKERS,
+    SCHEDULER_LEADER_ELECTION, SCHEDULER_LEASE_TTL, SCHEDULER_LEASE_RENEW_INTERVAL,
+    AUTOMATION_EXECUTOR_WORKERS, AUTOMATION_MAX_INSTANCES, AUTOMATION_HA_TIMEOUT,
+    ML_FOREST_RETRAIN_HOURS
+)
+from device_registry import device_registry
+from routes.device_routes import send_homeassistant_command
+from automation_triggers import TriggerIndex, parse_state_trigger
+from leader_election import LeaderElector
+from etags import current_listing_version
+from models.automation_execution import (
+    EXECUTION_SUCCESS, EXECUTION_FAILED, EXECUTION_SKIPPED, EXECUTION_MISSED,
+    build_execution_entry, record_executions, automation_metrics, automation_execution_writer
+)
 
-scheduler = BackgroundScheduler()
+# Automation jobs live in Mongo so they survive restarts and missed fires can
+# still run within the grace time; housekeeping jobs stay in memory.
+SCHEDULER_JOBS_COLLECTION = 'scheduler_jobs'
 
-def execute_automation(automation):
-    try:
-        action = automation.get('action', {})
-        command = action.get('command', 'toggle').lower()
-        device_id = action.get('deviceId')
-
-        if not device_id:
-            print(f"No deviceId found in automation '{automation.get('name')}'")
-            return
-
-        if isinstance(device_id, str):
-            try:
-                device_id = ObjectId(device_id)
-            except Exception:
-                print(f"Invalid ObjectId: {device_id}")
-                return
-
-        device = devices_collection.find_one({"_id": device_id})
-        if not device:
-            print(f"Device not found for automation '{automation.get('name')}'")
-            return
+def build_jobstores():
+    if not SCHEDULER_PERSISTENT_JOBS:
+        return {'default': MemoryJobStore(), 'memory': MemoryJobStore()}
+    return {
+        'default': MongoDBJobStore(
+            database=DATABASE_NAME,
+            collection=SCHEDULER_JOBS_COLLECTION,
+            client=db.db.client
+        ),
+        'memory': MemoryJobStore()
+    }
+
+# Automation batches get their own pool so a slow Home Assistant can't delay
+# housekeeping jobs such as the reconciliation
+scheduler = BackgroundScheduler(
+    jobstores=build_jobstores(),
+    executors={
+        'default': JobThreadPoolExecutor(4),
+        'automations': JobThreadPoolExecutor(AUTOMATION_EXECUTOR_WORKERS)
+    },
+    job_defaults={
+        'misfire_grace_time': SCHEDULER_MISFIRE_GRACE_TIME,
+        'coalesce': SCHEDULER_COALESCE,
+        'max_instances': 1
+    }
+)
+
+def resolve_automation_command(automation):
+    """Return (device ObjectId, command) for an automation's action, or None if unusable"""
+    action = automation.get('action', {})
+    command = action.get('command', 'toggle').lower()
+    device_id = action.get('deviceId')
+
+    if not device_id:
+        print(f"No deviceId found in automation '{automation.get('name')}'")
+        return None
+
+    if isinstance(device_id, str):
+        try:
+            device_id = ObjectId(device_id)
+        except Exception:
+            print(f"Invalid ObjectId: {device_id}")
+            return None
+
+    if command not in ('turn_on', 'turn_off', 'toggle'):
+        print(f"Unsupported command '{command}' in automation '{automation.get('name')}'")
+        return None
+    return device_id, command
 
-        current_state = device.get('isOn', False)
+def _send_ha_chunk(domain, service, entity_ids, delay):
+    if delay:
+        time.sleep(delay)
+    return send_homeassistant_command(domain, service, {"entity_id": entity_ids}, timeout=AUTOMATION_HA_TIMEOUT)
 
-        # Determine new state
-        if command == 'turn_on':
-            new_state = True
-        elif command == 'turn_off':
-            new_state = False
-        elif command == 'toggle':
-            new_state = not current_state
+def _run_automation_batch(automations):
+    """
+    Run every automation firing at the same time in one pass: one device load,
+    one Home Assistant call per (domain, service) chunk and one bulk_write.
+    Automations targeting the same device are applied in order, so two toggles
+    cancel out. With AUTOMATION_BATCH_JITTER set, Home Assistant calls are
+    spread over that many seconds instead of all being sent at once.
+    Returns {automation id: error} for the automations that failed.
+    """
+    failures = {}
+    commands = []
+    for automation in automations:
+        resolved = resolve_automation_command(automation)
+        if resolved:
+            commands.append((automation, *resolved))
+        else:
+            failures[str(automation.get('_id'))] = "Invalid action"
+    if not commands:
+        return failures
+
+    devices = device_registry.get_many([device_id for _, device_id, _ in commands])
+
+    # Net effect per device: a fixed state, or a flip for an odd number of toggles
+    targets = {}  # device ObjectId -> {"state": bool | None, "flips": int}
+    device_automations = {}  # device ObjectId -> ids of the automations targeting it
+    for automation, device_id, command in commands:
+        if device_id not in devices:
+            print(f"Device not found for automation '{automation.get('name')}'")
+            failures[str(automation.get('_id'))] = "Device not found"
+            continue
+        device_automations.setdefault(device_id, []).append(str(automation.get('_id')))
+        target = targets.setdefault(device_id, {"state": None, "flips": 0})
+        if command == 'toggle':
+            target["flips"] += 1
         else:
-            print(f"Unsupported command '{command}' in automation '{automation.get('name')}'")
-            return
-
-        # Control Home Assistant device
-        if device.get('isHomeAssistant'):
-            ha_payload = {"entity_id": device["entityId"]}
-            ha_headers = {
-                "Authorization": f"Bearer {HOME_ASSISTANT_TOKEN}",
-                "Content-Type": "application/json"
-            }
-            ha_service = "turn_on" if new_state else "turn_off"
-            ha_url = f"{HOME_ASSISTANT_URL}/api/services/light/{ha_service}"
-            ha_response = requests.post(ha_url, json=ha_payload, headers=ha_headers)
-
-            if ha_response.status_code != 200:
-                print(f"Failed Home Assistant command: {ha_response.text}")
+            target["state"] = command == 'turn_on'
+            target["flips"] = 0
+
+    ha_groups = {}    # (domain, service) -> [entity_id]
+    ha_devices = {}   # entity_id -> (device ObjectId, new state, or None for a flip)
+    local_updates = []
+    for device_id, target in targets.items():
+        device = devices[device_id]
+        if target["state"] is None and target["flips"] % 2 == 0:
+            continue  # Toggled back to where it was
+        if device.get('isHomeAssistant') and device.get('entityId'):
+            if target["state"] is None:
+                # Home Assistant flips the entity itself; our isOn may be stale
+                new_state, service = None, "toggle"
             else:
-                print(f"Home Assistant device {device['entityId']} set to {ha_service}")
+                new_state = not target["state"] if target["flips"] % 2 else target["state"]
+                service = "turn_on" if new_state else "turn_off"
+            entity_id = device["entityId"]
+            ha_groups.setdefault((entity_id.split('.', 1)[0], service), []).append(entity_id)
+            ha_devices[entity_id] = (device_id, new_state)
         else:
-            print(f"Local device '{device['name']}' set to {'ON' if new_state else 'OFF'}")
+            local_updates.append((device_id, target))
 
-        # Update MongoDB state
-        devices_collection.update_one(
-            {"_id": device_id},
-            {"$set": {"isOn": new_state}}
-        )
+    # Grouped Home Assistant calls, optionally spread out with jitter
+    chunks = [
+        (domain, service, entity_ids[i:i + AUTOMATION_BATCH_CHUNK_SIZE])
+        for (domain, service), entity_ids in ha_groups.items()
+        for i in range(0, len(entity_ids), AUTOMATION_BATCH_CHUNK_SIZE)
+    ]
+    ha_succeeded = []
+    if chunks:
+        with ThreadPoolExecutor(max_workers=min(AUTOMATION_BATCH_MAX_WORKERS, len(chunks))) as pool:
+            futures = [
+                (chunk, pool.submit(
+                    _send_ha_chunk, *chunk,
+                    random.uniform(0, AUTOMATION_BATCH_JITTER) if AUTOMATION_BATCH_JITTER and len(chunks) > 1 else 0
+                ))
+                for chunk in chunks
+            ]
+            for (domain, service, entity_ids), future in futures:
+                ok, error = future.result()
+                if ok:
+                    ha_succeeded.extend(entity_ids)
+                    continue
+                print(f"Failed Home Assistant {domain}.{service} for {len(entity_ids)} entities: {error}")
+                for entity_id in entity_ids:
+                    for automation_id in device_automations[ha_devices[entity_id][0]]:
+                        failures[automation_id] = error
 
-        print(f"Automation '{automation['name']}' executed at {datetime.now()}")
+    # One bulk_write for every state change (local toggles flip atomically in
+    # Mongo); each update stamps its own change version
+    operations, changed_ids = [], []
+    for entity_id in ha_succeeded:
+        device_id, new_state = ha_devices[entity_id]
+        # Flips are mirrored atomically, like the toggle Home Assistant applied
+        operations.append(UpdateOne({"_id": device_id}, db.device_power_update(new_state)))
+        changed_ids.append(device_id)
+    for device_id, target in local_updates:
+        if target["state"] is None:
+            new_state = None
+        else:
+            new_state = not target["state"] if target["flips"] % 2 else target["state"]
+        operations.append(UpdateOne({"_id": device_id}, db.device_power_update(new_state)))
+        changed_ids.append(device_id)
+    if operations:
+        db.devices_collection.bulk_write(operations, ordered=False)
+        for device in db.devices_collection.find({"_id": {"$in": changed_ids}}):
+            device_registry.upsert(device)
 
+    names = ", ".join(f"'{automation.get('name')}'" for automation, _, _ in commands)
+    print(f"Automations {names} executed at {datetime.now()} ({len(operations)} devices changed)")
+    scheduler_stats["batches_run"] += 1
+    scheduler_stats["batched_automations"] += len(commands)
+    return failures
+
+def execute_automation_batch(automations, trigger="time"):
+    """Run a batch of automations, recording its latency and each automation's outcome"""
+    started = time.perf_counter()
+    try:
+        failures = _run_automation_batch(automations)
     except Exception as e:
-        print(f"Error executing automation: {e}")
+        print(f"Error executing automations: {e}")
+        failures = {str(automation.get('_id')): str(e) for automation in automations}
+    duration_ms = round((time.perf_counter() - started) * 1000, 2)
 
-def schedule_automations():
-    scheduler.remove_all_jobs()
-    automations = list(automations_collection.find({"enabled": True}))
+    entries = []
     for automation in automations:
-        cond = automation.get('condition', {})
-        time_str = cond.get('time') or cond.get('value')  # support both formats
-        if time_str:
-            hour, minute = map(int, time_str.split(":"))
-            job_id = str(automation['_id'])
+        error = failures.get(str(automation.get('_id')))
+        outcome = EXECUTION_FAILED if error else EXECUTION_SUCCESS
+        entries.append(build_execution_entry(automation, outcome, duration_ms, trigger, error))
+    automation_metrics.record_batch(duration_ms, [entry["outcome"] for entry in entries])
+    record_executions(entries)
+
+def execute_automation(automation):
+    execute_automation_batch([automation], trigger="state")
+
+# Seconds between full reconciliations of automation jobs against Mongo,
+# catching changes made by other processes or directly in the database
+AUTOMATION_RECONCILE_INTERVAL = 300
+RECONCILE_JOB_ID = "reconcile-automations"
+
+# Time automations sharing an HH:MM run as one batch job per minute slot. The
+# job only stores its "HH:MM" and loads the slot's automations when it fires,
+# so workers changing the same slot never overwrite each other's automations.
+SLOT_JOB_PREFIX = "automation-slot-"
+
+# automation id -> automation document it was scheduled from (this process's view)
+_automation_jobs = {}
+# slot job id -> ids of the automations it runs
+_slot_members = {}
+_jobs_lock = threading.RLock()
+_last_reconcile = 0.0
+# Automations change version (see etags) the last reconciliation started from
+_reconciled_version = None
+
+# State-triggered automations, evaluated on every device change made by this process
+trigger_index = TriggerIndex(execute_automation)
+device_registry.add_listener(trigger_index.evaluate)
+
+# Cost of keeping the scheduler in sync with the automations collection
+scheduler_stats = {
+    "syncs": 0,
+    "reconciles": 0,
+    "jobs_added": 0,
+    "jobs_updated": 0,
+    "jobs_removed": 0,
+    "slot_jobs_written": 0,
+    "batches_run": 0,
+    "batched_automations": 0,
+    "last_reconcile_ms": None,
+    "total_reschedule_ms": 0.0
+}
+
+def get_automation_time(automation):
+    cond = automation.get('condition', {})
+    time_str = cond.get('time') or cond.get('value')  # support both formats
+    if not time_str or not isinstance(time_str, str) or ":" not in time_str:
+        return None
+    try:
+        hour, minute = map(int, time_str.split(":"))
+    except ValueError:
+        return None
+    return hour, minute
+
+def get_slot_job_id(hour, minute):
+    return f"{SLOT_JOB_PREFIX}{hour:02d}:{minute:02d}"
+
+def get_slot_time(slot):
+    """(hour, minute) of a slot job id"""
+    hour, minute = slot[len(SLOT_JOB_PREFIX):].split(":")
+    return int(hour), int(minute)
+
+def load_slot_automations(hour, minute):
+    """The enabled time automations due at hour:minute, read from Mongo"""
+    spellings = [f"{h}:{m}" for h in {str(hour), f"{hour:02d}"} for m in {str(minute), f"{minute:02d}"}]
+    candidates = automations_collection.find({
+        "enabled": True,
+        "$or": [{"condition.time": {"$in": spellings}}, {"condition.value": {"$in": spellings}}]
+    }).sort("_id", 1)
+    return [
+        automation for automation in candidates
+        if parse_state_trigger(automation)[0] is None and get_automation_time(automation) == (hour, minute)
+    ]
 
+def run_automation_slot(slot_time):
+    """Slot job: run the automations due at slot_time ("HH:MM") as one batch"""
+    hour, minute = map(int, slot_time.split(":"))
+    automations = load_slot_automations(hour, minute)
+    if automations:
+        execute_automation_batch(automations)
+
+def get_automation_job(automation_id):
+    """The slot job that runs an automation, or None if it is not scheduled"""
+    with _jobs_lock:
+        automation = _automation_jobs.get(str(automation_id))
+        if automation is None:
+            return None
+        return scheduler.get_job(get_slot_job_id(*get_automation_time(automation)))
+
+def _apply_automation_trigger(automation_id, automation):
+    """Index or unindex a state-triggered automation; True if it is state triggered"""
+    trigger, _ = parse_state_trigger(automation)
+    if trigger is None or not automation.get('enabled', True):
+        trigger_index.remove(automation_id)
+        return trigger is not None
+    if trigger_index.get(automation_id) != automation:
+        trigger_index.add(automation_id, automation, trigger)
+    return True
+
+def _apply_automation_job(automation_id, automation):
+    """
+    Record the new schedule of one automation (None or disabled removes it).
+    Returns the slot job ids that need rewriting, see _write_slot_jobs.
+    """
+    if _apply_automation_trigger(automation_id, automation):
+        automation = None  # State triggered, no time job
+    scheduled_time = get_automation_time(automation) if automation and automation.get('enabled', True) else None
+
+    previous = _automation_jobs.get(automation_id)
+    if previous == automation and scheduled_time is not None:
+        return set()  # Unchanged
+
+    dirty = set()
+    if previous is not None:
+        old_slot = get_slot_job_id(*get_automation_time(previous))
+        _slot_members.get(old_slot, set()).discard(automation_id)
+        dirty.add(old_slot)
+
+    if scheduled_time is None:
+        if previous is not None:
+            del _automation_jobs[automation_id]
+            scheduler_stats["jobs_removed"] += 1
+        return dirty
+
+    slot = get_slot_job_id(*scheduled_time)
+    _slot_members.setdefault(slot, set()).add(automation_id)
+    _automation_jobs[automation_id] = automation
+    dirty.add(slot)
+    scheduler_stats["jobs_updated" if previous is not None else "jobs_added"] += 1
+    return dirty
+
+def _writes_jobs():
+    """
+    Whether this process may write the shared job store: only the lease
+    holder does. Other workers keep their own view and state triggers up to
+    date, and the leader picks their changes up from the automations version.
+    """
+    return not SCHEDULER_LEADER_ELECTION or scheduler_leader.is_leader
+
+def _stored_slot_jobs():
+    """Ids of the slot jobs currently in the job store"""
+    return {job.id for job in scheduler.get_jobs(jobstore='default') if job.id.startswith(SLOT_JOB_PREFIX)}
+
+def _write_slot_jobs(slots, stored=None):
+    """
+    Add the job of each given slot that has automations and no job yet, and
+    remove the job of slots left without any. Since jobs hold no automations,
+    a slot whose automations only changed needs no write. A slot empty in this
+    process's view is checked in Mongo before its job is removed, as another
+    worker may just have scheduled an automation there. Outside the scheduler
+    leader only this process's view is updated.
+    """
+    writes = _writes_jobs()
+    if writes and stored is None:
+        stored = {slot for slot in slots if scheduler.get_job(slot)}
+    for slot in slots:
+        if _slot_members.get(slot):
+            if not writes or slot in stored:
+                continue
+            hour, minute = get_slot_time(slot)
             scheduler.add_job(
-                execute_automation,
+                run_automation_slot,
                 trigger='cron',
-                id=job_id,
+                id=slot,
                 hour=hour,
                 minute=minute,
-                args=[automation],
+                args=[f"{hour:02d}:{minute:02d}"],
+                executor='automations',
+                max_instances=AUTOMATION_MAX_INSTANCES,
                 replace_existing=True
             )
+            scheduler_stats["slot_jobs_written"] += 1
+            continue
+
+        _slot_members.pop(slot, None)
+        if writes and slot in stored and not load_slot_automations(*get_slot_time(slot)):
+            scheduler.remove_job(slot)
+
+def sync_automation(automation_id):
+    """Bring the job of a single automation in line with Mongo after it changed"""
+    started = time.perf_counter()
+    with _jobs_lock:
+        automation = automations_collection.find_one({"_id": ObjectId(automation_id)})
+        _write_slot_jobs(_apply_automation_job(str(automation_id), automation))
+        scheduler_stats["syncs"] += 1
+        scheduler_stats["total_reschedule_ms"] += (time.perf_counter() - started) * 1000
+
+def remove_automation_job(automation_id):
+    """Drop the job of a deleted automation"""
+    with _jobs_lock:
+        _write_slot_jobs(_apply_automation_job(str(automation_id), None))
+        scheduler_stats["syncs"] += 1
+
+def schedule_automations():
+    """
+    Reconcile scheduled jobs with every enabled automation in Mongo.
+    The slots are compared with the jobs in the store, so slot jobs missing
+    or left over (e.g. after another worker's change) are added or removed.
+    """
+    global _last_reconcile, _reconciled_version
+    started = time.perf_counter()
+    _last_reconcile = time.monotonic()
+    with _jobs_lock:
+        _reconciled_version = current_listing_version("automations")
+        automations = {str(a['_id']): a for a in automations_collection.find({"enabled": True})}
+        dirty = set()
+        for automation_id in set(_automation_jobs) | set(trigger_index.ids()):
+            if automation_id not in automations:
+                dirty |= _apply_automation_job(automation_id, None)
+        for automation_id, automation in automations.items():
+            dirty |= _apply_automation_job(automation_id, automation)
+        stored = _stored_slot_jobs() if _writes_jobs() else set()
+        _write_slot_jobs(dirty | set(_slot_members) | stored, stored)
+
+        elapsed = (time.perf_counter() - started) * 1000
+        scheduler_stats["reconciles"] += 1
+        scheduler_stats["last_reconcile_ms"] = round(elapsed, 2)
+        scheduler_stats["total_reschedule_ms"] += elapsed
+
+def get_scheduler_stats():
+    with _jobs_lock:
+        return {
+            **scheduler_stats,
+            "total_reschedule_ms": round(scheduler_stats["total_reschedule_ms"], 2),
+            "scheduled_jobs": len(_automation_jobs),
+            "slot_jobs": len(_slot_members),
+            "state_triggers": trigger_index.stats(),
+            "executions": automation_metrics.stats(),
+            "history_writer": automation_execution_writer.stats()
+        }
+
+def load_persisted_jobs():
+    """
+    Adopt the slot jobs already in the persistent job store, with the enabled
+    automations they run, so the first reconciliation only touches automations
+    that changed while we were down. Per-automation jobs and slot jobs holding
+    automation documents, left by older versions, are dropped and rescheduled
+    into slots by that reconciliation.
+    """
+    with _jobs_lock:
+        slots = set()
+        for job in scheduler.get_jobs(jobstore='default'):
+            if not job.id.startswith(SLOT_JOB_PREFIX) or not isinstance(job.args[0], str):
+                if _writes_jobs():
+                    scheduler.remove_job(job.id, jobstore='default')
+                continue
+            slots.add(job.id)
+        if not slots:
+            return 0
+        for automation in automations_collection.find({"enabled": True}):
+            scheduled_time = get_automation_time(automation)
+            if scheduled_time is None or parse_state_trigger(automation)[0] is not None:
+                continue
+            slot = get_slot_job_id(*scheduled_time)
+            if slot in slots:
+                automation_id = str(automation['_id'])
+                _automation_jobs[automation_id] = automation
+                _slot_members.setdefault(slot, set()).add(automation_id)
+        return len(_automation_jobs)
+
+def _on_job_not_run(event):
+    """
+    Record automation runs APScheduler did not execute: skipped because the
+    previous run of the slot was still busy (overrun), or missed beyond the
+    misfire grace time, or a batch that raised.
+    """
+    if not event.job_id.startswith(SLOT_JOB_PREFIX):
+        return
+    automations = load_slot_automations(*get_slot_time(event.job_id))
+    if event.code == EVENT_JOB_MAX_INSTANCES:
+        outcome, error = EXECUTION_SKIPPED, "Previous run still in progress"
+        print(f"Automation slot {event.job_id} skipped: previous run still in progress")
+    elif event.code == EVENT_JOB_MISSED:
+        outcome, error = EXECUTION_MISSED, "Missed by more than the misfire grace time"
+    else:
+        outcome, error = EXECUTION_FAILED, str(event.exception)
+    automation_metrics.record(outcome, len(automations))
+    record_executions([build_execution_entry(a, outcome, error=error) for a in automations])
+
+scheduler.add_listener(_on_job_not_run, EVENT_JOB_MAX_INSTANCES | EVENT_JOB_MISSED | EVENT_JOB_ERROR)
+
+def _add_reconcile_job():
+    if not scheduler.get_job(RECONCILE_JOB_ID, jobstore='memory'):
+        scheduler.add_job(
+            schedule_automations,
+            trigger='interval',
+            id=RECONCILE_JOB_ID,
+            seconds=AUTOMATION_RECONCILE_INTERVAL,
+            jobstore='memory',
+            replace_existing=True
+        )
+
+def retrain_usage_forests():
+    """Periodic batch retrain of the per-device forest models (run by the training queue)"""
+    from ml_models import device_predictor
+    queued = device_predictor.retrain_all()
+    print(f"Queued {queued} device usage models for retraining")
+
+def _add_ml_retrain_job():
+    if ML_FOREST_RETRAIN_HOURS > 0 and not scheduler.get_job("retrain-usage-forests", jobstore='memory'):
+        scheduler.add_job(
+            retrain_usage_forests,
+            trigger='interval',
+            id="retrain-usage-forests",
+            hours=ML_FOREST_RETRAIN_HOURS,
+            jobstore='memory',
+            replace_existing=True
+        )
+
+def _on_elected():
+    """This process now owns scheduling: pick up the shared jobs and run them"""
+    load_persisted_jobs()
+    schedule_automations()
+    scheduler.resume()
+
+def _on_demoted():
+    scheduler.pause()
+
+def _on_election_step(is_leader):
+    if is_leader:
+        # Automations changed through other workers only reach the job store here
+        if current_listing_version("automations") != _reconciled_version:
+            schedule_automations()
+        scheduler.wakeup()
+    elif time.monotonic() - _last_reconcile > AUTOMATION_RECONCILE_INTERVAL:
+        # Followers run no jobs but still evaluate state triggers for their own writes
+        schedule_automations()
+
+scheduler_leader = LeaderElector(
+    "automation-scheduler",
+    ttl=SCHEDULER_LEASE_TTL,
+    renew_interval=SCHEDULER_LEASE_RENEW_INTERVAL,
+    on_elected=_on_elected,
+    on_demoted=_on_demoted,
+    on_step=_on_election_step
+)
 
 def start_scheduler():
-    scheduler.start()
+    """
+    Start the scheduler. With leader election every process starts it paused
+    and only the lease holder writes the shared job store and runs jobs.
+    """
+    if scheduler.running:
+        return
+    scheduler.start(paused=SCHEDULER_LEADER_ELECTION)
+    adopted = load_persisted_jobs()
+    print(f"Scheduler started with {adopted} persisted automation jobs")
+    _add_reconcile_job()
+    _add_ml_retrain_job()
+    schedule_automations()
+    if SCHEDULER_LEADER_ELECTION:
+        scheduler_leader.start()
+        atexit.register(scheduler_leader.stop)
+
+def get_scheduler_leader():
+    """The process currently holding the scheduler lease, as seen from this one"""
+    if not SCHEDULER_LEADER_ELECTION:
+        return {"election": False, "leader": scheduler_leader.identity if scheduler.running else None}
+    lease = scheduler_leader.current_leader()
+    return {
+        "election": True,
+        "leader": lease["owner"] if lease else None,
+        "acquired_at": lease["acquired_at"].isoformat() if lease and lease.get("acquired_at") else None,
+        "expires_at": lease["expires_at"].isoformat() if lease else None,
+        "this_process": scheduler_leader.stats()
+    }
@@ -12,6 +12,7 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')
 from app import app
 import db
 from models.device_log import log_device_action
+from models.log_schema import encode_log_entry, delete_logs
 
 @pytest.fixture
 def client():
@@ -124,7 +125,7 @@ def cleanup():
     # Clean up test data
     db.devices_collection.delete_many({"name": {"$regex": "^MOCK_"}})
     db.rooms_collection.delete_many({"name": {"$regex": "^MOCK_"}})
-    db.device_logs.delete_many({"user": {"$in": ["analyticsuser", "testuser2"]}})
+    delete_logs({"user": {"$in": ["analyticsuser", "testuser2"]}})
     db.users_collection.delete_many({"username": {"$in": ["analyticsuser", "testuser2"]}})
 
 # Test Basic Analytics Endpoints
@@ -498,3 +499,35 @@ def test_comprehensive_filter_combination(client, auth_headers, sample_devices,
     
     data = response.get_json()
     assert isinstance(data, list)
+
+def test_compact_and_legacy_logs_decode_together(client, auth_headers, sample_devices, sample_logs):
+    """Compact (v2) log documents are decoded transparently alongside original ones"""
+    db.device_logs.insert_many([
+        encode_log_entry({
+            "user": "testuser2",
+            "device": sample_devices["device1"],
+            "action": "toggle",
+            "result": "error: Connection timeout",
+            "timestamp": datetime.utcnow() - timedelta(minutes=5),
+            "is_error": True,
+            "error_type": "timeout"
+        }),
+        encode_log_entry({
+            "user": "testuser2",
+            "device": sample_devices["device1"],
+            "action": "toggle",
+            "result": "on",
+            "timestamp": datetime.utcnow() - timedelta(minutes=4),
+            "is_error": False
+        })
+    ])
+    stored = db.device_logs.find_one({"u": "testuser2", "v": 2})
+    assert stored["a"] == 1 and "action" not in stored
+
+    response = client.get('/api/analytics/error-types', headers=auth_headers)
+    assert response.status_code == 200
+    timeouts = [r for r in response.get_json() if r["error_type"] == "timeout"]
+    assert timeouts and timeouts[0]["count"] >= 2
+
+    response = client.get('/api/analytics/usage-per-user?user=testuser2', headers=auth_headers)
+    assert response.get_json() == [{"user": "testuser2", "actions": 3}]
@@ -0,0 +1,129 @@
+import pytest
+import sys
+import os
+from bson import ObjectId
+import httpx
+from unittest.mock import patch, AsyncMock
+from starlette.testclient import TestClient
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from app import app as flask_app
+import asgi
+from asgi import app
+import db
+from models.log_schema import delete_logs
+
+@pytest.fixture(autouse=True)
+def cleanup_mock_devices():
+    yield
+    db.devices_collection.delete_many({"name": {"$regex": "^MOCK_"}})
+
+@pytest.fixture
+def client():
+    # The lifespan would start the real scheduler and its leader election threads
+    with patch('asgi.start_scheduler'):
+        with TestClient(app) as client:
+            yield client
+
+@pytest.fixture
+def auth_headers():
+    flask_app.config['TESTING'] = True
+    with flask_app.test_client() as flask_client:
+        flask_client.post('/api/auth/register', json={
+            'username': 'asynctester',
+            'email': 'asynctester@gmail.com',
+            'password': 'ValidPass123'
+        })
+        login = flask_client.post('/api/auth/login', json={
+            'username': 'asynctester',
+            'password': 'ValidPass123'
+        })
+    token = login.get_json().get('access_token')
+    return {'Authorization': f'Bearer {token}'}
+
+def test_async_toggle_requires_token(client):
+    response = client.post(f'/api/devices/{ObjectId()}/toggle')
+    assert response.status_code == 401
+
+def test_async_toggle_local_device(client, auth_headers):
+    device_id = ObjectId()
+    db.devices_collection.insert_one({
+        "_id": device_id,
+        "name": "MOCK_Async Lamp",
+        "type": "light",
+        "isHomeAssistant": False,
+        "isOn": False
+    })
+
+    response = client.post(f'/api/devices/{device_id}/toggle', headers=auth_headers)
+    assert response.status_code == 200
+    assert response.json()['isOn'] is True
+    assert db.devices_collection.find_one({"_id": device_id})['isOn'] is True
+    delete_logs({"device": str(device_id)})
+
+def test_async_toggle_homeassistant_device_stamps_version(client, auth_headers):
+    device_id = ObjectId()
+    db.devices_collection.insert_one({
+        "_id": device_id,
+        "name": "MOCK_Async HA Light",
+        "type": "light",
+        "isHomeAssistant": True,
+        "entityId": "light.mock_async_ha_light",
+        "isOn": False
+    })
+    counter = db.counters_collection.find_one({"_id": "devices"})
+
+    # Sent through the shared httpx client, not a worker thread
+    ha_response = httpx.Response(200, json=[{"entity_id": "light.mock_async_ha_light", "state": "on"}])
+    with patch.object(asgi.ha_client, 'post', new=AsyncMock(return_value=ha_response)) as mock_post:
+        response = client.post(f'/api/devices/{device_id}/toggle', headers=auth_headers)
+    assert response.status_code == 200
+    assert response.json()['isOn'] is True
+    assert mock_post.call_args[0][0] == "/api/services/light/toggle"
+    assert db.devices_collection.find_one({"_id": device_id})['version'] > 0
+    # Stamped by the device update itself, without a counter round trip
+    assert db.counters_collection.find_one({"_id": "devices"}) == counter
+    delete_logs({"device": "light.mock_async_ha_light"})
+
+def test_async_toggle_optimistic_local_device(client, auth_headers):
+    device_id = ObjectId()
+    db.devices_collection.insert_one({
+        "_id": device_id,
+        "name": "MOCK_Async Optimistic Lamp",
+        "type": "light",
+        "isHomeAssistant": False,
+        "isOn": False
+    })
+
+    # Same optimistic mode as the Flask route
+    response = client.post(f'/api/devices/{device_id}/toggle?optimistic=true', headers=auth_headers)
+    assert response.status_code == 200
+    assert response.json()['status'] == 'confirmed'
+    assert response.json()['device']['isOn'] is True
+    delete_logs({"device": str(device_id)})
+
+def test_async_toggle_rejects_refresh_token(client):
+    from flask_jwt_extended import create_refresh_token
+    with flask_app.app_context():
+        token = create_refresh_token(identity=str(ObjectId()))
+    response = client.post(f'/api/devices/{ObjectId()}/toggle', headers={'Authorization': f'Bearer {token}'})
+    assert response.status_code == 401
+
+def test_async_temperature_not_thermostat(client, auth_headers):
+    device_id = ObjectId()
+    db.devices_collection.insert_one({
+        "_id": device_id,
+        "name": "MOCK_Async Not Thermostat",
+        "type": "light",
+        "isOn": False
+    })
+
+    response = client.post(f'/api/devices/{device_id}/temperature', json={"temperature": 20}, headers=auth_headers)
+    assert response.status_code == 400
+    assert response.json()['error'] == 'Not a thermostat'
+    delete_logs({"device": str(device_id)})
+
+def test_flask_routes_served_through_asgi(client):
+    response = client.get('/api/devices')
+    assert response.status_code == 200
+    assert isinstance(response.json(), list)
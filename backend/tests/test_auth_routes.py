@@ -187,3 +187,23 @@ def test_initialize_admin(client):
     })
     print("Initialize admin status:", response.status_code)
     assert response.status_code in [200, 201, 403]
+
+def test_tokens_carry_username_claim(client):
+    from flask_jwt_extended import decode_token
+    client.post('/api/auth/register', json={
+        'username': 'claimuser',
+        'email': 'claimuser@gmail.com',
+        'password': 'ValidPass123'
+    })
+    login = client.post('/api/auth/login', json={
+        'username': 'claimuser',
+        'password': 'ValidPass123'
+    }).get_json()
+
+    refreshed = client.post('/api/auth/refresh', headers={
+        'Authorization': f"Bearer {login['refresh_token']}"
+    }).get_json()
+
+    with app.app_context():
+        assert decode_token(login['access_token'])['username'] == 'claimuser'
+        assert decode_token(refreshed['access_token'])['username'] == 'claimuser'
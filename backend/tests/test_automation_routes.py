@@ -3,6 +3,8 @@ import sys
 import os
 from bson import ObjectId
 from uuid import uuid4
+import time
+from unittest.mock import patch
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from app import app
@@ -33,6 +35,28 @@ def cleanup_mock_automations():
     yield
     db.automations_collection.delete_many({"name": {"$regex": "^MOCK_"}})
 
+@pytest.fixture
+def running_scheduler():
+    """
+    A started (paused) scheduler, so jobs read back from the store are real
+    Job objects. Started here rather than through start_scheduler so no leader
+    election runs, and only shut down again if this fixture started it.
+    """
+    from scheduler import scheduler
+    started = not scheduler.running
+    if started:
+        scheduler.start(paused=True)
+    yield scheduler
+    if started:
+        scheduler.shutdown(wait=False)
+
+@pytest.fixture
+def scheduler_leader_role():
+    """Make this process the scheduler leader, the only one writing jobs"""
+    from scheduler import scheduler_leader
+    with patch.object(scheduler_leader, 'is_leader', True):
+        yield
+
 def test_get_automations(client, auth_headers):
     response = client.get('/api/automations/', headers=auth_headers)
     assert response.status_code == 200
@@ -215,3 +239,324 @@ def test_create_automation_invalid_command(client, auth_headers):
     }
     response = client.post('/api/automations/', json=automation_data, headers=auth_headers)
     assert response.status_code in [201, 400]  
+
+def test_get_automations_conditional_get_invalidated_by_toggle(client, auth_headers):
+    inserted = db.automations_collection.insert_one({
+        "name": "MOCK_ETag Automation",
+        "type": "time",
+        "condition": {"time": "06:00"},
+        "action": {"deviceId": ObjectId(), "command": "toggle"},
+        "enabled": True
+    })
+    etag = client.get('/api/automations/', headers=auth_headers).headers.get('ETag')
+    assert etag
+
+    client.post(f'/api/automations/{inserted.inserted_id}/toggle', headers=auth_headers)
+    response = client.get('/api/automations/', headers={**auth_headers, 'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers.get('ETag') != etag
+
+def test_automation_changes_sync_only_their_job(client, auth_headers, scheduler_leader_role):
+    from scheduler import get_automation_job, get_scheduler_stats
+    before = get_scheduler_stats()
+
+    automation_id = client.post('/api/automations/', json={
+        "name": "MOCK_Synced Automation",
+        "type": "time",
+        "condition": {"time": "06:30"},
+        "action": {"deviceId": "000000000000000000000000", "command": "turn_on"}
+    }, headers=auth_headers).get_json()['id']
+    assert get_automation_job(automation_id) is not None
+
+    # Plain requests no longer rebuild the scheduler
+    client.get('/api/automations/', headers=auth_headers)
+    assert get_scheduler_stats()['reconciles'] == before['reconciles']
+
+    client.post(f'/api/automations/{automation_id}/toggle', headers=auth_headers)
+    assert get_automation_job(automation_id) is None
+
+    client.post(f'/api/automations/{automation_id}/toggle', headers=auth_headers)
+    assert get_automation_job(automation_id) is not None
+
+    client.delete(f'/api/automations/{automation_id}', headers=auth_headers)
+    assert get_automation_job(automation_id) is None
+
+    stats = client.get('/api/automations/scheduler/stats', headers=auth_headers).get_json()
+    assert stats['jobs_added'] >= before['jobs_added'] + 2
+    assert stats['jobs_removed'] >= before['jobs_removed'] + 2
+
+def test_scheduler_adopts_persisted_jobs(client, auth_headers, running_scheduler, scheduler_leader_role):
+    from scheduler import (
+        get_automation_job, load_persisted_jobs, schedule_automations, get_scheduler_stats, _automation_jobs
+    )
+
+    automation_id = client.post('/api/automations/', json={
+        "name": "MOCK_Persisted Automation",
+        "type": "time",
+        "condition": {"time": "07:15"},
+        "action": {"deviceId": "000000000000000000000000", "command": "turn_off"}
+    }, headers=auth_headers).get_json()['id']
+    job = get_automation_job(automation_id)
+    assert job.misfire_grace_time is not None
+    assert job.coalesce is True
+    schedule_automations()
+
+    # Simulate a restart: forget what was scheduled, then attach to the stored jobs
+    _automation_jobs.clear()
+    load_persisted_jobs()
+    assert automation_id in _automation_jobs
+
+    before = get_scheduler_stats()
+    schedule_automations()
+    after = get_scheduler_stats()
+    assert after['jobs_added'] == before['jobs_added']
+    assert after['jobs_updated'] == before['jobs_updated']
+
+    client.delete(f'/api/automations/{automation_id}', headers=auth_headers)
+
+def test_slot_job_keeps_automations_of_other_workers(client, auth_headers, running_scheduler, scheduler_leader_role):
+    from scheduler import get_slot_job_id, load_slot_automations
+    # Scheduled in the same minute by another worker, unknown to this process
+    other_id = db.automations_collection.insert_one({
+        "name": "MOCK_Other Worker Automation",
+        "type": "time",
+        "enabled": True,
+        "condition": {"time": "06:45"},
+        "action": {"deviceId": "000000000000000000000000", "command": "turn_on"}
+    }).inserted_id
+
+    automation_id = client.post('/api/automations/', json={
+        "name": "MOCK_Slot Neighbour Automation",
+        "type": "time",
+        "condition": {"time": "6:45"},
+        "action": {"deviceId": "000000000000000000000000", "command": "turn_off"}
+    }, headers=auth_headers).get_json()['id']
+    client.delete(f'/api/automations/{automation_id}', headers=auth_headers)
+
+    # The slot job stays for the other automation, which it loads when it fires
+    assert running_scheduler.get_job(get_slot_job_id(6, 45)) is not None
+    due = [str(a['_id']) for a in load_slot_automations(6, 45)]
+    assert str(other_id) in due
+    assert automation_id not in due
+
+    running_scheduler.remove_job(get_slot_job_id(6, 45))
+
+def test_follower_changes_reach_jobs_through_leader(client, auth_headers, running_scheduler):
+    from scheduler import get_automation_job, scheduler_leader, _on_election_step
+
+    # A worker without the scheduler lease leaves the shared job store alone
+    with patch.object(scheduler_leader, 'is_leader', False):
+        automation_id = client.post('/api/automations/', json={
+            "name": "MOCK_Follower Automation",
+            "type": "time",
+            "condition": {"time": "05:25"},
+            "action": {"deviceId": "000000000000000000000000", "command": "turn_on"}
+        }, headers=auth_headers).get_json()['id']
+    assert get_automation_job(automation_id) is None
+
+    # The leader notices the changed automations version on its next election step
+    with patch.object(scheduler_leader, 'is_leader', True):
+        _on_election_step(True)
+        assert get_automation_job(automation_id) is not None
+        client.delete(f'/api/automations/{automation_id}', headers=auth_headers)
+    assert get_automation_job(automation_id) is None
+
+def test_create_state_automation_invalid_operator(client, auth_headers):
+    response = client.post('/api/automations/', json={
+        "name": "MOCK_Bad Trigger",
+        "type": "state",
+        "condition": {"deviceId": str(ObjectId()), "attribute": "isOn", "operator": "between", "value": True},
+        "action": {"deviceId": str(ObjectId()), "command": "turn_on"}
+    }, headers=auth_headers)
+    assert response.status_code == 400
+    assert "operator" in response.get_json()['error']
+
+def test_state_automation_fires_on_toggle(client, auth_headers):
+    from scheduler import get_scheduler_stats
+    lamp_id = db.devices_collection.insert_one(
+        {"name": "MOCK_Trigger Lamp", "type": "light", "isHomeAssistant": False, "isOn": False}).inserted_id
+    fan_id = db.devices_collection.insert_one(
+        {"name": "MOCK_Triggered Fan", "type": "fan", "isHomeAssistant": False, "isOn": False}).inserted_id
+
+    automation_id = client.post('/api/automations/', json={
+        "name": "MOCK_Lamp Turns Fan On",
+        "type": "state",
+        "condition": {"deviceId": str(lamp_id), "attribute": "isOn", "operator": "eq", "value": True},
+        "action": {"deviceId": str(fan_id), "command": "turn_on"}
+    }, headers=auth_headers).get_json()['id']
+    before = get_scheduler_stats()['state_triggers']
+
+    assert client.post(f'/api/devices/{lamp_id}/toggle', headers=auth_headers).status_code == 200
+
+    # The automation runs on the trigger pool, off the request thread
+    for _ in range(50):
+        if db.devices_collection.find_one({"_id": fan_id})['isOn']:
+            break
+        time.sleep(0.05)
+    assert db.devices_collection.find_one({"_id": fan_id})['isOn'] is True
+    assert get_scheduler_stats()['state_triggers']['fired'] == before['fired'] + 1
+
+    client.delete(f'/api/automations/{automation_id}', headers=auth_headers)
+    db.devices_collection.delete_many({"_id": {"$in": [lamp_id, fan_id]}})
+
+@patch('requests.post')
+def test_same_minute_automations_run_as_one_batch(mock_post, client, auth_headers, scheduler_leader_role):
+    from scheduler import get_automation_job, execute_automation_batch, load_slot_automations
+    mock_post.return_value.status_code = 200
+    lamp_id, heater_id = ObjectId(), ObjectId()
+    ha_ids = [ObjectId(), ObjectId()]
+    db.devices_collection.insert_many([
+        {"_id": lamp_id, "name": "MOCK_Batch Lamp", "type": "light", "isHomeAssistant": False, "isOn": False},
+        {"_id": heater_id, "name": "MOCK_Batch Heater", "type": "switch", "isHomeAssistant": False, "isOn": True},
+        *[{"_id": ha_id, "name": f"MOCK_Batch HA Light {i}", "type": "light", "isHomeAssistant": True,
+           "entityId": f"light.mock_batch_{i}", "isOn": False} for i, ha_id in enumerate(ha_ids)]
+    ])
+
+    targets = [(lamp_id, "turn_on"), (heater_id, "toggle"), (ha_ids[0], "turn_on"), (ha_ids[1], "turn_on")]
+    automation_ids = [
+        client.post('/api/automations/', json={
+            "name": f"MOCK_Batch Automation {i}",
+            "type": "time",
+            "condition": {"time": "23:59"},
+            "action": {"deviceId": str(device_id), "command": command}
+        }, headers=auth_headers).get_json()['id']
+        for i, (device_id, command) in enumerate(targets)
+    ]
+
+    # One job for the whole minute slot, loading its automations when it fires
+    job = get_automation_job(automation_ids[0])
+    assert all(get_automation_job(a).id == job.id for a in automation_ids)
+    assert job.args == ["23:59"]
+    due = load_slot_automations(23, 59)
+    assert {str(a['_id']) for a in due} >= set(automation_ids)
+
+    execute_automation_batch([a for a in due if str(a['_id']) in automation_ids])
+
+    # Both Home Assistant lights in a single grouped call
+    assert mock_post.call_count == 1
+    assert sorted(mock_post.call_args.kwargs['json']['entity_id']) == ["light.mock_batch_0", "light.mock_batch_1"]
+    assert db.devices_collection.find_one({"_id": lamp_id})['isOn'] is True
+    assert db.devices_collection.find_one({"_id": heater_id})['isOn'] is False
+    assert all(db.devices_collection.find_one({"_id": ha_id})['isOn'] for ha_id in ha_ids)
+
+    # Every automation of the batch gets an execution record
+    from models.automation_execution import automation_execution_writer
+    automation_execution_writer.flush()
+    executions = client.get(f'/api/automations/{automation_ids[0]}/executions', headers=auth_headers).get_json()
+    assert executions[0]['outcome'] == "success"
+    assert executions[0]['trigger'] == "time"
+    assert executions[0]['duration_ms'] is not None
+    stats = client.get('/api/automations/scheduler/stats', headers=auth_headers).get_json()
+    assert stats['executions']['outcomes']['success'] >= 4
+
+    for automation_id in automation_ids:
+        client.delete(f'/api/automations/{automation_id}', headers=auth_headers)
+    assert get_automation_job(automation_ids[0]) is None
+    db.devices_collection.delete_many({"_id": {"$in": [lamp_id, heater_id, *ha_ids]}})
+    db.automation_executions_collection.delete_many({"automation_id": {"$in": automation_ids}})
+
+@patch('requests.post')
+def test_batch_toggles_homeassistant_device_with_toggle_service(mock_post):
+    from scheduler import execute_automation_batch
+    mock_post.return_value.status_code = 200
+    device_id = ObjectId()
+    db.devices_collection.insert_one({
+        "_id": device_id, "name": "MOCK_Batch HA Switch", "type": "switch",
+        "isHomeAssistant": True, "entityId": "switch.mock_batch_toggle", "isOn": False
+    })
+    automation_id = ObjectId()
+
+    execute_automation_batch([{
+        "_id": automation_id,
+        "name": "MOCK_Batch Toggle",
+        "action": {"deviceId": str(device_id), "command": "toggle"}
+    }])
+
+    # A pure flip is left to Home Assistant rather than derived from our isOn
+    assert mock_post.call_args[0][0].endswith('/api/services/switch/toggle')
+    assert db.devices_collection.find_one({"_id": device_id})['isOn'] is True
+    db.devices_collection.delete_one({"_id": device_id})
+    db.automation_executions_collection.delete_many({"automation_id": str(automation_id)})
+
+def test_scheduler_lease_fails_over_on_expiry():
+    from datetime import datetime, timezone, timedelta
+    from leader_election import LeaderElector
+    first = LeaderElector("MOCK_lease", ttl=30, renew_interval=10)
+    second = LeaderElector("MOCK_lease", ttl=30, renew_interval=10)
+    try:
+        first.step()
+        second.step()
+        assert first.is_leader and not second.is_leader
+        assert first.current_leader()["owner"] == first.identity
+
+        # First stops renewing and its lease runs out
+        db.scheduler_leases_collection.update_one(
+            {"_id": "MOCK_lease"}, {"$set": {"expires_at": datetime.now(timezone.utc) - timedelta(seconds=1)}})
+        second.step()
+        first.step()
+        assert second.is_leader and not first.is_leader
+
+        second.release()
+        first.step()
+        assert first.is_leader
+    finally:
+        db.scheduler_leases_collection.delete_one({"_id": "MOCK_lease"})
+
+def test_get_scheduler_leader(client, auth_headers):
+    response = client.get('/api/automations/scheduler/leader', headers=auth_headers)
+    assert response.status_code == 200
+    assert 'election' in response.get_json()
+
+@patch('requests.post')
+def test_failed_home_assistant_call_recorded(mock_post, client, auth_headers):
+    from scheduler import execute_automation_batch
+    from models.automation_execution import automation_execution_writer
+    mock_post.return_value.status_code = 500
+    mock_post.return_value.text = "boom"
+    light_id = db.devices_collection.insert_one({"name": "MOCK_Failing HA Light", "type": "light",
+        "isHomeAssistant": True, "entityId": "light.mock_failing", "isOn": False}).inserted_id
+    automation = {"_id": ObjectId(), "name": "MOCK_Failing Automation",
+                  "action": {"deviceId": str(light_id), "command": "turn_on"}}
+
+    execute_automation_batch([automation])
+    automation_execution_writer.flush()
+
+    execution = db.automation_executions_collection.find_one({"automation_id": str(automation["_id"])})
+    assert execution['outcome'] == "failed"
+    assert "boom" in execution['error']
+    assert db.devices_collection.find_one({"_id": light_id})['isOn'] is False
+    db.devices_collection.delete_one({"_id": light_id})
+    db.automation_executions_collection.delete_many({"automation_id": str(automation["_id"])})
+
+def test_simulate_draft_automations(client, auth_headers):
+    lamp, fan = str(ObjectId()), str(ObjectId())
+    drafts = [
+        {"name": "MOCK_Sim Lamp On", "type": "time", "condition": {"time": "07:00"},
+         "action": {"deviceId": lamp, "command": "turn_on"}},
+        {"name": "MOCK_Sim Lamp Off", "type": "time", "condition": {"time": "07:00"},
+         "action": {"deviceId": lamp, "command": "turn_off"}},
+        {"name": "MOCK_Sim Fan", "type": "time", "condition": {"time": "08:30"},
+         "action": {"deviceId": fan, "command": "toggle"}},
+        {"name": "MOCK_Sim Follow Fan", "type": "state",
+         "condition": {"deviceId": fan, "attribute": "isOn", "operator": "eq", "value": True},
+         "action": {"deviceId": lamp, "command": "turn_on"}}
+    ]
+    response = client.post('/api/automations/simulate', json={
+        "start": "2026-01-01T08:00:00", "days": 2, "draftsOnly": True, "automations": drafts
+    }, headers=auth_headers)
+    assert response.status_code == 200
+    report = response.get_json()
+
+    # The window runs Jan 1 08:00 to Jan 3 08:00: the two 07:00 automations
+    # fire on Jan 2 and Jan 3, the 08:30 one on Jan 1 and Jan 2
+    assert report['total_fires'] == 2 * 2 + 1 * 2
+    assert report['peak']['time'] == "07:00"
+    assert report['peak']['fires'] == 2
+    assert len(report['conflicts']) == 1
+    assert report['conflicts'][0]['deviceId'] == lamp
+    assert report['cascades'][0]['to']['name'] == "MOCK_Sim Follow Fan"
+    assert db.automations_collection.count_documents({"name": {"$regex": "^MOCK_Sim"}}) == 0
+
+def test_simulate_invalid_window(client, auth_headers):
+    response = client.post('/api/automations/simulate', json={"days": 1000}, headers=auth_headers)
+    assert response.status_code == 400
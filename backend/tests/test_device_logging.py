@@ -62,8 +62,12 @@ def test_toggle_device_logs_action(client):
     assert toggle_resp.status_code == 200
 
     # --- ASSERT: Check the log in device_logs (direct db access for test) ---
-    from db import device_logs, users_collection, devices_collection, rooms_collection
-    log = device_logs.find_one({"device": device_id, "action": "toggle"})
+    from db import users_collection, devices_collection, rooms_collection
+    from models.device_log import device_log_writer
+    device_log_writer.flush()  # logs are written in the background
+    from models.log_schema import find_logs, delete_logs
+    logs = find_logs({"device": device_id, "action": "toggle"}, limit=1)
+    log = logs[0] if logs else None
     assert log is not None, "No log entry found for device toggle"
     assert log["user"] == username, "Log does not contain correct username"
     assert log["result"] in ["on", "off"], "Log result is not on/off"
@@ -72,4 +76,85 @@ def test_toggle_device_logs_action(client):
     users_collection.delete_one({"username": username})
     devices_collection.delete_one({"_id": ObjectId(device_id)})
     rooms_collection.delete_one({"_id": ObjectId(room_id)})
-    device_logs.delete_many({"device": device_id})
+    delete_logs({"device": device_id})
+
+
+def test_device_log_writer_batches_and_counts_drops():
+    """
+    The buffered writer batches entries with insert_many and counts entries it had to drop.
+    """
+    from models.device_log import DeviceLogWriter, build_log_entry
+    from models.log_schema import find_logs, delete_logs
+
+    writer = DeviceLogWriter(max_queue=5, batch_size=3, flush_interval=60, put_timeout=0)
+    # Hold the background thread back so the queue fills up
+    writer._ensure_started = lambda: None
+    for i in range(7):
+        writer.submit(build_log_entry("testuser_writer", "MOCK_writer_device", "toggle", "on"))
+
+    stats = writer.stats()
+    assert stats["queued"] == 5
+    assert stats["dropped"] == 2
+    assert stats["backpressured"] == 2
+
+    writer.flush()
+    stats = writer.stats()
+    assert stats["written"] == 5
+    assert stats["batches"] == 2
+    assert len(find_logs({"device": "MOCK_writer_device"})) == 5
+    delete_logs({"device": "MOCK_writer_device"})
+
+
+def test_device_log_writer_collapses_error_storms():
+    """
+    Identical errors within the dedup window become one document with a count.
+    """
+    from models.device_log import DeviceLogWriter, build_log_entry
+    from models.log_schema import find_logs, delete_logs
+
+    writer = DeviceLogWriter(max_queue=100, batch_size=50, flush_interval=60, dedup_window=3600)
+    writer._ensure_started = lambda: None
+    for _ in range(5):
+        writer.submit(build_log_entry("testuser_storm", "MOCK_storm_device", "toggle", "error: connection refused", True, "connection_error"))
+    writer.flush()
+    # A later batch in the same window folds into the same document
+    writer.submit(build_log_entry("testuser_storm", "MOCK_storm_device", "toggle", "error: connection refused", True, "connection_error"))
+    writer.submit(build_log_entry("testuser_storm", "MOCK_storm_device", "toggle", "on"))
+    writer.flush()
+
+    errors = find_logs({"device": "MOCK_storm_device", "is_error": True})
+    assert len(errors) == 1
+    assert errors[0]["count"] == 6
+    assert errors[0]["last_timestamp"] >= errors[0]["timestamp"]
+    assert len(find_logs({"device": "MOCK_storm_device", "is_error": False})) == 1
+    assert writer.stats()["deduplicated"] == 5
+    delete_logs({"device": "MOCK_storm_device"})
+
+
+def test_aggregate_logs_groups_both_layouts_on_stored_codes():
+    """
+    Compact and not yet migrated documents group together, and only the
+    grouped output is decoded back to names; find_logs merges both layouts.
+    """
+    import db
+    from models.device_log import build_log_entry
+    from models.log_schema import aggregate_logs, find_logs, delete_logs, encode_log_entry
+
+    compact = build_log_entry("testuser_layouts", "MOCK_layout_device", "toggle", "on")
+    legacy = build_log_entry("testuser_layouts", "MOCK_layout_device", "toggle", "off")
+    legacy["timestamp"] = compact["timestamp"].replace(year=compact["timestamp"].year - 1)
+    db.device_logs.insert_one(encode_log_entry(compact))
+    db.device_logs.insert_one(legacy)
+
+    rows = list(aggregate_logs([
+        {"$match": {"device": "MOCK_layout_device"}},
+        {"$group": {"_id": "$action", "count": {"$sum": 1}, "results": {"$addToSet": "$result"}}}
+    ]))
+    assert len(rows) == 1
+    assert rows[0]["_id"] == "toggle"
+    assert rows[0]["count"] == 2
+    assert sorted(rows[0]["results"]) == ["off", "on"]
+
+    latest = find_logs({"device": "MOCK_layout_device"}, sort=[("timestamp", -1)], limit=1)
+    assert [log["result"] for log in latest] == ["on"]
+    delete_logs({"device": "MOCK_layout_device"})
@@ -13,6 +13,7 @@ load_dotenv()
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from app import app
 import db
+from models.log_schema import delete_logs
 
 def ensure_dummy_thermostat():
     thermostat_id = ObjectId("111111111111111111111111")
@@ -157,3 +158,496 @@ def test_real_ha_device_toggle():
 
     print("HA Response:", response.text)
     assert response.status_code == 200
+
+def test_bulk_commands_missing_data(client, auth_headers):
+    response = client.post('/api/devices/commands', json={}, headers=auth_headers)
+    assert response.status_code == 400
+    assert response.get_json().get('error') == 'Commands list required'
+
+def test_bulk_commands_local_devices(client, auth_headers):
+    lamp_id = ObjectId()
+    thermostat_id = ObjectId()
+    db.devices_collection.insert_many([
+        {"_id": lamp_id, "name": "MOCK_Bulk Lamp", "type": "light", "isHomeAssistant": False, "isOn": False},
+        {"_id": thermostat_id, "name": "MOCK_Bulk Thermostat", "type": "thermostat", "isHomeAssistant": False, "isOn": True}
+    ])
+
+    response = client.post('/api/devices/commands', json={
+        "commands": [
+            {"deviceId": str(lamp_id), "command": "turn_on"},
+            {"deviceId": str(thermostat_id), "command": "set_temperature", "temperature": 21},
+            {"deviceId": "ffffffffffffffffffffffff", "command": "toggle"},
+            {"deviceId": str(lamp_id), "command": "reboot"}
+        ]
+    }, headers=auth_headers)
+    assert response.status_code == 200
+    data = response.get_json()
+    assert data['succeeded'] == 2
+    assert data['failed'] == 2
+    assert [r['status'] for r in data['results']] == ['success', 'success', 'error', 'error']
+
+    assert db.devices_collection.find_one({"_id": lamp_id})['isOn'] is True
+    assert db.devices_collection.find_one({"_id": thermostat_id})['temperature'] == 21
+    delete_logs({"device": {"$in": [str(lamp_id), str(thermostat_id)]}})
+
+@patch('requests.post')
+def test_bulk_commands_use_entity_domain(mock_post, client, auth_headers):
+    fan_id = ObjectId()
+    db.devices_collection.insert_one({"_id": fan_id, "name": "MOCK_Bulk HA Fan", "type": "fan",
+                                      "isHomeAssistant": True, "entityId": "fan.mock_bulk_fan", "isOn": False})
+    mock_post.return_value.status_code = 200
+
+    response = client.post('/api/devices/commands', json={
+        "commands": [{"deviceId": str(fan_id), "command": "turn_on"}]
+    }, headers=auth_headers)
+    assert response.get_json()['succeeded'] == 1
+    assert mock_post.call_args[0][0].endswith('/api/services/fan/turn_on')
+    assert db.devices_collection.find_one({"_id": fan_id})['isOn'] is True
+    delete_logs({"device": "fan.mock_bulk_fan"})
+
+def test_bulk_commands_reject_boolean_temperature(client, auth_headers):
+    thermostat_id = ObjectId()
+    db.devices_collection.insert_one({"_id": thermostat_id, "name": "MOCK_Bool Thermostat", "type": "thermostat",
+                                      "isHomeAssistant": False, "isOn": True, "temperature": 20})
+
+    response = client.post('/api/devices/commands', json={
+        "commands": [{"deviceId": str(thermostat_id), "command": "set_temperature", "temperature": True}]
+    }, headers=auth_headers)
+    assert response.status_code == 200
+    assert response.get_json()['results'][0]['error'] == 'Temperature must be a number'
+    assert db.devices_collection.find_one({"_id": thermostat_id})['temperature'] == 20
+
+@patch('requests.get')
+def test_refresh_device_state_updates_is_on(mock_get, client):
+    from device_registry import device_registry
+    device_id = ObjectId()
+    db.devices_collection.insert_one({"_id": device_id, "name": "MOCK_Refresh Light", "type": "light",
+                                      "isHomeAssistant": True, "entityId": "light.mock_refresh", "isOn": False})
+    version = db.devices_collection.find_one({"_id": device_id}).get('version', 0)
+    mock_get.return_value.status_code = 200
+    mock_get.return_value.json.return_value = {
+        "entity_id": "light.mock_refresh", "state": "on", "last_updated": "2025-01-01T00:00:00", "attributes": {}
+    }
+
+    response = client.post(f'/api/devices/{device_id}/refresh')
+    assert response.status_code == 200
+    device = db.devices_collection.find_one({"_id": device_id})
+    assert device['isOn'] is True
+    assert device['version'] > version
+    assert device_registry.get(device_id)['isOn'] is True
+    delete_logs({"device": "MOCK_Refresh Light"})
+
+@patch('requests.get')
+def test_refresh_device_group_single_states_fetch(mock_get, client):
+    ha_id = ObjectId()
+    missing_id = ObjectId()
+    climate_id = ObjectId()
+    db.devices_collection.insert_many([
+        {"_id": ha_id, "name": "MOCK_Group Light", "type": "light", "group": "mock_group",
+         "isHomeAssistant": True, "entityId": "light.mock_group_light", "isOn": False},
+        {"_id": missing_id, "name": "MOCK_Group Ghost", "type": "light", "group": "mock_group",
+         "isHomeAssistant": True, "entityId": "light.mock_ghost", "isOn": False},
+        {"_id": climate_id, "name": "MOCK_Group Thermostat", "type": "thermostat", "group": "mock_group",
+         "isHomeAssistant": True, "entityId": "climate.mock_group_thermostat", "isOn": False}
+    ])
+
+    mock_get.return_value.status_code = 200
+    mock_get.return_value.json.return_value = [
+        {"entity_id": "light.mock_group_light", "state": "on", "last_updated": "2025-01-01T00:00:00"},
+        {"entity_id": "climate.mock_group_thermostat", "state": "heat", "last_updated": "2025-01-01T00:00:00"}
+    ]
+
+    response = client.post('/api/devices/group/mock_group/refresh')
+    assert response.status_code == 200
+    data = response.get_json()
+    assert data['refreshed'] == 2
+    assert data['failed'] == 1
+    assert mock_get.call_count == 1
+    assert db.devices_collection.find_one({"_id": ha_id})['isOn'] is True
+    # Climate entities report their HVAC mode; anything but off means on
+    assert db.devices_collection.find_one({"_id": climate_id})['isOn'] is True
+    delete_logs({"device": {"$in": [str(ha_id), str(missing_id), str(climate_id)]}})
+
+def test_get_devices_reports_version(client):
+    response = client.get('/api/devices')
+    assert response.status_code == 200
+    assert int(response.headers['X-Devices-Version']) >= 0
+
+def test_get_devices_since_returns_changes_only(client, auth_headers):
+    device_id = ObjectId()
+    db.devices_collection.insert_one({
+        "_id": device_id,
+        "name": "MOCK_Delta Lamp",
+        "type": "light",
+        "isHomeAssistant": False,
+        "isOn": False
+    })
+    version = int(client.get('/api/devices').headers['X-Devices-Version'])
+
+    empty = client.get(f'/api/devices?since={version}').get_json()
+    assert all(d['id'] != str(device_id) for d in empty['changed'])
+
+    client.post(f'/api/devices/{device_id}/toggle', headers=auth_headers)
+    delta = client.get(f'/api/devices?since={version}').get_json()
+    assert delta['version'] >= version
+    assert [d['isOn'] for d in delta['changed'] if d['id'] == str(device_id)] == [True]
+
+    client.delete(f'/api/devices/{device_id}', headers=auth_headers)
+    delta = client.get(f'/api/devices?since={delta["version"]}').get_json()
+    assert str(device_id) in delta['deleted']
+    delete_logs({"device": str(device_id)})
+
+def test_get_devices_since_catches_out_of_order_writes(client):
+    from device_registry import device_registry
+    early_id, late_id = ObjectId(), ObjectId()
+    db.insert_device({"_id": early_id, "name": "MOCK_Delta Early Lamp", "type": "light", "isHomeAssistant": False, "isOn": False})
+    db.insert_device({"_id": late_id, "name": "MOCK_Delta Late Lamp", "type": "light", "isHomeAssistant": False, "isOn": False})
+    assert device_registry.get(late_id)['isOn'] is False
+    device_registry.sync()
+
+    # A write stamped before the latest visible one, still in flight during the poll
+    late_version = db.devices_collection.find_one({"_id": early_id})['version'] - 1
+    delta = client.get('/api/devices?since=0').get_json()
+    assert delta['version'] < late_version
+
+    db.devices_collection.update_one({"_id": late_id}, {"$set": {"isOn": True, "version": late_version}})
+    delta = client.get(f'/api/devices?since={delta["version"]}').get_json()
+    assert [d['isOn'] for d in delta['changed'] if d['id'] == str(late_id)] == [True]
+
+    # Other workers' registries pick it up on their next incremental sync too
+    device_registry.sync()
+    assert device_registry.get(late_id)['isOn'] is True
+    db.devices_collection.delete_many({"_id": {"$in": [early_id, late_id]}})
+    device_registry.remove(early_id)
+    device_registry.remove(late_id)
+
+def test_device_writes_stamp_their_own_version(client, auth_headers):
+    device_id = ObjectId()
+    db.devices_collection.insert_one({
+        "_id": device_id,
+        "name": "MOCK_Stamped Lamp",
+        "type": "light",
+        "isHomeAssistant": False,
+        "isOn": False
+    })
+    counter = db.counters_collection.find_one({"_id": "devices"})
+
+    client.post(f'/api/devices/{device_id}/toggle', headers=auth_headers)
+    first = db.devices_collection.find_one({"_id": device_id})['version']
+    client.post(f'/api/devices/{device_id}/toggle', headers=auth_headers)
+    second = db.devices_collection.find_one({"_id": device_id})['version']
+    assert 0 < first <= second
+    assert db.counters_collection.find_one({"_id": "devices"}) == counter
+    delete_logs({"device": str(device_id)})
+
+def test_get_devices_conditional_get_follows_version(client, auth_headers):
+    device_id = ObjectId()
+    db.devices_collection.insert_one({
+        "_id": device_id,
+        "name": "MOCK_ETag Lamp",
+        "type": "light",
+        "isHomeAssistant": False,
+        "isOn": False
+    })
+    client.post(f'/api/devices/{device_id}/toggle', headers=auth_headers)
+
+    # Right after a write the listing gets no ETag: a write stamped just below
+    # it may still land, and a 304 would then hide it for good
+    assert client.get('/api/devices').headers.get('ETag') is None
+
+    with patch('db.DEVICE_VERSION_SETTLE_SECONDS', 0):
+        first = client.get('/api/devices')
+        etag = first.headers.get('ETag')
+        assert etag is not None
+        assert client.get('/api/devices', headers={'If-None-Match': etag}).status_code == 304
+
+        # A write from any worker changes the latest version
+        client.post(f'/api/devices/{device_id}/toggle', headers=auth_headers)
+        changed = client.get('/api/devices', headers={'If-None-Match': etag})
+        assert changed.status_code == 200
+        assert changed.headers.get('ETag') != etag
+    delete_logs({"device": str(device_id)})
+
+def test_get_devices_since_invalid(client):
+    response = client.get('/api/devices?since=abc')
+    assert response.status_code == 400
+
+def test_command_coalescer_merges_rapid_commands():
+    import threading
+    import time
+    from coalescer import CommandCoalescer
+
+    coalescer = CommandCoalescer(window=0.2)
+    executed = []
+
+    def execute(intent):
+        time.sleep(0.05)
+        executed.append(intent)
+        return intent
+
+    results = []
+    first = threading.Thread(target=lambda: results.append(coalescer.submit("dev", 1, lambda a, b: a + b, execute)))
+    first.start()
+    time.sleep(0.01)
+    followers = [
+        threading.Thread(target=lambda: results.append(coalescer.submit("dev", 1, lambda a, b: a + b, execute)))
+        for _ in range(3)
+    ]
+    for t in followers:
+        t.start()
+    for t in [first] + followers:
+        t.join()
+
+    # The first command runs at once; the ones arriving meanwhile run once,
+    # merged, and all of them get that result
+    assert executed == [1, 3]
+    assert sorted(results) == [1, 3, 3, 3]
+    # Idle keys are dropped
+    assert coalescer.stats()["active_keys"] == 0
+
+def test_command_coalescer_runs_lone_command_at_once():
+    import time
+    from coalescer import CommandCoalescer
+
+    coalescer = CommandCoalescer(window=5)
+    started = time.monotonic()
+    assert coalescer.submit("dev", ["alice"], lambda a, b: a + b, len) == 1
+    assert time.monotonic() - started < 1
+    assert coalescer.stats()["active_keys"] == 0
+
+def test_command_coalescer_repeated_taps_net_out():
+    import threading
+    import time
+    from coalescer import CommandCoalescer
+
+    coalescer = CommandCoalescer(window=0.1)
+    executed = []
+
+    def execute(users):
+        time.sleep(0.05)
+        executed.append(users)
+        return len(users) % 2
+
+    first = threading.Thread(target=coalescer.submit, args=("dev", ["alice"], lambda a, b: a + b, execute))
+    first.start()
+    time.sleep(0.01)
+    taps = [
+        threading.Thread(target=coalescer.submit, args=("dev", [user], lambda a, b: a + b, execute))
+        for user in ("bob", "carol")
+    ]
+    for t in taps:
+        t.start()
+    for t in [first] + taps:
+        t.join()
+
+    # Taps made while the first toggle ran net out in one execution that
+    # knows who sent them
+    assert executed[0] == ["alice"]
+    assert sorted(executed[1]) == ["bob", "carol"]
+
+def test_async_command_coalescer_merges_followers():
+    import asyncio
+    from coalescer import AsyncCommandCoalescer
+
+    coalescer = AsyncCommandCoalescer(window=0.1)
+    executed = []
+
+    async def execute(users):
+        await asyncio.sleep(0.05)
+        executed.append(users)
+        return len(users)
+
+    async def run():
+        first = asyncio.ensure_future(coalescer.submit("dev", ["alice"], lambda a, b: a + b, execute))
+        await asyncio.sleep(0.01)
+        followers = [coalescer.submit("dev", [user], lambda a, b: a + b, execute) for user in ("bob", "carol")]
+        return await asyncio.gather(first, *followers)
+
+    assert asyncio.run(run()) == [1, 2, 2]
+    assert executed == [["alice"], ["bob", "carol"]]
+    assert coalescer.stats()["active_keys"] == 0
+
+@patch('requests.post')
+def test_optimistic_toggle_confirms_in_background(mock_post, client, auth_headers):
+    import time
+    device_id = ObjectId()
+    db.devices_collection.insert_one({
+        "_id": device_id,
+        "name": "MOCK_Optimistic HA Switch",
+        "type": "switch",
+        "isHomeAssistant": True,
+        "entityId": "switch.mock_optimistic",
+        "isOn": False
+    })
+    mock_post.return_value.status_code = 200
+
+    response = client.post(f'/api/devices/{device_id}/toggle?optimistic=true', headers=auth_headers)
+    assert response.status_code == 202
+    data = response.get_json()
+    assert data['status'] == 'pending'
+    assert data['device']['isOn'] is True
+
+    status = None
+    for _ in range(50):
+        status = client.get(f"/api/devices/commands/{data['commandId']}", headers=auth_headers).get_json()['status']
+        if status != 'pending':
+            break
+        time.sleep(0.05)
+    assert status == 'confirmed'
+    # Sent to the entity's own domain
+    assert mock_post.call_args[0][0].endswith('/api/services/switch/turn_on')
+    assert db.devices_collection.find_one({"_id": device_id})['isOn'] is True
+    db.device_commands_collection.delete_one({"_id": ObjectId(data['commandId'])})
+    delete_logs({"device": "switch.mock_optimistic"})
+
+@patch('requests.post')
+def test_optimistic_toggle_rolls_back_on_ha_failure(mock_post, client, auth_headers):
+    import time
+    device_id = ObjectId()
+    db.devices_collection.insert_one({
+        "_id": device_id,
+        "name": "MOCK_Optimistic Broken Light",
+        "type": "light",
+        "isHomeAssistant": True,
+        "entityId": "light.mock_optimistic_broken",
+        "isOn": False
+    })
+    mock_post.return_value.status_code = 500
+    mock_post.return_value.text = 'Internal Server Error'
+
+    data = client.post(f'/api/devices/{device_id}/toggle?optimistic=true', headers=auth_headers).get_json()
+
+    status = None
+    for _ in range(50):
+        status = client.get(f"/api/devices/commands/{data['commandId']}", headers=auth_headers).get_json()['status']
+        if status != 'pending':
+            break
+        time.sleep(0.05)
+    assert status == 'rolled_back'
+    assert db.devices_collection.find_one({"_id": device_id})['isOn'] is False
+    db.device_commands_collection.delete_one({"_id": ObjectId(data['commandId'])})
+    delete_logs({"device": "light.mock_optimistic_broken"})
+
+def test_device_registry_reads_through_and_reports_stats(client, auth_headers):
+    from device_registry import device_registry
+    device_id = ObjectId()
+    db.devices_collection.insert_one({
+        "_id": device_id,
+        "name": "MOCK_Registry Lamp",
+        "type": "light",
+        "isHomeAssistant": False,
+        "isOn": False
+    })
+
+    # Inserted behind the registry's back: first lookup misses and reads through
+    assert device_registry.get(device_id)['name'] == "MOCK_Registry Lamp"
+    assert device_registry.get(str(device_id))['isOn'] is False
+
+    response = client.post(f'/api/devices/{device_id}/toggle', headers=auth_headers)
+    assert response.status_code == 200
+    assert device_registry.get(device_id)['isOn'] is True
+
+    stats = client.get('/api/devices/registry/stats', headers=auth_headers).get_json()
+    assert stats['hits'] >= 1
+    assert stats['devices'] >= 1
+    device_registry.remove(device_id)
+    delete_logs({"device": str(device_id)})
+
+def test_device_registry_apply_notifies_for_uncached_device():
+    from device_registry import device_registry
+    device_id = ObjectId()
+    db.devices_collection.insert_one({
+        "_id": device_id,
+        "name": "MOCK_Uncached Lamp",
+        "type": "light",
+        "isHomeAssistant": False,
+        "isOn": True
+    })
+    seen = []
+    device_registry.add_listener(lambda device, changes: seen.append((device["_id"], changes)))
+    try:
+        device_registry.remove(device_id)
+        device_registry.apply(device_id, {"isOn": True})
+    finally:
+        device_registry._listeners.pop()
+
+    # The device is read through, so listeners (e.g. state triggers) still see the change
+    assert (device_id, {"isOn": (None, True)}) in seen
+    assert device_registry.get(device_id)['isOn'] is True
+    device_registry.remove(device_id)
+
+@patch('requests.post')
+def test_toggle_homeassistant_device_uses_toggle_service(mock_post, client, auth_headers):
+    device_id = ObjectId()
+    db.devices_collection.insert_one({
+        "_id": device_id,
+        "name": "MOCK_HA Toggle Light",
+        "type": "light",
+        "isHomeAssistant": True,
+        "entityId": "light.mock_toggle_service",
+        "isOn": False
+    })
+    mock_post.return_value.status_code = 200
+    # Home Assistant reports the state it actually reached
+    mock_post.return_value.json.return_value = [{"entity_id": "light.mock_toggle_service", "state": "off"}]
+
+    response = client.post(f'/api/devices/{device_id}/toggle', headers=auth_headers)
+    assert response.status_code == 200
+    assert mock_post.call_args[0][0].endswith('/api/services/light/toggle')
+    assert response.get_json()['isOn'] is False
+    delete_logs({"device": "light.mock_toggle_service"})
+
+def test_reset_device_runs_as_background_job(client, auth_headers):
+    import time
+    device_id = ObjectId()
+    db.devices_collection.insert_one({
+        "_id": device_id,
+        "name": "MOCK_Reset Thermostat",
+        "type": "thermostat",
+        "isHomeAssistant": False,
+        "isOn": True
+    })
+
+    response = client.post(f'/api/devices/{device_id}/reset', headers=auth_headers)
+    assert response.status_code == 202
+    data = response.get_json()
+    assert data['status'] == 'queued'
+
+    job = None
+    for _ in range(50):
+        job = client.get(f"/api/devices/jobs/{data['jobId']}", headers=auth_headers).get_json()
+        if job['status'] not in ('queued', 'running'):
+            break
+        time.sleep(0.05)
+    # Thermostats have no reset strategy
+    assert job['status'] == 'failed'
+    assert job['resultCode'] == 400
+    assert 'Reset not supported' in job['result']['error']
+    db.device_jobs_collection.delete_one({"_id": ObjectId(data['jobId'])})
+    delete_logs({"device": "MOCK_Reset Thermostat"})
+
+def test_device_job_not_found(client, auth_headers):
+    response = client.get('/api/devices/jobs/ffffffffffffffffffffffff', headers=auth_headers)
+    assert response.status_code == 404
+    response = client.post('/api/devices/ffffffffffffffffffffffff/test', headers=auth_headers)
+    assert response.status_code == 404
+
+def test_set_device_power_flips_atomically():
+    from concurrent.futures import ThreadPoolExecutor
+    device_id = ObjectId()
+    db.devices_collection.insert_one({
+        "_id": device_id,
+        "name": "MOCK_Atomic Lamp",
+        "type": "light",
+        "isHomeAssistant": False,
+        "isOn": False
+    })
+
+    # An even number of concurrent flips must land back where it started
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(lambda _: db.set_device_power(device_id), range(10)))
+    assert db.devices_collection.find_one({"_id": device_id})['isOn'] is False
+
+    device = db.set_device_power(device_id, True)
+    assert device['isOn'] is True
+    assert db.set_device_power(ObjectId()) is None
@@ -153,3 +153,34 @@ def test_toggle_ha_flips_device_state(mock_get, mock_post, client, auth_headers)
     data = response.get_json()
     assert data.get("success") is True
     assert data.get("new_state") == "off"
+
+def test_ha_event_updates_device(client, auth_headers):
+    device_id = db.devices_collection.insert_one({
+        "name": "MOCK_Event Thermostat",
+        "type": "thermostat",
+        "entityId": "climate.mock_event",
+        "isHomeAssistant": True,
+        "isOn": False,
+        "temperature": 19
+    }).inserted_id
+
+    response = client.post('/api/home-assistant/events', json={
+        "event_type": "state_changed",
+        "data": {
+            "entity_id": "climate.mock_event",
+            "new_state": {"state": "heat", "attributes": {"temperature": 22}}
+        }
+    }, headers=auth_headers)
+    assert response.status_code == 200
+    assert response.get_json()['changed'] == {"isOn": True, "temperature": 22}
+
+    device = db.devices_collection.find_one({"_id": device_id})
+    assert device['isOn'] is True
+    assert device['temperature'] == 22
+
+def test_ha_event_unknown_entity(client, auth_headers):
+    response = client.post('/api/home-assistant/events', json={
+        "event_type": "state_changed",
+        "data": {"entity_id": "light.does_not_exist", "new_state": {"state": "on"}}
+    }, headers=auth_headers)
+    assert response.status_code == 404
@@ -5,8 +5,9 @@ warnings.filterwarnings("ignore", category=FutureWarning)
 import pytest
 import sys
 import os
+import time
 from bson import ObjectId
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
 
 # Add backend path
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
@@ -39,6 +40,7 @@ def cleanup_mock_ml_data():
     db.devices_collection.delete_many({"name": {"$regex": "^MOCK_"}})
     db.device_history_collection.delete_many({"device_id": {"$exists": True}})
     db.prediction_feedback_collection.delete_many({"device_id": {"$exists": True}})
+    db.device_usage_models_collection.delete_many({})
 
 def test_predict_device_invalid_id(client, auth_headers):
     response = client.get('/api/ml/predict/device/000000000000000000000000', headers=auth_headers)
@@ -112,3 +114,112 @@ def test_feedback_rejected(client, auth_headers):
     }
     response = client.post('/api/ml/feedback', json=feedback, headers=auth_headers)
     assert response.status_code == 200
+
+def test_online_model_learns_from_history(client, auth_headers):
+    from ml_models import update_device_history, usage_model, device_predictor
+    device_id = db.devices_collection.insert_one({
+        "name": "MOCK_Online Lamp",
+        "type": "light",
+        "isOn": False
+    }).inserted_id
+
+    # History recorded before the online model existed is folded in on first use
+    monday_evening = datetime(2026, 1, 5, 19, 0, tzinfo=timezone.utc)
+    db.device_history_collection.insert_many([
+        {"device_id": device_id, "timestamp": monday_evening - timedelta(weeks=week),
+         "previous_state": False, "state": True}
+        for week in range(12)
+    ])
+    probability, events = usage_model.predict(device_id, monday_evening, False)
+    assert events == 12
+    assert probability > 0.7
+
+    # New state changes update the stored counts without retraining
+    update_device_history(str(device_id), True)
+    doc = db.device_usage_models_collection.find_one({"_id": device_id})
+    assert doc['events'] == 13
+
+    expected = device_predictor.predict_device_state(str(device_id))
+    assert expected['model'] == "online"
+    assert expected['events'] == 13
+
+    response = client.get(f'/api/ml/predict/device/{device_id}', headers=auth_headers)
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body['device']['id'] == str(device_id)
+    assert body['device']['current_state'] is False
+    assert body['prediction']['should_be_on'] == expected['prediction']
+    assert body['prediction']['confidence'] == pytest.approx(expected['probability'])
+    assert 0 < body['prediction']['confidence'] < 1
+
+def test_online_model_bootstrap_keeps_concurrent_counts():
+    from ml_models import usage_model
+    device_id = db.devices_collection.insert_one({"name": "MOCK_Bootstrap Lamp", "type": "light", "isOn": False}).inserted_id
+    monday_evening = datetime(2026, 1, 5, 19, 0, tzinfo=timezone.utc)
+    db.device_history_collection.insert_many([
+        {"device_id": device_id, "timestamp": monday_evening - timedelta(weeks=week),
+         "previous_state": False, "state": True}
+        for week in range(1, 13)
+    ])
+
+    # Counted before the history was folded in (its history entry lands later)
+    usage_model.observe(device_id, monday_evening, False, True)
+    usage_model.forget(device_id)
+    probability, events = usage_model.predict(device_id, monday_evening, False)
+    assert events == 13
+    assert db.device_usage_models_collection.find_one({"_id": device_id})['bootstrapped'] is True
+
+    # A second bootstrap attempt adds nothing
+    usage_model._bootstrap(device_id)
+    assert db.device_usage_models_collection.find_one({"_id": device_id})['events'] == 13
+
+def test_training_queue_debounces_per_device():
+    from ml_models import TrainingQueue
+    trained = []
+    queue = TrainingQueue(lambda device_id: trained.append(device_id) or True, workers=2,
+                          quiet_seconds=0.2, event_threshold=100, max_delay=60, poll_interval=0.05)
+
+    for _ in range(10):
+        queue.mark_dirty("device-a")
+    queue.mark_dirty("device-b")
+    assert queue.stats()['queue_depth'] == 2
+    assert trained == []
+
+    for _ in range(40):
+        if len(trained) == 2:
+            break
+        time.sleep(0.05)
+    # Ten events for device-a still give a single training run
+    assert sorted(trained) == ["device-a", "device-b"]
+    stats = queue.stats()
+    assert stats['queue_depth'] == 0
+    assert stats['trained'] == 2
+
+def test_get_training_stats(client, auth_headers):
+    response = client.get('/api/ml/training/stats', headers=auth_headers)
+    assert response.status_code == 200
+    data = response.get_json()
+    assert 'queue_depth' in data['queue']
+    assert isinstance(data['models'], list)
+
+def test_prepare_data_vectorized_features():
+    from ml_models import device_predictor
+    device_id = db.devices_collection.insert_one({
+        "name": "MOCK_Feature Lamp",
+        "type": "light",
+        "isOn": False
+    }).inserted_id
+    saturday_night = datetime(2026, 1, 3, 23, 30, tzinfo=timezone.utc)
+    db.device_history_collection.insert_many([
+        {"device_id": device_id, "timestamp": saturday_night + timedelta(hours=i),
+         "previous_state": i % 2 == 0, "state": i % 2 == 1}
+        for i in range(12)
+    ])
+
+    X, y = device_predictor._prepare_data_for_device(str(device_id))
+    assert X.shape == (12, 4)
+    rows = sorted(map(tuple, X.tolist()))
+    # Saturday 23:30 and Sunday 00:30 onwards, both weekend days
+    assert (23, 5, 1, 1) in rows
+    assert (0, 6, 1, 0) in rows
+    assert sorted(y.tolist()) == [0] * 6 + [1] * 6
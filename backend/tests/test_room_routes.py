@@ -107,3 +107,18 @@ def test_delete_nonexistent_room(client, auth_headers):
 def test_invalid_objectid_format(client, auth_headers):
     response = client.get('/api/rooms/invalid123/devices', headers=auth_headers)
     assert response.status_code == 500
+
+def test_get_rooms_conditional_get(client, auth_headers):
+    first = client.get('/api/rooms/', headers=auth_headers)
+    assert first.status_code == 200
+    etag = first.headers.get('ETag')
+    assert etag
+
+    cached = client.get('/api/rooms/', headers={**auth_headers, 'If-None-Match': etag})
+    assert cached.status_code == 304
+
+    created = client.post('/api/rooms/', json={'name': 'MOCK_ETag Room'}, headers=auth_headers)
+    assert created.status_code == 201
+    changed = client.get('/api/rooms/', headers={**auth_headers, 'If-None-Match': etag})
+    assert changed.status_code == 200
+    assert changed.headers.get('ETag') != etag
@@ -0,0 +1,134 @@
+import pytest
+import sys
+import os
+from bson import ObjectId
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from app import app
+import db
+from models.log_schema import delete_logs
+
+@pytest.fixture
+def client():
+    app.config['TESTING'] = True
+    with app.test_client() as client:
+        yield client
+
+@pytest.fixture
+def auth_headers(client):
+    client.post('/api/auth/register', json={
+        'username': 'scenetester',
+        'email': 'scenetester@gmail.com',
+        'password': 'ValidPass123'
+    })
+    login = client.post('/api/auth/login', json={
+        'username': 'scenetester',
+        'password': 'ValidPass123'
+    })
+    token = login.get_json().get('access_token')
+    return {'Authorization': f'Bearer {token}'}
+
+@pytest.fixture(autouse=True)
+def cleanup_mock_scenes():
+    yield
+    db.devices_collection.delete_many({"name": {"$regex": "^MOCK_"}})
+    db.scenes_collection.delete_many({"name": {"$regex": "^MOCK_"}})
+
+def insert_mock_devices():
+    lamp_id, thermostat_id, ha_id = ObjectId(), ObjectId(), ObjectId()
+    db.devices_collection.insert_many([
+        {"_id": lamp_id, "name": "MOCK_Scene Lamp", "type": "light", "isHomeAssistant": False, "isOn": True},
+        {"_id": thermostat_id, "name": "MOCK_Scene Thermostat", "type": "thermostat", "isHomeAssistant": False, "isOn": False},
+        {"_id": ha_id, "name": "MOCK_Scene HA Light", "type": "light", "isHomeAssistant": True,
+         "entityId": "light.mock_scene", "isOn": True}
+    ])
+    return lamp_id, thermostat_id, ha_id
+
+def test_add_scene_missing_name(client, auth_headers):
+    response = client.post('/api/scenes/', json={"actions": []}, headers=auth_headers)
+    assert response.status_code == 400
+    assert response.get_json().get('error') == "Scene name required"
+
+def test_add_scene_invalid_actions(client, auth_headers):
+    response = client.post('/api/scenes/', json={
+        "name": "MOCK_Bad Scene",
+        "actions": [{"deviceId": str(ObjectId())}]
+    }, headers=auth_headers)
+    assert response.status_code == 400
+    assert response.get_json().get('error') == "Each action needs isOn or temperature"
+
+def test_add_and_list_scene(client, auth_headers):
+    lamp_id, thermostat_id, _ = insert_mock_devices()
+    response = client.post('/api/scenes/', json={
+        "name": "MOCK_Movie Night",
+        "actions": [
+            {"deviceId": str(lamp_id), "isOn": False},
+            {"deviceId": str(thermostat_id), "isOn": True, "temperature": 22}
+        ]
+    }, headers=auth_headers)
+    assert response.status_code == 201
+    scene = response.get_json()
+    assert scene['actions'][0]['deviceId'] == str(lamp_id)
+
+    scenes = client.get('/api/scenes/', headers=auth_headers).get_json()
+    assert any(s['id'] == scene['id'] for s in scenes)
+
+@patch('requests.post')
+def test_apply_scene(mock_post, client, auth_headers):
+    lamp_id, thermostat_id, ha_id = insert_mock_devices()
+    mock_post.return_value.status_code = 200
+    scene = client.post('/api/scenes/', json={
+        "name": "MOCK_Leave Home",
+        "actions": [
+            {"deviceId": str(lamp_id), "isOn": False},
+            {"deviceId": str(thermostat_id), "temperature": 17},
+            {"deviceId": str(ha_id), "isOn": False},
+            {"deviceId": "ffffffffffffffffffffffff", "isOn": False}
+        ]
+    }, headers=auth_headers).get_json()
+
+    response = client.post(f"/api/scenes/{scene['id']}/apply", headers=auth_headers)
+    assert response.status_code == 200
+    data = response.get_json()
+    assert data['succeeded'] == 3
+    assert data['failed'] == 1
+    assert 'total_ms' in data['timing']
+
+    # One grouped Home Assistant call for the HA light
+    assert mock_post.call_count == 1
+    assert mock_post.call_args.kwargs['json'] == {"entity_id": ["light.mock_scene"]}
+
+    assert db.devices_collection.find_one({"_id": lamp_id})['isOn'] is False
+    assert db.devices_collection.find_one({"_id": thermostat_id})['temperature'] == 17
+    assert db.devices_collection.find_one({"_id": ha_id})['isOn'] is False
+    assert db.scenes_collection.find_one({"_id": ObjectId(scene['id'])})['last_timing']
+    delete_logs({"device": {"$in": [str(lamp_id), str(thermostat_id), "light.mock_scene", "ffffffffffffffffffffffff"]}})
+
+def test_apply_scene_logs_temperature_on_non_thermostat(client, auth_headers):
+    from models.device_log import device_log_writer
+    from models.log_schema import find_logs
+    lamp_id, _, _ = insert_mock_devices()
+    scene = client.post('/api/scenes/', json={
+        "name": "MOCK_Warm Lamp",
+        "actions": [{"deviceId": str(lamp_id), "temperature": 22}]
+    }, headers=auth_headers).get_json()
+
+    data = client.post(f"/api/scenes/{scene['id']}/apply", headers=auth_headers).get_json()
+    assert data['results'][0]['error'] == "Not a thermostat"
+
+    # Logged like every other failed scene action
+    device_log_writer.flush()
+    logs = find_logs({"device": str(lamp_id), "action": "scene"})
+    assert logs and logs[0]['is_error'] is True
+    assert logs[0]['error_type'] == "unsupported_operation"
+    delete_logs({"device": str(lamp_id)})
+
+def test_apply_scene_not_found(client, auth_headers):
+    response = client.post('/api/scenes/ffffffffffffffffffffffff/apply', headers=auth_headers)
+    assert response.status_code == 404
+
+def test_delete_scene(client, auth_headers):
+    scene_id = db.scenes_collection.insert_one({"name": "MOCK_Delete Scene", "actions": []}).inserted_id
+    response = client.delete(f'/api/scenes/{scene_id}', headers=auth_headers)
+    assert response.status_code == 200